@@ -10,7 +10,9 @@ __version__ = 1
 
 
 import Nagios2Timeline
+import signal
 import sys
+from os.path import exists as File_exists
 
 EXIT = {'OK' : 0,
         'SYNTAX_ERROR' : 1}
@@ -21,42 +23,400 @@ def main():
     # files will contain all remaining positional arguments
     (options, files) = parser.parse_args()
 
-    if len(files) < 2:
+    # Serve mode takes logs only, and no output file.
+    if files and files[0] == 'serve':
+        if len(files) < 2:
+            sys.stderr.write("Error: Missing input files to serve.\n\n")
+            parser.print_help()
+            sys.exit(EXIT['SYNTAX_ERROR'])
+        serve(options, files[1:])
+        return
+
+    if len(files) < 2 and not (options.sources and files):
         sys.stderr.write("Error: Missing input and output files.\n\n")
         parser.print_help()
         sys.exit(EXIT['SYNTAX_ERROR'])
+
+    # Under --profile, the whole run is profiled by cProfile.
+    if options.profile:
+        import cProfile
+        cProfile.runctx('run(options, files)', globals(),
+                        {'options' : options, 'files' : files},
+                        options.profile)
     else:
-        # Grab the last file for our output
-        outputfile = files[-1]
-        files = files[:-1]
+        run(options, files)
+
+
+def run(options, files):
+    """Convert files into the last of them as instructed by options."""
+    # Formats are named in upper case.
+    options.format = options.format.upper()
+    if options.format not in Nagios2Timeline.WRITERS:
+        sys.stderr.write("Error: Unknown format %s.\n" % options.format)
+        sys.exit(EXIT['SYNTAX_ERROR'])
+
+    # Grab the last file for our output
+    outputfile = files[-1]
+    files = files[:-1]
+
+    # Follow mode reads a single live log and always keeps a checkpoint.
+    if options.follow:
+        if len(files) != 1:
+            sys.stderr.write("Error: Follow mode takes a single input file.\n")
+            sys.exit(EXIT['SYNTAX_ERROR'])
+        options.incremental = True
+
+    # A database is exported as a whole, into a new output file.
+    if options.from_db:
+        if len(files) != 1 or not File_exists(files[0]):
+            sys.stderr.write("Error: --from-db takes a single database.\n")
+            sys.exit(EXIT['SYNTAX_ERROR'])
+        if options.incremental or options.append:
+            sys.stderr.write("Error: --from-db cannot append to the " + \
+                             "output.\n")
+            sys.exit(EXIT['SYNTAX_ERROR'])
+
+    # Dumps of parsed alerts are replayed as a whole, into a new output
+    # file, and dumped from the logs read by a single process. They hold
+    # nothing but the alerts.
+    other_kinds = options.snapshots or options.downtime or options.acks or \
+                  options.notifications
+    if (options.from_parsed or options.dump_parsed) and other_kinds:
+        sys.stderr.write("Error: --from-parsed and --dump-parsed cannot " + \
+                         "be used with --snapshots, --downtime, " + \
+                         "--acks or --notifications.\n")
+        sys.exit(EXIT['SYNTAX_ERROR'])
+    if options.from_parsed:
+        if options.incremental or options.append or options.from_db or \
+           options.sources:
+            sys.stderr.write("Error: --from-parsed cannot append to the " + \
+                             "output or be used with --from-db or " + \
+                             "--source.\n")
+            sys.exit(EXIT['SYNTAX_ERROR'])
+        for file in files:
+            if not File_exists(file):
+                sys.stderr.write("Error: No such dump %s.\n" % file)
+                sys.exit(EXIT['SYNTAX_ERROR'])
+
+    # A time window is read through the log indexes, not from checkpoints.
+    window = options.since is not None or options.until is not None
+    if window and options.incremental:
+        sys.stderr.write("Error: --since and --until cannot be used in " + \
+                         "incremental or follow mode.\n")
+        sys.exit(EXIT['SYNTAX_ERROR'])
+
+    # A dump replays as the whole of its logs, so it cannot be made from a
+    # time window or from the part of the logs left by a checkpoint.
+    if options.dump_parsed:
+        if options.incremental or options.from_db or options.from_parsed \
+           or window:
+            sys.stderr.write("Error: --dump-parsed cannot be used with " + \
+                             "--from-db, --from-parsed, --since, " + \
+                             "--until or in incremental or follow " + \
+                             "mode.\n")
+            sys.exit(EXIT['SYNTAX_ERROR'])
+        options.jobs = 1
+
+    # Several sources are merged into one stream, which has no offsets to
+    # checkpoint or index. The input files form a source of their own.
+    sources = None
+    if options.sources:
+        if options.incremental or options.from_db or window:
+            sys.stderr.write("Error: --source cannot be used with " + \
+                             "--from-db, --since, --until or in " + \
+                             "incremental or follow mode.\n")
+            sys.exit(EXIT['SYNTAX_ERROR'])
+        sources = [Nagios2Timeline.parse_source(spec)
+                   for spec in options.sources]
+        for source in sources:
+            if not File_exists(source.path):
+                sys.stderr.write("Error: No such source %s.\n" % source.path)
+                sys.exit(EXIT['SYNTAX_ERROR'])
+        if files:
+            sources.insert(0, Nagios2Timeline.LogSource(files))
+
+    # Host and service patterns are checked before anything is read.
+    try:
+        (host_filter, service_filter) = Nagios2Timeline.name_filters(options)
+    except ValueError, e:
+        sys.stderr.write("Error: %s\n" % e)
+        sys.exit(EXIT['SYNTAX_ERROR'])
+
+    # The Nagios configuration is read, or its index loaded, up front.
+    configs = read_configs(options)
+
+    # Correlated failures take at least one host.
+    if options.min_hosts < 1:
+        sys.stderr.write("Error: --min-hosts must be at least 1.\n")
+        sys.exit(EXIT['SYNTAX_ERROR'])
+
+    # The limits of ongoing outages are a count and a duration.
+    if options.max_open < 0 or options.max_age < 0:
+        sys.stderr.write("Error: --max-open and --max-age cannot be " \
+                         "negative.\n")
+        sys.exit(EXIT['SYNTAX_ERROR'])
+
+    # Statistics are collected per file, so the files are read one by one.
+    if options.stats_json:
+        options.stats = True
+    if options.stats and options.jobs > 1:
+        options.jobs = 1
+
+    # The limits close outages in the order they were read across files.
+    if options.max_open or options.max_age:
+        options.jobs = 1
+
+    # In incremental mode, continue from the checkpoint of the previous run.
+    # Without one, the output file must not exist yet.
+    checkpoint = None
+    if options.incremental:
+        checkpoint = Nagios2Timeline.Checkpoint(outputfile + '.checkpoint')
+        try:
+            options.append = checkpoint.load()
+        except ValueError, e:
+            sys.stderr.write("Error: %s\n" % e)
+            sys.exit(EXIT['SYNTAX_ERROR'])
+        if not options.append and File_exists(outputfile):
+            sys.stderr.write("Error: No checkpoint found for %s.\n" % \
+                             outputfile)
+            sys.exit(EXIT['SYNTAX_ERROR'])
+
+    # Levels are event sources for Timeline bands, not databases.
+    if options.levels and options.format == 'SQLITE':
+        sys.stderr.write("Error: --levels cannot be written as SQLITE.\n")
+        sys.exit(EXIT['SYNTAX_ERROR'])
 
     # Create XML or JSON output depending on command line parameters given
     # 'type' is not understood by NagiosLogReader.get_config()
-    if options.format == 'JSON':
-        writer = Nagios2Timeline.TimelineWriterJSON(outputfile, options.append)
-    else:
-        writer = Nagios2Timeline.TimelineWriterXML(outputfile, options.append)
+    # Only the writer of the format given is set up, along with the modules
+    # it needs.
+    try:
+        writer_class = Nagios2Timeline.WRITERS[options.format]
+        if options.levels:
+            writer = Nagios2Timeline.TimelineWriterLevels(
+                outputfile, writer_class, options.append, checkpoint)
+        elif options.format == 'JSON' and options.chunk:
+            writer = Nagios2Timeline.TimelineWriterJSONChunks(
+                outputfile, options.append, checkpoint, options.chunk)
+        else:
+            writer = writer_class(outputfile, options.append, checkpoint)
+    except ValueError, e:
+        sys.stderr.write("Error: %s\n" % e)
+        sys.exit(EXIT['SYNTAX_ERROR'])
+    writer.configs = configs
+
+    # Flapping outages are collapsed on their way to the writer, and the
+    # outages written are analysed.
+    output = writer
+    analytics = None
+    if options.analytics:
+        output = analytics = Nagios2Timeline.OutageAnalytics(
+            writer, options.min_hosts)
+    if options.merge_gap or options.min_duration:
+        output = Nagios2Timeline.FlapFilter(output, options.merge_gap,
+                                            options.min_duration)
+
+    # Regenerate the output from a database instead of reading logs.
+    if options.from_db:
+        database = Nagios2Timeline.TimelineWriterSQLite(files[0], True)
+        count = database.export(output, None, options.since, options.until,
+                                host_filter, service_filter)
+        if options.verbose:
+            print "Wrote %d events from %s into %s" % \
+                  (count, files[0], outputfile)
+        report_flapping(output, options.verbose)
+        report_analytics(analytics, options.analytics, options.verbose)
+        return
         
     # Create reader object, passing it the options extracted from the
     # command line parameters.
-    reader = Nagios2Timeline.NagiosLogReader(writer, options)
+    reader = Nagios2Timeline.NagiosLogReader(output, options)
+    stats = None
+    if options.stats:
+        stats = Nagios2Timeline.RunStats()
+        stats.instrument(reader)
+    dump = None
+    if options.dump_parsed:
+        try:
+            dump = reader.dump = Nagios2Timeline.ParsedDump(
+                options.dump_parsed)
+        except (ValueError, IOError), e:
+            sys.stderr.write("Error: %s\n" % e)
+            sys.exit(EXIT['SYNTAX_ERROR'])
     
     # If we were set to append, parse all ongoing events from the event file
     # and populate NLR's internal data structure with them
     if options.append:
         reader.set_ongoing_events(writer.get_ongoing_events())
+        reader.last_timestamp = max(reader.last_timestamp,
+                                    writer.last_timestamp)
+
+    # In follow mode, keep reading the log until we are told to stop.
+    if options.follow:
+        follower = Nagios2Timeline.LogFollower(
+            reader, files[0], checkpoint, options.latency, options.batch,
+            options.checkpoint_interval)
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda signum, frame: follower.stop())
+        if options.verbose:
+            print "Following file %s" % files[0]
+        follower.run()
+        report_truncated(reader, options.verbose)
+        report_flapping(output, options.verbose)
+        report_analytics(analytics, options.analytics, options.verbose)
+        report_stats(stats, options.stats_json)
+        return
+
+    # Incremental runs only read the part of each log not read before.
+    offsets = [0] * len(files)
+    if checkpoint is not None:
+        offsets = [checkpoint.input_offset(file) for file in files]
 
     # For each log file remaining as input, let NLR parse through the log and
-    # pass events found to TLW for writing.
-    for file in files:
+    # pass events found to TLW for writing. With several jobs, the files are
+    # parsed in parallel and merged in the order given. A time window only
+    # reads the parts of the files which overlap it. Dumps of parsed alerts
+    # are replayed instead of reading logs.
+    if options.from_parsed:
+        ends = []
+        for file in files:
+            if options.verbose:
+                print "Replaying dump %s" % file
+            try:
+                alerts = Nagios2Timeline.ParsedAlerts(file)
+            except ValueError, e:
+                sys.stderr.write("Error: %s\n" % e)
+                sys.exit(EXIT['SYNTAX_ERROR'])
+            try:
+                reader.replay(alerts)
+            finally:
+                alerts.close()
+    elif sources:
+        if options.verbose:
+            print "Merging %d sources" % len(sources)
+        reader.process_sources(sources)
+        ends = []
+    elif window:
+        if options.verbose:
+            print "Processing the window of %d files" % len(files)
+        reader.process_window(files)
+        ends = []
+    elif options.jobs > 1 and len(files) > 1:
         if options.verbose:
-            print "Processing file %s" % file
-        reader.process(file)
+            print "Processing %d files in %d processes" % \
+                  (len(files), options.jobs)
+        ends = reader.process_many(files, options.jobs, offsets)
+    else:
+        ends = []
+        for (file, offset) in zip(files, offsets):
+            if options.verbose:
+                print "Processing file %s" % file
+            ends.append(reader.process(file, offset))
 
     # Finally, flush still ongoing events to the output.
+    if dump is not None:
+        if options.verbose:
+            print "Writing %d parsed alerts into %s" % \
+                  (dump.count, options.dump_parsed)
+        dump.close()
+    if options.verbose:
+        print "Writing %s document %s" % (options.format, outputfile)
+    reader.flush_events(checkpoint)
+    if checkpoint is not None:
+        for (file, end) in zip(files, ends):
+            checkpoint.consumed(file, end)
+        checkpoint.save()
+    report_truncated(reader, options.verbose)
+    report_flapping(output, options.verbose)
+    report_analytics(analytics, options.analytics, options.verbose)
+    report_stats(stats, options.stats_json)
+
+
+def serve(options, files):
+    """Serve the events of files over HTTP until interrupted."""
+    import socket
+    for file in files:
+        if not File_exists(file):
+            sys.stderr.write("Error: No such file %s.\n" % file)
+            sys.exit(EXIT['SYNTAX_ERROR'])
+    try:
+        Nagios2Timeline.name_filters(options)
+    except ValueError, e:
+        sys.stderr.write("Error: %s\n" % e)
+        sys.exit(EXIT['SYNTAX_ERROR'])
+    configs = read_configs(options)
     if options.verbose:
-        print "Writing XML document %s" % outputfile
-    reader.flush_events()
+        print "Reading %d files" % len(files)
+    service = Nagios2Timeline.TimelineService(files, options, configs,
+                                              options.cache_size)
+    try:
+        server = Nagios2Timeline.http_server(
+            (options.bind, options.port), service, options.verbose)
+    except socket.error, e:
+        sys.stderr.write("Error: Cannot listen on %s:%d: %s\n" % \
+                         (options.bind, options.port, e))
+        sys.exit(EXIT['SYNTAX_ERROR'])
+    # SIGTERM stops the server as an interrupt does.
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    if options.verbose:
+        print "Serving http://%s:%d/events.xml and /events.json" % \
+              server.server_address
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    service.close()
+
+
+def read_configs(options):
+    """Return the NagiosConfig of --configs, or None without it. The
+    configuration is read, or its index loaded, before any log."""
+    if not options.configs:
+        return None
+    configs = Nagios2Timeline.NagiosConfig(options.configs,
+                                           options.configs_index)
+    try:
+        configs.update()
+    except (IOError, OSError), e:
+        sys.stderr.write("Error: Cannot read configuration: %s\n" % e)
+        sys.exit(EXIT['SYNTAX_ERROR'])
+    if options.verbose:
+        print "Read the configuration of %d hosts and %d services" % \
+              (len(configs.hosts), len(configs.services))
+    return configs
+
+
+def report_truncated(reader, verbose):
+    """Tell how many ongoing outages a limited reader closed, if
+    verbose."""
+    if verbose and (reader.max_open or reader.max_age):
+        print "Truncated %d ongoing outages" % reader.truncated
+
+
+def report_flapping(output, verbose):
+    """Tell how many outages a FlapFilter collapsed, if verbose."""
+    if verbose and isinstance(output, Nagios2Timeline.FlapFilter):
+        print "Merged %d flapping outages, dropped %d short outages" % \
+              (output.merged, output.dropped)
+
+
+def report_analytics(analytics, filename, verbose):
+    """Save the report of an OutageAnalytics into filename, and summarize
+    it if verbose."""
+    if analytics is not None:
+        report = analytics.save(filename)
+        if verbose:
+            print "Analysed %d outages, found %d periods of correlated " \
+                  "failures" % (report['outages'], len(report['correlated']))
+
+
+def report_stats(stats, filename):
+    """Print the statistics of a --stats run, and save them into filename."""
+    if stats is not None:
+        stats.report()
+        if filename:
+            stats.save(filename)
 
 if __name__ == "__main__":
     main()
@@ -3,7 +3,8 @@
 """Converts Nagios log files into event source files readable by the
 Timeline widget.
 
-This version currently only provides XML output, JSON is under development.
+Output is written as XML or JSON, optionally split into daily or weekly
+JSON documents.
 
 The following two references provide additional information.
   [1] Marc Powell, nagios.log format:
@@ -14,20 +15,171 @@ The following two references provide additional information.
 
 Copyright: GPL version 3 or later. See the file LICENSE for details."""
 from __future__ import with_statement
+import array
+import bisect
+import cPickle as pickle
+import errno
+import fnmatch
+import heapq
+import mmap
+import os
 import re
+import select
+import struct
 import sys
 import time
-import xml.dom.minidom
+from cStringIO import StringIO
 from os.path import exists as File_exists
-from optparse import OptionParser, OptionGroup, Values
+try:
+    import lzma
+except ImportError:
+    # Python 2 needs the backports.lzma package for xz archives
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+
+class LazyModule(object):
+    """Stands in for a module which not every run needs until one of its
+    attributes is used. The module is then imported, along with any
+    submodules given, and takes the place of the stand-in among our
+    globals.
+
+    Short runs from cron spend much of their time importing, so only the
+    modules used on every run are imported eagerly below. The writers and
+    modes which need the others pull them in as they are used. alternative
+    is imported if name cannot be."""
+
+    def __init__(self, name, alternative=None, submodules=()):
+        self.name = name
+        self.alternative = alternative
+        self.submodules = submodules
+
+
+    def __getattr__(self, attribute):
+        try:
+            module = __import__(self.name)
+        except ImportError:
+            if self.alternative is None:
+                raise
+            module = __import__(self.alternative)
+        for submodule in self.submodules:
+            __import__(submodule)
+        globals()[self.name] = module
+        return getattr(module, attribute)
+
+
+class LazyPattern(object):
+    """A regular expression class attribute, compiled on first use.
+
+    The regular expressions kept for reference or needed by one writer only
+    are not compiled on import."""
+
+    def __init__(self, pattern):
+        self.pattern = pattern
+        self.compiled = None
+
+
+    def __get__(self, instance, owner):
+        if self.compiled is None:
+            self.compiled = re.compile(self.pattern)
+        return self.compiled
+
+
+
+bz2 = LazyModule('bz2')
+collections = LazyModule('collections')
+ctypes = LazyModule('ctypes', submodules=('ctypes.util',))
+gzip = LazyModule('gzip')
+hashlib = LazyModule('hashlib')
+# Python 2.5 only has the simplejson package
+json = LazyModule('json', 'simplejson')
+multiprocessing = LazyModule('multiprocessing')
+optparse = LazyModule('optparse')
+shutil = LazyModule('shutil')
+sqlite3 = LazyModule('sqlite3')
+threading = LazyModule('threading')
+urlparse = LazyModule('urlparse')
+# NumPy is optional, see load_numpy()
+numpy = None
 __version__ = '1'
 __author__ =  'Pervilä <pervila@cs.helsinki.fi>'
 
+def xml_escape(data):
+    """Escape data for use as XML character data or attribute values.
+
+    Equal to xml.sax.saxutils.escape() with quotes escaped, which takes
+    longer to import than to write out."""
+    return data.replace('&', '&amp;').replace('>', '&gt;').replace(
+        '<', '&lt;').replace('"', '&quot;')
+
+
+def json_text(data):
+    """Return data as unicode for the json module.
+
+    Nagios passes plugin output through as is, so it is not necessarily
+    UTF-8. Anything else is assumed to be Latin-1."""
+    try:
+        return data.decode('utf-8')
+    except UnicodeError:
+        return data.decode('latin-1')
+
+
+def open_archive(filename):
+    """Open filename for reading if it is a gzip, bzip2 or xz archive.
+
+    The compression is detected from the first bytes of the file rather than
+    its name. Returns a file object producing the uncompressed log, or None
+    for uncompressed files. Raises IOError for xz archives if no lzma module
+    is available."""
+    with open(filename, 'rb') as f:
+        magic = f.read(6)
+    if magic.startswith('\x1f\x8b'):
+        return gzip.GzipFile(filename, 'rb')
+    elif magic.startswith('BZh'):
+        return bz2.BZ2File(filename, 'r', 1 << 20)
+    elif magic == '\xfd7zXZ\x00':
+        if lzma is None:
+            raise IOError, \
+"Reading the xz archive %s requires the lzma or backports.lzma module." % \
+filename
+        return lzma.LZMAFile(filename, 'rb')
+    return None
+
+
+def to_timestamp(value):
+    """Convert a time given as seconds since the epoch or as local time
+    "YYYY-MM-DD[ HH:MM[:SS]]" into an epoch timestamp.
+
+    Raises ValueError for other times."""
+    if value.isdigit():
+        return int(value)
+    for form in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            return int(time.mktime(time.strptime(value, form)))
+        except ValueError:
+            pass
+    raise ValueError, \
+        "invalid time %r, use YYYY-MM-DD [HH:MM[:SS]]" % value
+
+
+def parse_time(option, opt, value, parser):
+    """Option callback converting a time into an epoch timestamp, see
+    to_timestamp()."""
+    try:
+        timestamp = to_timestamp(value)
+    except ValueError, e:
+        raise optparse.OptionValueError, "option %s: %s" % (opt, e)
+    setattr(parser.values, option.dest, timestamp)
+
+
 def optparser():
     """Create an OptionParser compatible with Nmap2Timeline objects."""
-    usage = "usage: %prog [options] logfile1 logfile2 ... outputfile"
-    parser = OptionParser(usage=usage)
-    group = OptionGroup(parser, "Omit host or service states",
+    usage = "usage: %prog [options] logfile1 logfile2 ... outputfile\n" + \
+            "       %prog serve [options] logfile1 logfile2 ..."
+    parser = optparse.OptionParser(usage=usage)
+    group = optparse.OptionGroup(parser, "Omit host or service states",
                         "Each option silently discards events of that type.")
     group.add_option("-s", "--omit-services",
                       action="store_false", dest="services",
@@ -59,16 +211,552 @@ def optparser():
                       help="operate as quietly as possible")
     parser.add_option("-f", "--format", metavar="FORMAT", 
                       action="store", dest="format", type="string",
-                      help="output FORMAT: XML or JSON [default: %default]")
+                      help="output FORMAT: XML, JSON or SQLITE " + \
+                      "[default: %default]")
+    parser.add_option("--chunk", metavar="PERIOD",
+                      action="store", dest="chunk", type="choice",
+                      choices=['day', 'week'],
+                      help="split JSON output into one file per PERIOD, " + \
+                      "day or week, writing an index into the output file")
+    parser.add_option("--from-db",
+                      action="store_true", dest="from_db",
+                      help="read events from a database written with " + \
+                      "-f SQLITE, given as the only input, instead of logs")
+    parser.add_option("--dump-parsed", metavar="FILE",
+                      action="store", dest="dump_parsed", type="string",
+                      help="also write the alerts read into FILE for " + \
+                      "--from-parsed")
+    parser.add_option("--from-parsed",
+                      action="store_true", dest="from_parsed",
+                      help="replay the alerts of files written with " + \
+                      "--dump-parsed, given as input, instead of logs")
+    parser.add_option("--levels",
+                      action="store_true", dest="levels",
+                      help="write the events of the last day, hourly " + \
+                      "rollups per host for the last month and daily " + \
+                      "rollups for the last year into separate outputs " + \
+                      "named after the output file, in XML or JSON")
     parser.add_option("-a", "--append",
                       action="store_true", dest="append",
                       help="append to output file")
+    parser.add_option("-i", "--incremental",
+                      action="store_true", dest="incremental",
+                      help="continue from the checkpoint stored next to " + \
+                      "the output file, reading only new log data")
+    group = optparse.OptionGroup(parser, "Follow mode",
+                        "Follow a live Nagios log given as the only input, " + \
+                        "checkpointing as in incremental mode.")
+    group.add_option("-F", "--follow",
+                      action="store_true", dest="follow",
+                      help="follow the log as it grows, surviving rotation")
+    group.add_option("--latency", metavar="SECONDS",
+                      action="store", dest="latency", type="float",
+                      help="write events at most SECONDS after they " + \
+                      "close [default: %default]")
+    group.add_option("--batch", metavar="N",
+                      action="store", dest="batch", type="int",
+                      help="write events once N are pending " + \
+                      "[default: %default]")
+    group.add_option("--checkpoint-interval", metavar="SECONDS",
+                      action="store", dest="checkpoint_interval",
+                      type="float",
+                      help="save the checkpoint every SECONDS " + \
+                      "[default: %default]")
+    parser.add_option_group(group)
+    group = optparse.OptionGroup(parser, "Time window",
+                        "Output only the events overlapping a time window. " + \
+                        "Each input log is indexed into a file next to it " + \
+                        "on first use, so later runs seek to the window " + \
+                        "directly. TIME is YYYY-MM-DD [HH:MM[:SS]] in " + \
+                        "local time, or seconds since the epoch.")
+    group.add_option("--since", metavar="TIME",
+                      action="callback", dest="since", type="string",
+                      callback=parse_time,
+                      help="omit events which ended before TIME")
+    group.add_option("--until", metavar="TIME",
+                      action="callback", dest="until", type="string",
+                      callback=parse_time,
+                      help="omit events which started after TIME")
+    parser.add_option_group(group)
+    group = optparse.OptionGroup(parser, "Flapping",
+                        "Collapse the many short outages of flapping " + \
+                        "hosts and services before they are written.")
+    group.add_option("--merge-gap", metavar="SECONDS",
+                      action="store", dest="merge_gap", type="int",
+                      help="merge outages of the same host or service " + \
+                      "less than SECONDS apart")
+    group.add_option("--min-duration", metavar="SECONDS",
+                      action="store", dest="min_duration", type="int",
+                      help="omit outages shorter than SECONDS")
+    parser.add_option_group(group)
+    group = optparse.OptionGroup(parser, "Ongoing outages",
+                        "Bound the outages held open when recoveries " + \
+                        "go missing from the logs. The outages closed " + \
+                        "are marked truncated.")
+    group.add_option("--max-open", metavar="N",
+                      action="store", dest="max_open", type="int",
+                      help="close the oldest ongoing outages while over " + \
+                      "N are ongoing")
+    group.add_option("--max-age", metavar="SECONDS",
+                      action="store", dest="max_age", type="int",
+                      help="close ongoing outages SECONDS after their start")
+    parser.add_option_group(group)
+    group = optparse.OptionGroup(parser, "Analytics",
+                        "Analyse the outages written, after any " + \
+                        "flapping outages have been merged, into a " + \
+                        "report of their own.")
+    group.add_option("--analytics", metavar="FILE",
+                      action="store", dest="analytics", type="string",
+                      help="write the failures, downtime, MTTR and MTBF " + \
+                      "of each host and service and the periods of " + \
+                      "correlated failures into FILE as JSON")
+    group.add_option("--min-hosts", metavar="N",
+                      action="store", dest="min_hosts", type="int",
+                      help="report the periods when at least N hosts " + \
+                      "fail at once as correlated [default: %default]")
+    parser.add_option_group(group)
+    group = optparse.OptionGroup(parser, "Host and service filters",
+                        "PATTERN is a shell glob such as 'lc2-*', or a " + \
+                        "regular expression searched for in the name " + \
+                        "if prefixed with 're:'. Each option may be " + \
+                        "given several times. Names are matched as " + \
+                        "they appear in the log, or the database with " + \
+                        "--from-db. Service filters leave host events " + \
+                        "alone.")
+    group.add_option("--host", metavar="PATTERN",
+                      action="append", dest="host_names",
+                      help="output only the events of hosts matching " + \
+                      "PATTERN")
+    group.add_option("--exclude-host", metavar="PATTERN",
+                      action="append", dest="exclude_host_names",
+                      help="omit the events of hosts matching PATTERN")
+    group.add_option("--host-file", metavar="FILE",
+                      action="append", dest="host_files",
+                      help="as --host for each line of FILE, skipping " + \
+                      "empty lines and lines starting with #")
+    group.add_option("--service", metavar="PATTERN",
+                      action="append", dest="svc_descs",
+                      help="output only the services matching PATTERN")
+    group.add_option("--exclude-service", metavar="PATTERN",
+                      action="append", dest="exclude_svc_descs",
+                      help="omit the services matching PATTERN")
+    parser.add_option_group(group)
+    group = optparse.OptionGroup(parser, "Other kinds of lines",
+                        "Besides host and service alerts, read the lines " + \
+                        "below. Overlay events are marked with a " + \
+                        "classname of their kind for Timeline.")
+    group.add_option("--snapshots",
+                      action="store_true", dest="snapshots",
+                      help="seed outages already ongoing when a log " + \
+                      "starts from its CURRENT HOST and SERVICE STATE lines")
+    group.add_option("--downtime",
+                      action="store_true", dest="downtime",
+                      help="output scheduled downtime as overlay events")
+    group.add_option("--acks",
+                      action="store_true", dest="acks",
+                      help="output acknowledgements of problems as " + \
+                      "overlay events")
+    group.add_option("--notifications",
+                      action="store_true", dest="notifications",
+                      help="output notifications as overlay events")
+    parser.add_option_group(group)
+    group = optparse.OptionGroup(parser, "Nagios configuration",
+                        "Describe hosts and services with their aliases, " + \
+                        "notes, addresses, groups and contacts from the " + \
+                        "Nagios object configuration. The resolved " + \
+                        "configuration is cached in an index file, " + \
+                        "rebuilt when any of the files change.")
+    group.add_option("--configs", metavar="PATH",
+                      action="append", dest="configs",
+                      help="read object definitions from PATH, a " + \
+                      "nagios.cfg, object file or directory of *.cfg " + \
+                      "files; may be given several times")
+    group.add_option("--configs-index", metavar="FILE",
+                      action="store", dest="configs_index", type="string",
+                      help="cache the configuration in FILE " + \
+                      "[default: the first PATH with .index appended]")
+    parser.add_option_group(group)
+    group = optparse.OptionGroup(parser, "Instrumentation")
+    group.add_option("--stats",
+                      action="store_true", dest="stats",
+                      help="report lines, alerts, events and time spent " + \
+                      "per input file; implies -j 1")
+    group.add_option("--stats-json", metavar="FILE",
+                      action="store", dest="stats_json", type="string",
+                      help="also write the --stats report into FILE as JSON")
+    group.add_option("--profile", metavar="FILE",
+                      action="store", dest="profile", type="string",
+                      help="run under cProfile, writing its statistics " + \
+                      "into FILE")
+    parser.add_option_group(group)
+    group = optparse.OptionGroup(parser, "Serve mode",
+                        "Given serve as the first argument, serve the " + \
+                        "events of the logs that follow over HTTP " + \
+                        "instead of writing an output file, as " + \
+                        "/events.xml and /events.json. The last log is " + \
+                        "followed as it grows.")
+    group.add_option("--bind", metavar="ADDRESS",
+                      action="store", dest="bind", type="string",
+                      help="listen on ADDRESS [default: %default]")
+    group.add_option("--port", metavar="PORT",
+                      action="store", dest="port", type="int",
+                      help="listen on PORT [default: %default]")
+    group.add_option("--cache-size", metavar="N",
+                      action="store", dest="cache_size", type="int",
+                      help="cache the N most recently used responses " + \
+                      "[default: %default]")
+    parser.add_option_group(group)
+    parser.add_option("--source", metavar="[PREFIX=]PATH",
+                      action="append", dest="sources",
+                      help="merge the logs of PATH, a log file or " + \
+                      "directory of an other Nagios instance, by " + \
+                      "timestamp with the other inputs, prefixing its " + \
+                      "host names with PREFIX/; may be given several times")
+    parser.add_option("--batch-size", metavar="N",
+                      action="store", dest="batch_size", type="int",
+                      help="pass closed events to the writer N at a " + \
+                      "time [default: %default]")
+    parser.add_option("-j", "--jobs", metavar="N",
+                      action="store", dest="jobs", type="int",
+                      help="process input files in N parallel processes " + \
+                      "[default: %default]")
     parser.set_defaults(services=False, hosts=False, WARNING=False, DOWN=False,
                         UNREACHABLE=False, CRITICAL=False, UNKNOWN=False,
-                        verbose=False, format='XML', append=False)
+                        verbose=False, format='XML', append=False, jobs=1,
+                        incremental=False, follow=False, latency=5.0,
+                        batch=100, checkpoint_interval=60.0, chunk=None,
+                        since=None, until=None, batch_size=256,
+                        from_db=False, host_names=None, merge_gap=0,
+                        min_duration=0, levels=False, stats=False,
+                        stats_json=None, profile=None, sources=None,
+                        snapshots=False, downtime=False, acks=False,
+                        notifications=False, exclude_host_names=None,
+                        host_files=None, svc_descs=None,
+                        exclude_svc_descs=None, configs=None,
+                        configs_index=None, bind='127.0.0.1', port=8080,
+                        cache_size=64, analytics=None, min_hosts=2,
+                        max_open=0, max_age=0,
+                        dump_parsed=None, from_parsed=False)
     return parser
 
 
+class NameFilter(object):
+    """Matches host or service names against include and exclude patterns.
+
+    Patterns are shell globs, as in fnmatch, or regular expressions searched
+    for in the name if prefixed with "re:". A name is accepted if it matches
+    any of the includes, or there are none, and none of the excludes.
+
+    Each distinct name is matched only once, the result is cached. There are
+    as many names as there are hosts or services, so the cache is not
+    bounded. Patterns without wildcards, such as the thousands of names of
+    a --host-file, are looked up in sets of exact names before any pattern
+    is tried, instead of being compiled.
+
+    Raises ValueError for invalid regular expressions."""
+
+    def __init__(self, includes=(), excludes=()):
+        self.includes = tuple(includes)
+        self.excludes = tuple(excludes)
+        (self.include_names, self.include) = self.compile(self.includes)
+        (self.exclude_names, self.exclude) = self.compile(self.excludes)
+        self.cache = {}
+
+
+    def compile(self, patterns):
+        """Return the frozenset of the exact names among the patterns, and
+        the match methods of the others."""
+        names = []
+        matchers = []
+        for pattern in patterns:
+            if not pattern.startswith('re:') and \
+               not ('*' in pattern or '?' in pattern or '[' in pattern):
+                names.append(pattern)
+                continue
+            try:
+                if pattern.startswith('re:'):
+                    matchers.append(re.compile(pattern[3:]).search)
+                else:
+                    matchers.append(re.compile(
+                        fnmatch.translate(pattern)).match)
+            except re.error, e:
+                raise ValueError, "Invalid pattern %s: %s" % (pattern, e)
+        return (frozenset(names), matchers)
+
+
+    def accepts(self, name):
+        """Return True if name passes the filter."""
+        accepted = self.cache.get(name)
+        if accepted is None:
+            accepted = (not self.includes or name in self.include_names or
+                        any(match(name) for match in self.include)) and \
+                       not (name in self.exclude_names or
+                            any(match(name) for match in self.exclude))
+            self.cache[name] = accepted
+        return accepted
+
+
+    def signature(self):
+        """Return the patterns, for telling filters apart."""
+        return (self.includes, self.excludes)
+
+
+
+# The NameFilters returned by name_filters(), by the options they were made
+# from, so that the readers of a run build them only once
+NAME_FILTERS = {}
+
+def name_filters(options):
+    """Return the NameFilters of hosts and services given by options, each
+    None if no patterns were given for it. The filters are shared by all
+    callers giving the same options, and host files are read again only
+    once they have been modified.
+
+    Raises ValueError for invalid patterns and unreadable host files."""
+    host_files = []
+    for filename in options.host_files or []:
+        try:
+            host_files.append((filename, os.stat(filename).st_mtime))
+        except OSError, e:
+            raise ValueError, "Cannot read host file %s: %s" % \
+                  (filename, e.strerror)
+    key = tuple([tuple(getattr(options, name) or ()) for name in
+                 ('host_names', 'exclude_host_names', 'svc_descs',
+                  'exclude_svc_descs')] + [tuple(host_files)])
+    filters = NAME_FILTERS.get(key)
+    if filters is None:
+        filters = NAME_FILTERS[key] = read_name_filters(options)
+    return filters
+
+
+def read_name_filters(options):
+    """Build the NameFilters of name_filters()."""
+    host_names = list(options.host_names or [])
+    for filename in options.host_files or []:
+        try:
+            with open(filename) as f:
+                for line in f:
+                    line = line.strip()
+                    if line and not line.startswith('#'):
+                        host_names.append(line)
+        except IOError, e:
+            raise ValueError, "Cannot read host file %s: %s" % \
+                  (filename, e.strerror)
+    host_filter = service_filter = None
+    if host_names or options.exclude_host_names or options.host_files:
+        host_filter = NameFilter(host_names, options.exclude_host_names or ())
+    if options.svc_descs or options.exclude_svc_descs:
+        service_filter = NameFilter(options.svc_descs or (),
+                                    options.exclude_svc_descs or ())
+    return (host_filter, service_filter)
+
+
+
+class Event(object):
+    """A host or service outage recorded by NagiosLogReader.
+
+    Events are slotted objects, but also behave like the dictionaries of
+    earlier versions for TimelineWriter implementations: event['title'],
+    'plugin_end' in event, event.get(), event.iteritems(), dict(event) and
+    so forth. See NagiosLogReader.record_event() for the keys. Optional
+    attributes which are not set are None, and absent from the dictionary
+    view. The title is derived from the host and service names.
+
+    kind is None for outages. Overlay events, such as scheduled downtime,
+    have a kind from NagiosLogReader.OVERLAY_KINDS instead."""
+    __slots__ = ('timestamp_start', 'timestamp_end', 'host_name', 'svc_desc',
+                 'state', 'plugin_start', 'plugin_end', 'kind')
+    KEYS = ('timestamp_start', 'timestamp_end', 'host_name', 'svc_desc',
+            'state', 'title', 'plugin_start', 'plugin_end', 'kind')
+
+    def __init__(self, timestamp_start, host_name, state, svc_desc=None,
+                 plugin_start=None, kind=None):
+        self.timestamp_start = timestamp_start
+        self.timestamp_end = None
+        self.host_name = host_name
+        self.svc_desc = svc_desc or None
+        self.state = state
+        self.plugin_start = plugin_start or None
+        self.plugin_end = None
+        self.kind = kind
+
+
+    @property
+    def title(self):
+        """host_name [+ svc_desc] if available"""
+        if self.svc_desc:
+            return self.host_name + ' ' + self.svc_desc
+        return self.host_name
+
+
+    def __getitem__(self, key):
+        if key in self.KEYS:
+            value = getattr(self, key)
+            if value is not None:
+                return value
+        raise KeyError, key
+
+
+    def __setitem__(self, key, value):
+        if key not in self.__slots__:
+            raise KeyError, key
+        setattr(self, key, value)
+
+
+    def __contains__(self, key):
+        return key in self.KEYS and getattr(self, key) is not None
+
+
+    def get(self, key, default=None):
+        if key in self:
+            return getattr(self, key)
+        return default
+
+
+    def keys(self):
+        return [key for key in self.KEYS if getattr(self, key) is not None]
+
+
+    def iteritems(self):
+        for key in self.keys():
+            yield (key, getattr(self, key))
+
+
+    def items(self):
+        return list(self.iteritems())
+
+
+    def __iter__(self):
+        return iter(self.keys())
+
+
+    def __len__(self):
+        return len(self.keys())
+
+
+    def __repr__(self):
+        return 'Event(%r)' % dict(self)
+
+
+    def __getstate__(self):
+        return tuple([getattr(self, key) for key in self.__slots__])
+
+
+    def __setstate__(self, state):
+        # Events pickled by earlier versions have no kind.
+        self.kind = None
+        for (key, value) in zip(self.__slots__, state):
+            setattr(self, key, value)
+
+
+
+class AlertScanner(object):
+    """Finds the lines containing token in the blocks read from the file
+    object log. The other lines are skipped with string searches instead of
+    splitting them into Python strings.
+
+    Iterating over the scanner yields the matching lines of the block last
+    given to scan(). Line numbers are only needed for error messages, so
+    linenum() counts them by reading log again when it is called."""
+    COUNT_SIZE = 1 << 20
+
+    def __init__(self, token, log):
+        self.token = token
+        self.log = log
+        self.start = log.tell()     # offset at which scanning began
+        self.buffer = ''
+        self.offset = self.start    # offset of buffer in log
+        self.end = 0                # length of the lines scanned in buffer
+        self.position = 0           # offset of the line last yielded
+        self.counted = (self.start, 0)  # newlines counted up to an offset
+
+
+    def scan(self, buffer, end=None):
+        """Scan the lines in buffer[:end] next. The buffer must continue the
+        log right after the lines scanned before. Returns the scanner
+        itself for iteration."""
+        if end is None:
+            end = len(buffer)
+        self.offset += self.end
+        self.buffer = buffer
+        self.end = end
+        self.position = 0
+        return self
+
+
+    def blocks(self, size, stop=None, unterminated=True):
+        """Read the log size bytes at a time, up to byte offset stop if
+        given, and scan the whole lines of each block in turn. Yields the
+        scanner itself after each scan().
+
+        A last line without a newline is only scanned if unterminated is
+        true. Otherwise it is taken to be still being written, and left
+        for the next reader: stopped() is then the offset of its start."""
+        partial = ''
+        position = self.log.tell()
+        while True:
+            length = size
+            if stop is not None:
+                length = min(length, stop - position)
+                if length <= 0:
+                    break
+            data = self.log.read(length)
+            if not data:
+                break
+            position += len(data)
+            if partial:
+                data = partial + data
+            end = data.rfind('\n') + 1
+            partial = data[end:]
+            yield self.scan(data, end)
+        if partial and unterminated:
+            yield self.scan(partial)
+
+
+    def stopped(self):
+        """Return the offset in the log up to which lines were scanned."""
+        return self.offset + self.end
+
+
+    def __iter__(self):
+        buffer = self.buffer
+        find = buffer.find
+        rfind = buffer.rfind
+        token = self.token
+        end = self.end
+        position = 0
+        while True:
+            match = find(token, position, end)
+            if match == -1:
+                return
+            start = rfind('\n', position, match) + 1 or position
+            stop = find('\n', match, end) + 1 or end
+            self.position = start
+            yield buffer[start:stop]
+            position = stop
+
+
+    def linenum(self):
+        """Return the line number of the line last yielded, counting from
+        the line at which scanning began."""
+        target = self.offset + self.position
+        (offset, newlines) = self.counted
+        if target < offset:
+            (offset, newlines) = (self.start, 0)
+        resume = self.log.tell()
+        self.log.seek(offset)
+        while offset < target:
+            data = self.log.read(min(self.COUNT_SIZE, target - offset))
+            if not data:
+                break
+            newlines += data.count('\n')
+            offset += len(data)
+        self.log.seek(resume)
+        self.counted = (offset, newlines)
+        return newlines + 1
+
+
+
 class NagiosLogReader(object):
     """NagiosLogReader encapsulates Nagios events and calls a TimelineWriter
     for output.
@@ -81,6 +769,11 @@ class NagiosLogReader(object):
     # The following error states are possible for hosts and services
     HOST_NONOK_STATES = [ 'DOWN', 'UNREACHABLE' ]
     SVC_NONOK_STATES = [ 'WARNING', 'CRITICAL', 'UNKNOWN' ]
+    NONOK_STATES = frozenset(HOST_NONOK_STATES + SVC_NONOK_STATES)
+    # States which close an event: recoveries, and the ends of downtime
+    RECOVERY_STATES = frozenset(['OK', 'UP', 'STOPPED', 'CANCELLED'])
+    # Kinds of the overlay events recorded besides outages
+    OVERLAY_KINDS = ('downtime', 'acknowledgement', 'notification')
 
     # These two regexps match service and host alerts, respectively
     #
@@ -91,13 +784,13 @@ class NagiosLogReader(object):
     #
     # [1256805642] HOST ALERT: svm-5.cs.helsinki.fi;DOWN; \
     # SOFT;2;CRITICAL - Host Unreachable (128.214.11.45)
-    RE_HOST = re.compile(r'\[(\d+)\] HOST ALERT: ([^;]+)(;)([^;]+);' + \
-                         r'[^;]+;[^;]+;(.+)')
+    RE_HOST = LazyPattern(r'\[(\d+)\] HOST ALERT: ([^;]+)(;)([^;]+);' + \
+                          r'[^;]+;[^;]+;(.+)')
 
     # [1256805672] SERVICE ALERT: svm-5.cs.helsinki.fi;SSH; \
     # CRITICAL;HARD;1;No route to host
-    RE_SVC = re.compile(r'\[(\d+)\] SERVICE ALERT: ([^;]+);([^;]+);' + \
-                        r'([^;]+);[^;]+;[^;]+;(.+)')
+    RE_SVC = LazyPattern(r'\[(\d+)\] SERVICE ALERT: ([^;]+);([^;]+);' + \
+                         r'([^;]+);[^;]+;[^;]+;(.+)')
 
     # At which positions are the interesting values?
     # I could use group renaming, but it would make the regexp even uglier...
@@ -106,7 +799,41 @@ class NagiosLogReader(object):
     RE_INDEX_SVC = 3
     RE_INDEX_STATE = 4
     RE_INDEX_PLUG = 5
-    
+
+    # Every host and service alert line contains this token. process() uses
+    # it to reject all other lines before doing any parsing.
+    ALERT_TOKEN = ' ALERT: '
+    # Lines of the other kinds all contain this token instead, see token().
+    LINE_TOKEN = ': '
+
+    # The kinds of lines split by split_line(), keyed by the text between
+    # the timestamp and the colon, as (kind, number of fields, service?).
+    # feed() passes alerts on to record_event() and the other kinds to the
+    # methods of handlers(), so each line is only split once whatever its
+    # kind.
+    #
+    # [1256767200] CURRENT SERVICE STATE: svm-5.cs.helsinki.fi;SSH; \
+    # CRITICAL;HARD;3;No route to host
+    # [1256808482] HOST DOWNTIME ALERT: svm-5.cs.helsinki.fi;STARTED; \
+    # Host has entered a period of scheduled downtime
+    # [1256769432] SERVICE NOTIFICATION: pervila;lc2-6.cs.helsinki.fi;SSH; \
+    # ACKNOWLEDGEMENT (CRITICAL);notify-service-by-email;Socket timeout; \
+    # pervila;Rebooting
+    LINE_KINDS = {'HOST ALERT' : ('alert', 5, False),
+                  'SERVICE ALERT' : ('alert', 6, True),
+                  'CURRENT HOST STATE' : ('snapshot', 5, False),
+                  'CURRENT SERVICE STATE' : ('snapshot', 6, True),
+                  'HOST DOWNTIME ALERT' : ('downtime', 3, False),
+                  'SERVICE DOWNTIME ALERT' : ('downtime', 4, True),
+                  'HOST NOTIFICATION' : ('notification', 5, False),
+                  'SERVICE NOTIFICATION' : ('notification', 6, True)}
+    # Bytes of the log searched by scan() at a time
+    READ_SIZE = 1 << 20
+    # plugin_end of the ongoing events closed by evict_ongoing()
+    TRUNCATED = "Truncated: %s"
+    # Stale entries tolerated in the heap of evict_ongoing()
+    STALE_OPENED = 1024
+
     def __init__(self, TimelineWriter, options):
         """Use TimelineWriter for output, set defaults, then configs given.
 
@@ -114,14 +841,35 @@ class NagiosLogReader(object):
 
         Raises ValueError if any of the set_config():s does so."""
         self.writer = TimelineWriter
-        if isinstance(options, Values):
+        if isinstance(options, optparse.Values):
             self.options = options
         else:
             raise ValueError, "options must be an instance of optparse.Values"
         self.events_seen = 0    # how many events we have processed
+        self.events_output = 0  # how many events we have output
         self.last_timestamp = 0 # most recent event seen
         # Record all objects in non-ok states in this dictionary.
         self.ongoing_events = {}
+        # Limits of the ongoing events, 0 for none, see evict_ongoing()
+        self.max_open = options.max_open
+        self.max_age = options.max_age
+        # Heap of (timestamp_start, sequence, identifier, event) of the
+        # ongoing events while limited, oldest first
+        self.opened = []
+        self.sequence = 0
+        self.truncated = 0      # how many ongoing events we have evicted
+        # (since, until) of process_window(), None for all events
+        self.window = None
+        # Closed events not yet passed to the writer, see emit()
+        self.pending = []
+        # RunStats collecting counters, see RunStats.instrument()
+        self.stats = None
+        # The last notification recorded, see record_notification()
+        self.last_notification = None
+        # NameFilters of the names to record, None for all
+        (self.host_filter, self.service_filter) = name_filters(options)
+        # ParsedDump collecting the alerts read, see feed()
+        self.dump = None
                 
 
     def get_config(self, setting):
@@ -147,11 +895,34 @@ class NagiosLogReader(object):
         return value
 
 
+    def accepts(self, host_name, svc_desc=None):
+        """Return True unless the host or service is filtered out by the
+        host and service patterns of the options."""
+        if self.host_filter is not None and \
+           not self.host_filter.accepts(host_name):
+            return False
+        if svc_desc and self.service_filter is not None and \
+           not self.service_filter.accepts(svc_desc):
+            return False
+        return True
+
+
+    def identifier(self, host_name, svc_desc=None, kind=None):
+        """Return the key of host_name [+ svc_desc] in ongoing_events, the
+        tuple (host_name, svc_desc) with svc_desc None for hosts. The key
+        of an overlay event ends with its kind."""
+        if kind is not None:
+            return (host_name, svc_desc or None, kind)
+        return (host_name, svc_desc or None)
+
+
     def record_event(self, timestamp, host_name, state, svc_desc="",
-                     plugin_output=""):
+                     plugin_output="", kind=None):
         """Record host or service event, output if the state was a recovery.
 
-        Services are recognised by a nonempty svc_desc parameter.
+        Services are recognised by a nonempty svc_desc parameter. Overlay
+        events are recorded with their kind, and opened by any state other
+        than those of RECOVERY_STATES.
 
         Raises ValueError if the parameters given are invalid.
         Raises Warnings if the event ordering seems broken.
@@ -165,47 +936,129 @@ class NagiosLogReader(object):
             timestamp_end : when malfunction ceased
             svc_desc : description of service, if relevant
             plugin_start : output of plugin at start
-            plugin_end: output of plugin at end"""
-        identifier = host_name
+            plugin_end: output of plugin at end
+            kind : kind of an overlay event"""
+        identifier = (host_name, svc_desc or None)
+        if kind is not None:
+            identifier += (kind,)
         timestamp = int(timestamp)
         if self.last_timestamp < timestamp:
             self.last_timestamp = timestamp
-        if svc_desc:
-              identifier = identifier + ' ' + svc_desc
-        if (state == "OK" or state == "UP"):
+        if state in self.RECOVERY_STATES:
             # Look for a match from our tab of ongoing events. If found,
             # let our TimelineWriter output the event and remove the entry
             # from our tab.
-            if identifier in self.ongoing_events:
-                event = self.ongoing_events[identifier] # just a shortcut
-                event['timestamp_end'] = timestamp
-                if plugin_output:
-                    event['plugin_end'] = plugin_output
-                self.writer.output(event)
-                del self.ongoing_events[identifier]
-            else:
+            event = self.ongoing_events.pop(identifier, None)
+            if event is None:
                 raise Warning, "Recovery for previously unseen event."
-        elif state in self.HOST_NONOK_STATES + self.SVC_NONOK_STATES:
+            event.timestamp_end = timestamp
+            if plugin_output:
+                event.plugin_end = plugin_output
+            self.emit(event)
+        elif state in self.NONOK_STATES or kind is not None:
             # This object has entered a nonworking state: create a new record
-            # and add it to our tab of ongoing_events.
+            # and add it to our tab of ongoing_events. The names are interned,
+            # so that all events of an object share them.
             if identifier not in self.ongoing_events:
-                event = {
-                    'timestamp_start' : timestamp,
-                    'host_name' : host_name,
-                    'state' : state,
-                    'title' : identifier
-                    }
+                host_name = intern(host_name)
                 if svc_desc:
-                    event['svc_desc'] = svc_desc
-                if plugin_output:
-                    event['plugin_start'] = plugin_output
+                    svc_desc = intern(svc_desc)
+                identifier = self.identifier(host_name, svc_desc, kind)
+                event = Event(timestamp, host_name, intern(state), svc_desc,
+                              plugin_output, kind)
                 self.ongoing_events[identifier] = event
+                if self.max_open or self.max_age:
+                    self.track(identifier, event)
         else:
             raise ValueError, "Unknown host state %s" % state
+        if self.opened:
+            self.evict_ongoing()
         # Record successful.
         return True
 
 
+    def track(self, identifier, event):
+        """Add the ongoing event of identifier to the heap of
+        evict_ongoing()."""
+        heapq.heappush(self.opened, (int(event.timestamp_start),
+                                     self.sequence, identifier, event))
+        self.sequence += 1
+
+
+    def evict_ongoing(self):
+        """Close the oldest ongoing events while they started more than
+        max_age seconds before last_timestamp, or more than max_open events
+        are ongoing. Their plugin_end is marked TRUNCATED.
+
+        Objects whose recovery is never logged, such as hosts removed from
+        the configuration, would otherwise stay ongoing until
+        flush_events(). An event older than max_age ends max_age seconds
+        after its start, one evicted for max_open at last_timestamp. Events
+        are evicted after each line is recorded, so the recovery which
+        advances last_timestamp still closes its own event. A later
+        recovery of an evicted event is an unseen one.
+
+        The heap of track() keeps the events in the order they started, so
+        each eviction takes O(log n) time. Entries of events closed since
+        are skipped when they come up, and dropped all at once when they
+        may outnumber the ongoing events, give or take STALE_OPENED."""
+        opened = self.opened
+        ongoing = self.ongoing_events
+        while opened:
+            (start, sequence, identifier, event) = opened[0]
+            if ongoing.get(identifier) is not event:
+                heapq.heappop(opened)
+                continue
+            if self.max_age and \
+               self.last_timestamp - start > self.max_age:
+                event.timestamp_end = start + self.max_age
+                reason = "no recovery within %d seconds" % self.max_age
+            elif self.max_open and len(ongoing) > self.max_open:
+                event.timestamp_end = self.last_timestamp
+                reason = "over %d events ongoing" % self.max_open
+            else:
+                break
+            heapq.heappop(opened)
+            del ongoing[identifier]
+            event.plugin_end = self.TRUNCATED % reason
+            self.truncated += 1
+            if self.stats is not None:
+                self.stats.truncated += 1
+            self.emit(event)
+        if len(opened) > 2 * len(ongoing) + self.STALE_OPENED:
+            self.opened = [entry for entry in opened
+                           if ongoing.get(entry[2]) is entry[3]]
+            heapq.heapify(self.opened)
+
+
+    def emit(self, event):
+        """Pass a closed event to the TimelineWriter for output, unless it
+        falls outside the window of process_window().
+
+        Events are passed on batch_size at a time through the writer's
+        output_many(). See flush_pending() for passing the rest."""
+        if self.window is not None:
+            (since, until) = self.window
+            if (since is not None and event['timestamp_end'] < since) or \
+               (until is not None and event['timestamp_start'] > until):
+                return
+        self.events_output += 1
+        self.pending.append(event)
+        if len(self.pending) >= self.options.batch_size:
+            self.flush_pending()
+
+
+    def flush_pending(self):
+        """Pass the events held back by emit() to the TimelineWriter.
+
+        Called at the end of each process() and before the writer is asked
+        for its offset, synced or flushed."""
+        if self.pending:
+            pending = self.pending
+            self.pending = []
+            self.writer.output_many(pending)
+
+
     def set_ongoing_events(self, events):
         """Populate our ongoing events from the list of events given.
 
@@ -218,63 +1071,474 @@ class NagiosLogReader(object):
             try:
                 self.record_event(event['timestamp'], event['host_name'],
                                   event['state'], event.get('svc_desc'),
-                                  event.get('plugin_output'))
+                                  event.get('plugin_output'),
+                                  event.get('kind'))
             except KeyError:
                 raise ValueError, \
                     "Malformed event in list of events given as parameter."
             
 
-    def process(self, filename):
-        """Search through filename for host and/or service events.
+    def enabled_states(self):
+        """Return the set of states which are to be recorded.
+
+        OK and UP states are always recorded, the NON-OK states only if we
+        were NOT configured to omit that state."""
+        states = ['OK', 'UP']
+        for state in self.HOST_NONOK_STATES + self.SVC_NONOK_STATES:
+            if not self.get_config(state):
+                states.append(state)
+        return frozenset(states)
+
+
+    def signature(self):
+        """Return what the events recorded depend on besides the logs: the
+        states, kinds of lines and names recorded. See LogIndex."""
+        return (sorted(self.enabled_states()), self.options.hosts,
+                self.options.services, sorted(self.handlers()),
+                self.options.acks, self.options.notifications,
+                [name_filter and name_filter.signature() for name_filter in
+                 (self.host_filter, self.service_filter)])
+
+
+    def split_line(self, line):
+        """Split a line of one of the LINE_KINDS into its fields.
+
+        Returns a tuple (kind, service, timestamp, fields) with the fields
+        split on semicolons, the last one running to the end of the line,
+        and service True for the kinds of service lines. Returns None for
+        other lines, and for lines with any of the fields empty."""
+        if not line.startswith('['):
+            return None
+        close = line.find('] ', 1)
+        colon = line.find(': ', close)
+        if close == -1 or colon == -1:
+            return None
+        spec = self.LINE_KINDS.get(line[close + 2:colon])
+        if spec is None:
+            return None
+        (kind, count, service) = spec
+        fields = line[colon + 2:].split(';', count - 1)
+        if len(fields) != count:
+            return None
+        # Like the '.' of the regexps, stop at the end of the line.
+        if fields[-1].endswith('\n'):
+            fields[-1] = fields[-1][:-1]
+        timestamp = line[1:close]
+        if not timestamp.isdigit() or '' in fields:
+            return None
+        return (kind, service, timestamp, fields)
+
+
+    def tokenize(self, line):
+        """Split a host or service alert line into its fields.
+
+        Returns a tuple (timestamp, host_name, svc_desc, state, plugin_output)
+        with svc_desc set to None for host alerts, or None if the line is not
+        an alert. The result is the same as matching RE_HOST and RE_SVC, but
+        the line is split on semicolons instead of backtracking."""
+        tokens = self.split_line(line)
+        if tokens is None or tokens[0] != 'alert':
+            return None
+        (kind, service, timestamp, fields) = tokens
+        if service:
+            (host_name, svc_desc, state) = fields[:3]
+        else:
+            (host_name, state) = fields[:2]
+            svc_desc = None
+        return (timestamp, host_name, svc_desc, state, fields[-1])
+
+
+    def handlers(self):
+        """Return the methods recording the kinds of lines other than alerts
+        which the options enable, keyed by kind. Each is called with the
+        service flag, timestamp and fields of split_line(), and the set of
+        states recorded."""
+        handlers = {}
+        if self.options.snapshots:
+            handlers['snapshot'] = self.record_snapshot
+        if self.options.downtime:
+            handlers['downtime'] = self.record_downtime
+        if self.options.acks or self.options.notifications:
+            handlers['notification'] = self.record_notification
+        return handlers
+
+
+    def token(self):
+        """Return the token contained in every line to be split."""
+        if self.handlers():
+            return self.LINE_TOKEN
+        return self.ALERT_TOKEN
+
+
+    def record_snapshot(self, service, timestamp, fields, states):
+        """Seed an outage from a CURRENT HOST or SERVICE STATE line, logged
+        for each object when the log is rotated. Objects which are not
+        ongoing yet are recorded as failing since the snapshot. Working
+        states are ignored, their recoveries are alerts of their own."""
+        if service:
+            (host_name, svc_desc, state) = fields[:3]
+            if self.options.hosts:
+                return
+        else:
+            (host_name, state) = fields[:2]
+            svc_desc = None
+            if self.options.services:
+                return
+        if state in self.NONOK_STATES and state in states and \
+           self.accepts(host_name, svc_desc):
+            self.record_event(timestamp, host_name, state, svc_desc,
+                              fields[-1])
+
+
+    def record_downtime(self, service, timestamp, fields, states):
+        """Record a period of scheduled downtime, opened by STARTED and
+        closed by STOPPED or CANCELLED."""
+        if service:
+            (host_name, svc_desc, state) = fields[:3]
+        else:
+            (host_name, state) = fields[:2]
+            svc_desc = None
+        if not self.accepts(host_name, svc_desc):
+            return
+        if state == 'STARTED':
+            state = 'DOWNTIME'
+        self.record_event(timestamp, host_name, state, svc_desc,
+                          fields[-1].strip(), 'downtime')
+
+
+    def record_notification(self, service, timestamp, fields, states):
+        """Record a notification, or an acknowledgement of a problem, as an
+        instant overlay event. Nagios notifies each contact separately, so
+        repeats of the previous notification to other contacts are
+        skipped."""
+        if service:
+            (contact, host_name, svc_desc, state, command, text) = fields
+        else:
+            (contact, host_name, state, command, text) = fields
+            svc_desc = None
+        if not self.accepts(host_name, svc_desc):
+            return
+        if state.startswith('ACKNOWLEDGEMENT ('):
+            if not self.options.acks:
+                return
+            kind = 'acknowledgement'
+            state = state[len('ACKNOWLEDGEMENT ('):-1]
+            # The author and comment follow the plugin output.
+            parts = text.split(';')
+            if len(parts) >= 3:
+                text = '%s: %s' % (parts[-2], parts[-1])
+        else:
+            if not self.options.notifications:
+                return
+            kind = 'notification'
+            text = '%s: %s' % (contact, text)
+        key = (kind, host_name, svc_desc, timestamp, state)
+        if key == self.last_notification:
+            return
+        self.last_notification = key
+        timestamp = int(timestamp)
+        if self.last_timestamp < timestamp:
+            self.last_timestamp = timestamp
+        event = Event(timestamp, intern(host_name), intern(state),
+                      svc_desc and intern(svc_desc), text, kind)
+        event.timestamp_end = timestamp
+        self.emit(event)
+
+
+    def process(self, filename, offset=0, stop=None):
+        """Search through filename for host and/or service events, starting
+        at byte offset and stopping at byte offset stop, if given. Returns
+        the offset at which reading stopped.
 
         Each event given an unique integer identifier. Objects which have
         switched to a non-working state are recorded as ongoing events.
         Whenever an object returns to a working state, it is removed
-        from ongoing and passed to the TimelineWriter object for output."""
-        with open(filename) as f:
-            linenum = 0
-            for line in f:
-                linenum += 1
-                match = None
-                # If we are not set to omit services, try to match line
-                if not self.options.services:
-                    match = self.RE_HOST.match(line)
-                # No match and we are not set to omit services? Try again:
-                if not (match or self.options.hosts):
-                    match = self.RE_SVC.match(line)
-                if match:
-                    # We are set to process the state if it matches one of the
-                    # NON-OK states and we were NOT configured to omit that
-                    # state. (OK and UP states are always recorded)
-                    state = match.group(self.RE_INDEX_STATE)
-                    if (state == 'OK' or state == 'UP') or \
-                       ((state in \
-                         self.HOST_NONOK_STATES + self.SVC_NONOK_STATES) and \
-                        not self.get_config(state)):
-                        # found a matching event!
-                        self.events_seen += 1
-                        # If this was actually a host, cleanse the placeholder.
-                        svc = match.group(self.RE_INDEX_SVC)
-                        if svc == ';':
-                            svc = None
-                        try:
-                            self.record_event(
-                                match.group(self.RE_INDEX_TIME),
-                                match.group(self.RE_INDEX_HOST),
-                                state,
-                                svc,
-                                match.group(self.RE_INDEX_PLUG))
-                        except Warning:
-                            if self.options.verbose:
-                                sys.stderr.write(
+        from ongoing and passed to the TimelineWriter object for output.
+
+        Archives compressed with gzip, bzip2 or xz are decompressed on the
+        fly, and offset refers to the uncompressed log. Other files are
+        memory-mapped. See scan() for the reading itself."""
+        log = open_archive(filename)
+        if log is None:
+            with open(filename, 'rb') as f:
+                if os.fstat(f.fileno()).st_size <= offset:
+                    # Nothing new, and empty files cannot be mapped.
+                    return offset
+                log = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if offset:
+                log.seek(offset)
+            end = self.scan(log, filename, stop)
+            self.flush_pending()
+            return end
+        finally:
+            log.close()
+
+
+    def scan(self, log, filename, stop=None):
+        """Feed the alert lines of the file object log into feed(), up to
+        byte offset stop if given. Returns the offset at which scanning
+        stopped: in incremental mode, a last line without a newline is
+        left for the next run, as the log may still be being written.
+
+        log is read READ_SIZE bytes at a time. Each block is searched for
+        alert lines by an AlertScanner, so that the other lines are never
+        split into strings of their own. Searching a block is much faster
+        than searching an mmap in place, which has no fast substring
+        search."""
+        scanner = AlertScanner(self.token(), log)
+        for lines in scanner.blocks(self.READ_SIZE, stop,
+                                    not self.options.incremental):
+            self.feed(lines, filename)
+        return scanner.stopped()
+
+
+    def feed(self, lines, filename):
+        """Search through the lines of filename given for host and/or service
+        events.
+
+        Lines which cannot be split are rejected with a substring test, the
+        rest are split by split_line() and dispatched by their kind. The
+        configuration is resolved once per call instead of once per line.
+        Lines may also be given as an AlertScanner, which can count the
+        lines it skipped."""
+        # If we are not set to omit hosts or services, record them.
+        hosts = not self.options.services
+        services = not self.options.hosts
+        states = self.enabled_states()
+        handlers = self.handlers()
+        token = self.token()
+        split_line = self.split_line
+        filtered = self.host_filter is not None or \
+                   self.service_filter is not None
+        stats = self.stats
+        dump = self.dump
+        linenum = 0
+        for line in lines:
+            linenum += 1
+            if token not in line:
+                continue
+            tokens = split_line(line)
+            if tokens is None:
+                continue
+            (kind, service, timestamp, fields) = tokens
+            if kind != 'alert':
+                handler = handlers.get(kind)
+                if handler is None:
+                    continue
+                try:
+                    handler(service, timestamp, fields, states)
+                except Warning:
+                    self.unseen_recovery(filename, line)
+                except ValueError:
+                    self.malformed(lines, linenum, filename)
+                continue
+            if service:
+                (host_name, svc, state) = fields[:3]
+            else:
+                (host_name, state) = fields[:2]
+                svc = None
+            plugin_output = fields[-1]
+            if dump is not None:
+                dump.add(timestamp, host_name, svc, state, plugin_output)
+            if stats is not None:
+                stats.alert(svc)
+            if not (services if svc else hosts) or state not in states:
+                continue
+            if filtered and not self.accepts(host_name, svc):
+                continue
+            # found a matching event!
+            self.events_seen += 1
+            try:
+                self.record_event(timestamp, host_name, state, svc,
+                                  plugin_output)
+            except Warning:
+                if stats is not None:
+                    stats.unmatched += 1
+                self.unseen_recovery(filename, line)
+            except ValueError:
+                self.malformed(lines, linenum, filename)
+        if stats is not None:
+            stats.read(lines, linenum)
+
+
+    def replay(self, alerts):
+        """Record the alerts of a ParsedAlerts like process() would the log
+        they were read from, reading none of the log itself.
+
+        Only the alerts recorded with our options are selected, so that
+        the dump of a whole log can be filtered again. The window of the
+        since and until options is applied by emit() as in
+        process_window(), but the whole dump is replayed, so outages
+        ongoing at until end when they actually do."""
+        since = self.options.since
+        until = self.options.until
+        if since is not None or until is not None:
+            self.window = (since, until)
+        stats = self.stats
+        start = time.time()
+        for (timestamp, host_name, svc_desc, state, plugin_output) in \
+                alerts.select(self):
+            self.events_seen += 1
+            try:
+                self.record_event(timestamp, host_name, state, svc_desc,
+                                  plugin_output)
+            except Warning:
+                if stats is not None:
+                    stats.unmatched += 1
+                self.unseen_recovery(alerts.filename, "[%d] %s;%s;%s\n" % (
+                    timestamp, host_name, svc_desc or '', state))
+        self.flush_pending()
+        if stats is not None:
+            stats.finish(alerts.filename, time.time() - start)
+
+
+    def malformed(self, lines, linenum, filename):
+        """Called by feed() for lines rejected by record_event()."""
+        if isinstance(lines, AlertScanner):
+            linenum = lines.linenum()
+        sys.stderr.write(
+"Error: Malformed line %d of file %s (bypassing)\n" % (linenum, filename))
+
+
+    def unseen_recovery(self, filename, line):
+        """Called by process() for recoveries of previously unseen events."""
+        if self.options.verbose:
+            sys.stderr.write(
 "Warning: recovery for previously unseen event. In file %s:\n    %s" % \
 (filename, line))
-                        except ValueError:
-                            sys.stderr.write(
-"Error: Malformed line %d of file %s (bypassing)\n" % (linenum, filename))
 
 
-    def flush_events(self):
+    def process_many(self, filenames, workers=None, offsets=None):
+        """Process each of filenames in a pool of worker processes.
+
+        The files are parsed independently into LogSummary objects, which are
+        merged in the order given. The events passed to the TimelineWriter and
+        the ongoing events left over are identical to calling process() for
+        each file in turn. workers defaults to the number of CPUs.
+
+        offsets may list the byte offset to start each file from. Returns the
+        list of offsets at which reading stopped.
+
+        The limits of evict_ongoing() depend on the events ongoing across
+        files, which the workers cannot know, so with --max-open or
+        --max-age the files are processed in turn instead."""
+        if offsets is None:
+            offsets = [0] * len(filenames)
+        if self.max_open or self.max_age:
+            return [self.process(filename, offset)
+                    for (filename, offset) in zip(filenames, offsets)]
+        pool = multiprocessing.Pool(workers)
+        ends = []
+        try:
+            jobs = [(filename, self.options, offset)
+                    for (filename, offset) in zip(filenames, offsets)]
+            for summary in pool.imap(summarize, jobs):
+                self.merge_summary(summary)
+                self.flush_pending()
+                ends.append(summary.offset)
+        finally:
+            pool.close()
+            pool.join()
+        return ends
+
+
+    def merge_summary(self, summary):
+        """Continue from our ongoing events as if the file of the LogSummary
+        given had been processed by process().
+
+        An event still ongoing before the file takes precedence over the
+        events found in the file itself: its first recovery in the file closes
+        our event instead, and failures before that recovery are ignored."""
+        self.events_seen += summary.events_seen
+        if self.last_timestamp < summary.last_timestamp:
+            self.last_timestamp = summary.last_timestamp
+        for (identifier, event, timestamp, plugin_output, first, line) in \
+                summary.closings:
+            if first and identifier in self.ongoing_events:
+                ongoing = self.ongoing_events.pop(identifier)
+                ongoing['timestamp_end'] = timestamp
+                if plugin_output:
+                    ongoing['plugin_end'] = plugin_output
+                self.emit(ongoing)
+            elif event is not None:
+                self.emit(event)
+            else:
+                self.unseen_recovery(summary.filename, line)
+        for (identifier, event) in summary.ongoing_events.iteritems():
+            if identifier not in self.ongoing_events:
+                self.ongoing_events[identifier] = event
+
+
+    def carry_in(self, point):
+        """Continue from our ongoing events as if the file of the LogIndex
+        point given had been processed by process() up to the point.
+
+        As in merge_summary(), an event still ongoing before the file is
+        closed by the first recovery of its identifier in the file, and
+        takes precedence over the events found in the file itself. Events
+        closed before the point are dropped without output."""
+        (timestamp, offset, ongoing_events, recovered) = point
+        for identifier in recovered:
+            self.ongoing_events.pop(identifier, None)
+        self.set_ongoing_events(ongoing_events)
+        if self.last_timestamp < timestamp:
+            self.last_timestamp = timestamp
+
+
+    def process_window(self, filenames):
+        """Process the parts of filenames which overlap the window given by
+        the since and until options, outputting only the events which do.
+
+        Each file is indexed by a LogIndex. Reading starts from the last
+        index point before since, carrying in the state of the earlier
+        files and of the file up to the point, so that events ongoing at
+        the start of the window are output with their actual start. Reading
+        stops at the first index point after until. Events still ongoing
+        there are left ongoing, like those at the end of the logs."""
+        since = self.options.since
+        until = self.options.until
+        self.window = (since, until)
+        for filename in filenames:
+            index = LogIndex(filename, self.options)
+            index.update()
+            point = index.start(since)
+            offset = 0
+            if point is not None:
+                self.carry_in(point)
+                offset = point[1]
+            stop = index.stop(until)
+            if stop is not None and stop <= offset:
+                break
+            self.process(filename, offset, stop)
+            if stop is not None:
+                break
+
+
+    def process_sources(self, sources):
+        """Process the LogSources given as one log, merging their alert
+        lines in timestamp order with merge_sources().
+
+        Only a line of each source is held at a time besides the blocks
+        being read, so memory does not grow with the size of the logs."""
+        filename = ' + '.join([source.path for source in sources])
+        for source in sources:
+            source.token = self.token()
+        self.feed(merge_sources(sources), filename)
+        self.flush_pending()
+
+
+    def save_state(self, checkpoint):
+        """Record our ongoing events, last_timestamp and the current output
+        offset of the TimelineWriter into checkpoint."""
+        self.flush_pending()
+        checkpoint.ongoing_events = [dict(event) for event in
+                                     self.ongoing_events.itervalues()]
+        checkpoint.last_timestamp = self.last_timestamp
+        checkpoint.output_offset = self.writer.tell()
+
+
+    def flush_events(self, checkpoint=None):
         """Flush any remaining ongoing events to the TimelineWriter.
 
         Note that the events may lack an ending timestamp, if no such
@@ -284,16 +1548,207 @@ class NagiosLogReader(object):
 
         TimelineWriter should record the last seen timestamp when closing its
         output file. When appending, TimelineWriter should look for events with
-        timestamp + 1 and return them as still ongoing."""
+        timestamp + 1 and return them as still ongoing.
+
+        If a Checkpoint is given, the ongoing events, last_timestamp and the
+        output offset of the flushed events are recorded into it first. An
+        incremental run drops the flushed events from the output and
+        continues the ongoing events instead."""
+        if checkpoint is not None:
+            self.save_state(checkpoint)
         for event in self.ongoing_events.itervalues():
             event['timestamp_end'] = self.last_timestamp + 1
-            self.writer.output(event)
+            self.emit(event)
+        self.flush_pending()
         self.writer.flush_file(self.last_timestamp)
         # Garbage collect and reset
         self.ongoing_events = {}
 
 
 
+class RunStats(object):
+    """Counters and timers of a run, per input file, for --stats.
+
+    instrument() hooks a NagiosLogReader and its TimelineWriter, after which
+    each call to process() is recorded as a file with
+        lines : lines read
+        host_alerts, service_alerts : lines tokenized as host or service
+            alerts, whether their state is recorded or not
+        events : events passed on to the writer
+        unmatched : recoveries of events not seen ongoing
+        truncated : ongoing events evicted by
+            NagiosLogReader.evict_ongoing()
+        peak_ongoing : largest number of ongoing events
+        seconds : wall-clock time taken by process()
+        record : time in record_event(), except for writing
+        formatting : time formatting times and descriptions for the writer
+        writing : time in the writer, except for formatting
+        parsing : the rest of seconds
+    The final flush is recorded as a file named "(flush)", and the lines fed
+    outside process(), by a LogFollower or process_sources(), as "(stream)".
+    The timing of each call adds some overhead of its own."""
+    FIELDS = ('lines', 'host_alerts', 'service_alerts', 'events',
+              'unmatched', 'truncated', 'peak_ongoing', 'seconds', 'parsing',
+              'record', 'formatting', 'writing')
+
+    def __init__(self):
+        self.files = []         # (filename, fields) of each file processed
+        self.reset()
+
+
+    def reset(self):
+        """Zero the counters for the next file."""
+        for field in self.FIELDS:
+            setattr(self, field, 0)
+        self.started = time.time()
+
+
+    def instrument(self, reader):
+        """Wrap the methods of reader and its writer to be timed.
+
+        The wrappers are set as instance attributes, so the classes are
+        unaffected."""
+        reader.stats = self
+        writer = reader.writer
+        # Formatting is done by the writer at the end of a filter chain.
+        formatter = writer
+        while isinstance(formatter, TimelineFilter):
+            formatter = formatter.inner
+        record_event = reader.record_event
+        output_many = writer.output_many
+        process = reader.process
+        flush_events = reader.flush_events
+
+        def timed_record_event(*args):
+            writing = self.writing + self.formatting
+            start = time.time()
+            try:
+                return record_event(*args)
+            finally:
+                self.record += time.time() - start - \
+                               (self.writing + self.formatting - writing)
+                if self.peak_ongoing < len(reader.ongoing_events):
+                    self.peak_ongoing = len(reader.ongoing_events)
+
+        def timed_output_many(events):
+            formatting = self.formatting
+            start = time.time()
+            try:
+                return output_many(events)
+            finally:
+                self.writing += time.time() - start - \
+                                (self.formatting - formatting)
+                self.events += len(events)
+
+        def timed_process(filename, *args):
+            self.reset()
+            start = time.time()
+            try:
+                return process(filename, *args)
+            finally:
+                self.finish(filename, time.time() - start)
+
+        def timed_flush_events(*args):
+            if self.lines:
+                self.finish('(stream)', time.time() - self.started)
+            self.reset()
+            start = time.time()
+            try:
+                return flush_events(*args)
+            finally:
+                self.finish('(flush)', time.time() - start)
+
+        reader.record_event = timed_record_event
+        writer.output_many = timed_output_many
+        reader.process = timed_process
+        reader.flush_events = timed_flush_events
+        for name in ('format_time', 'describe'):
+            setattr(formatter, name, self.timed(getattr(formatter, name)))
+
+
+    def timed(self, method):
+        """Return method wrapped to add its time to formatting."""
+        def timed_method(*args):
+            start = time.time()
+            try:
+                return method(*args)
+            finally:
+                self.formatting += time.time() - start
+        return timed_method
+
+
+    def alert(self, svc_desc):
+        """Count an alert line, of a service if svc_desc is set."""
+        if svc_desc:
+            self.service_alerts += 1
+        else:
+            self.host_alerts += 1
+
+
+    def read(self, lines, linenum):
+        """Count the lines given to NagiosLogReader.feed(). linenum is the
+        number of lines iterated over, which for an AlertScanner are only
+        the alert lines."""
+        if isinstance(lines, AlertScanner):
+            linenum = lines.buffer.count('\n', 0, lines.end)
+            if lines.end and lines.buffer[lines.end - 1] != '\n':
+                linenum += 1
+        self.lines += linenum
+
+
+    def finish(self, filename, seconds):
+        """Record the counters of filename, and zero them."""
+        self.seconds = seconds
+        self.parsing = max(seconds - self.record - self.formatting - \
+                           self.writing, 0)
+        self.files.append((filename, dict([(field, getattr(self, field))
+                                           for field in self.FIELDS])))
+        self.reset()
+
+
+    def totals(self):
+        """Return the fields summed over all files, with the peak as the
+        maximum."""
+        totals = dict([(field, 0) for field in self.FIELDS])
+        for (filename, fields) in self.files:
+            for field in self.FIELDS:
+                if field == 'peak_ongoing':
+                    totals[field] = max(totals[field], fields[field])
+                else:
+                    totals[field] += fields[field]
+        return totals
+
+
+    def report(self, out=sys.stdout):
+        """Print a table of the files processed."""
+        out.write("%-24s %9s %7s %7s %7s %6s %6s %6s %7s %7s %7s %7s " \
+                  "%7s\n" % (
+            'File', 'Lines', 'Host', 'Service', 'Events', 'Unseen', 'Trunc',
+            'Peak', 'Total s', 'Parse', 'Record', 'Format', 'Write'))
+        for (filename, fields) in self.files + [('Total', self.totals())]:
+            if len(filename) > 24:
+                filename = '...' + filename[-21:]
+            out.write("%-24s %9d %7d %7d %7d %6d %6d %6d %7.2f %7.2f %7.2f " \
+                      "%7.2f %7.2f\n" % (
+                filename, fields['lines'], fields['host_alerts'],
+                fields['service_alerts'], fields['events'],
+                fields['unmatched'], fields['truncated'],
+                fields['peak_ongoing'],
+                fields['seconds'], fields['parsing'], fields['record'],
+                fields['formatting'], fields['writing']))
+
+
+    def save(self, filename):
+        """Write the files and totals as a JSON document."""
+        with open(filename, 'wb') as f:
+            json.dump({'files' : [dict(fields, file=name)
+                                  for (name, fields) in self.files],
+                       'totals' : self.totals()},
+                      f, sort_keys=True, indent=1)
+            f.write('\n')
+
+
+
 class TimelineWriter(object):
     """Base class for writing event source files compatible with Timeline.
 
@@ -301,9 +1756,15 @@ class TimelineWriter(object):
     # Output formats for format_time(), below
     TFORMAT_TIMELINE = 0
     TFORMAT_RFC2822 = 1
-
+    # Caches of format_time(), shared by all writers
+    TIME_CACHE_SIZE = 65536
+    hour_cache = {}
+    rfc2822_cache = {}
+    MINUTES_SECONDS = ['%02d:%02d' % divmod(i, 60) for i in range(3600)]
+    # NagiosConfig describing hosts and services further, if any
+    configs = None
     
-    def __init__(self, filename, append=False):
+    def __init__(self, filename, append=False, checkpoint=None):
         """Empty interface, implemented by derived classes."""
         pass
 
@@ -322,26 +1783,71 @@ class TimelineWriter(object):
         The parameter form may be one of
             TFORMAT_TIMELINE : Timeline's default representation
                 (default here, also)
-            TFORMAT_RFC2822 : RFC2822 Internet email standard."""
+            TFORMAT_RFC2822 : RFC2822 Internet email standard.
+
+        TFORMAT_TIMELINE is built from the formatted date and hour of each
+        UTC hour, cached in hour_cache, and the minutes and seconds looked up
+        from MINUTES_SECONDS. TFORMAT_RFC2822 depends on the local time zone,
+        so whole strings are cached in rfc2822_cache instead. Each cache is
+        cleared once it holds TIME_CACHE_SIZE entries."""
+        timestamp = int(timestamp)
         if form == self.TFORMAT_TIMELINE:
             # Timeline's default format, e.g.
             # "May 10 1961 00:00:00 GMT-0600"
-            utc = time.gmtime(int(timestamp))
-            return time.strftime("%b %d %Y %H:%M:%S GMT%z", utc)
+            (hour, seconds) = divmod(timestamp, 3600)
+            parts = self.hour_cache.get(hour)
+            if parts is None:
+                if len(self.hour_cache) >= self.TIME_CACHE_SIZE:
+                    self.hour_cache.clear()
+                utc = time.gmtime(hour * 3600)
+                parts = (time.strftime("%b %d %Y %H:", utc),
+                         time.strftime(" GMT%z", utc))
+                self.hour_cache[hour] = parts
+            return parts[0] + self.MINUTES_SECONDS[seconds] + parts[1]
         elif form == self.TFORMAT_RFC2822:
             # RFC 2822 (Internet email std) timestamp, e.g.
             # "Thu, 21 Dec 2000 16:01:07 +0200"
             # 
             # TODO: Fix this
-            local = time.localtime(int(timestamp))
-            return time.strftime("%a, %d %b %Y %H:%M:%S %z", local)
-
+            formatted = self.rfc2822_cache.get(timestamp)
+            if formatted is None:
+                if len(self.rfc2822_cache) >= self.TIME_CACHE_SIZE:
+                    self.rfc2822_cache.clear()
+                local = time.localtime(timestamp)
+                formatted = time.strftime("%a, %d %b %Y %H:%M:%S %z", local)
+                self.rfc2822_cache[timestamp] = formatted
+            return formatted
 
-    def output(self, event):
-        """Write the given event to the standard output.
 
-        Derived classes should implement their own versions which output the
-        events to a given file.
+    def describe(self, event):
+        """Return the description of the event shown by Timeline.
+
+        Events made up by the writers themselves, such as the rollups of
+        TimelineWriterLevels, may bring their own description. Others are
+        described further from configs, if set."""
+        if 'description' in event:
+            return event['description']
+        content = ''
+        for i in ['plugin_start', 'plugin_end']:
+            if i in event:
+                content += "%s : %s\n" % (i, event[i].strip())
+        if self.configs is not None:
+            content += self.configs.describe(event['host_name'],
+                                             event.get('svc_desc'))
+        return content
+
+
+    def open_output(self):
+        """Open a new output file for writing. render() replaces this to
+        write the document into memory instead."""
+        return open(self.filename, 'wb')
+
+
+    def output(self, event):
+        """Write the given event to the standard output.
+
+        Derived classes should implement their own versions which output the
+        events to a given file.
 
         Raises ValueError if the event does not meet Timeline's attribute
         constraints."""
@@ -353,6 +1859,16 @@ class TimelineWriter(object):
             print "    %s : %s" % (k,v)            
 
 
+    def output_many(self, events):
+        """Write the given list of events.
+
+        Derived classes should implement this to format and write the events
+        as a block. This default passes each event to output() in turn, for
+        writers which only implement output()."""
+        for event in events:
+            self.output(event)
+
+
     def get_ongoing_events(self):
         """Return all ongoing events as a dictionary.
 
@@ -361,6 +1877,21 @@ class TimelineWriter(object):
         pass
 
 
+    def tell(self):
+        """Return the output offset at which the next event will be written.
+
+        Writers which cannot truncate their output at such an offset return
+        None, and cannot be used with a Checkpoint."""
+        return None
+
+
+    def sync(self, last_timestamp=0):
+        """Make the output written so far complete without closing it.
+
+        Writers which cannot do so ignore this call."""
+        pass
+
+
     def flush_file(self, last_timestamp=0):
         """Close the output file, potentially writing footers and such.
 
@@ -370,90 +1901,2723 @@ class TimelineWriter(object):
 
 
 
-class TimelineWriterXML(TimelineWriter):
-    """Extends XML-specific event attribute constraints."""
+class TimelineFilter(TimelineWriter):
+    """Base class for stages between a NagiosLogReader and its
+    TimelineWriter.
 
-    def __init__(self, filename, append=False):
-        """Create or append to XML document filename.
+    A filter is given to the reader in place of the inner writer it wraps.
+    This base class passes everything on to the inner writer unchanged;
+    derived classes override output_many() and the methods which must see
+    the events held back first."""
 
-        If append is set to True, we will try to read the last-seen attribute
-        of the XML document.
+    def __init__(self, inner):
+        self.inner = inner
 
-        TODO: wiki-url, wiki-section."""
-        self.dom = None
-        self.filename = filename
-        if append:
-            self.dom = xml.dom.minidom.parse(filename)
-            self.root = self.dom.documentElement
-            try: 
-                self.last_timestamp = \
-                    int(self.root.getAttribute('last_timestamp'))
-            except ValueError:
-                raise ValueError, "XML document does not contain " + \
-                      "last_timestamp attribute and append mode requested."
+
+    def output(self, event):
+        """Pass the event on, see output_many()."""
+        self.output_many((event,))
+
+
+    def output_many(self, events):
+        self.inner.output_many(events)
+
+
+    def get_ongoing_events(self):
+        return self.inner.get_ongoing_events()
+
+
+    def tell(self):
+        return self.inner.tell()
+
+
+    def sync(self, last_timestamp=0):
+        self.inner.sync(last_timestamp)
+
+
+    def flush_file(self, last_timestamp=0):
+        self.inner.flush_file(last_timestamp)
+
+
+
+class FlapFilter(TimelineFilter):
+    """Merges the outages of flapping hosts and services.
+
+    An outage which starts less than merge_gap seconds after the previous
+    outage of the same title ended is merged into it: the merged event keeps
+    the start, state and plugin_start of the first outage, and the end and
+    plugin_end of the last one. Outages still shorter than min_duration
+    seconds after merging are dropped, unless still ongoing at the end.
+
+    Each title has at most one pending outage, held back until merge_gap
+    seconds have passed since its end, as told by the latest end seen. A
+    heap orders the pending outages by that deadline; entries of outages
+    merged since are skipped when they come up. So memory is bounded by the
+    number of objects recovering within merge_gap. An outage which starts
+    within the gap but only ends after the gap has passed is not merged.
+
+    merged and dropped count the outages collapsed. Overlay events are not
+    held back."""
+
+    def __init__(self, inner, merge_gap=0, min_duration=0):
+        TimelineFilter.__init__(self, inner)
+        self.merge_gap = merge_gap
+        self.min_duration = min_duration
+        self.pending = {}       # title : event
+        self.deadlines = []     # heap of (deadline, sequence, event)
+        self.sequence = 0
+        self.now = 0            # latest end seen
+        self.merged = 0
+        self.dropped = 0
+
+
+    def output_many(self, events):
+        """Merge the events into the pending ones, then pass on those whose
+        deadline has passed."""
+        ready = []
+        for event in events:
+            # Overlay events are passed on as they are.
+            if event.get('kind') is not None:
+                ready.append(event)
+                continue
+            title = event['title']
+            previous = self.pending.pop(title, None)
+            if previous is not None:
+                if int(event['timestamp_start']) - \
+                   int(previous['timestamp_end']) < self.merge_gap:
+                    previous['timestamp_end'] = event['timestamp_end']
+                    if 'plugin_end' in event:
+                        previous['plugin_end'] = event['plugin_end']
+                    self.merged += 1
+                    event = previous
+                else:
+                    self.release(previous, ready)
+            end = int(event['timestamp_end'])
+            self.pending[title] = event
+            heapq.heappush(self.deadlines,
+                           (end + self.merge_gap, self.sequence, event))
+            self.sequence += 1
+            if self.now < end:
+                self.now = end
+            self.evict(ready)
+        if ready:
+            self.inner.output_many(ready)
+
+
+    def evict(self, ready):
+        """Release the pending events whose deadline has passed into
+        ready."""
+        deadlines = self.deadlines
+        while deadlines and deadlines[0][0] <= self.now:
+            (deadline, sequence, event) = heapq.heappop(deadlines)
+            if self.is_pending(deadline, event):
+                del self.pending[event['title']]
+                self.release(event, ready)
+
+
+    def is_pending(self, deadline, event):
+        """Return True if the heap entry (deadline, event) is current."""
+        return self.pending.get(event['title']) is event and \
+               deadline == int(event['timestamp_end']) + self.merge_gap
+
+
+    def release(self, event, ready, last_timestamp=None):
+        """Add the event to ready, unless it is too short. Events ending
+        after last_timestamp are still ongoing, and always kept."""
+        if int(event['timestamp_end']) - int(event['timestamp_start']) < \
+           self.min_duration and not (last_timestamp is not None and
+                                      event['timestamp_end'] > last_timestamp):
+            self.dropped += 1
         else:
-            if File_exists(filename):
-                raise IOError, \
-                    "File %s exists and not instructed to append." % filename
-            self.dom = xml.dom.minidom.Document()
-            self.root = self.dom.createElement('data')
-            self.dom.appendChild(self.root)
+            ready.append(event)
+
+
+    def drain(self, last_timestamp=None):
+        """Pass on all pending events in the order of their deadlines."""
+        ready = []
+        for (deadline, sequence, event) in sorted(self.deadlines):
+            if self.is_pending(deadline, event):
+                self.release(event, ready, last_timestamp)
+        self.pending = {}
+        self.deadlines = []
+        if ready:
+            self.inner.output_many(ready)
+
+
+    def tell(self):
+        """Pass on all pending events, then return the offset of the inner
+        writer. Outages are not merged across such a point."""
+        self.drain()
+        return self.inner.tell()
+
+
+    def flush_file(self, last_timestamp=0):
+        """Pass on all pending events and flush the inner writer."""
+        self.drain(last_timestamp)
+        self.inner.flush_file(last_timestamp)
+
+
+
+class OutageAnalytics(TimelineFilter):
+    """Computes failure statistics of the outages passing through to the
+    inner writer.
+
+    Each outage is counted in a single pass as it goes by, into the number
+    of failures, the total downtime and the total uptime between failures
+    of its host, or of its service. Their mean time to repair (MTTR) is the
+    downtime per failure and their mean time between failures (MTBF) the
+    uptime between consecutive failures. An object fails at most once at a
+    time and its outages are closed in order, so the uptime is the gap from
+    the end of its previous outage.
+
+    The outages are also kept as (start, end, host) intervals for
+    correlated(), which sweeps over their sorted ends to find the periods
+    when at least min_hosts hosts were failing at once, a host failing
+    whenever it or any of its services is. Sorting dominates, so the
+    analysis takes O(n log n) time for n outages. Overlay events are passed
+    on without being counted."""
+
+    def __init__(self, inner, min_hosts=2):
+        TimelineFilter.__init__(self, inner)
+        self.min_hosts = min_hosts
+        # [failures, downtime, uptime, end of the last outage] of each
+        # host name and (host name, service description)
+        self.hosts = {}
+        self.services = {}
+        self.intervals = []
+        self.first = None
+        self.last = None
+
+
+    def output_many(self, events):
+        """Count the outages, then pass the events on."""
+        hosts = self.hosts
+        services = self.services
+        intervals = self.intervals
+        for event in events:
+            if event.get('kind') is not None:
+                continue
+            start = int(event['timestamp_start'])
+            end = int(event['timestamp_end'])
+            host_name = intern(event['host_name'])
+            svc_desc = event.get('svc_desc')
+            if svc_desc:
+                stats = services.setdefault((host_name, svc_desc),
+                                            [0, 0, 0, None])
+            else:
+                stats = hosts.setdefault(host_name, [0, 0, 0, None])
+            stats[0] += 1
+            stats[1] += end - start
+            if stats[3] is not None:
+                stats[2] += start - stats[3]
+            stats[3] = end
+            intervals.append((start, end, host_name))
+            if self.first is None or start < self.first:
+                self.first = start
+            if self.last is None or end > self.last:
+                self.last = end
+        self.inner.output_many(events)
+
+
+    def figures(self, stats):
+        """Return the failures, downtime, MTTR and MTBF of stats as a
+        dictionary. MTBF is None for objects which failed only once."""
+        (failures, downtime, uptime, end) = stats
+        mtbf = None
+        if failures > 1:
+            mtbf = float(uptime) / (failures - 1)
+        return {'failures' : failures,
+                'downtime' : downtime,
+                'mttr' : float(downtime) / failures,
+                'mtbf' : mtbf}
+
+
+    def correlated(self):
+        """Return the periods when at least min_hosts hosts were failing at
+        once, as dictionaries of their start and end, the peak number of
+        hosts failing and the sorted names of all hosts failing during the
+        period.
+
+        An outage ending at the moment another one starts does not overlap
+        it, so the ends of each moment are swept before its starts. Outages
+        of no length overlap nothing, and are left out."""
+        points = []
+        for (start, end, host_name) in self.intervals:
+            if end > start:
+                points.append((start, 1, host_name))
+                points.append((end, -1, host_name))
+        points.sort()
+        active = {}             # host name : outages ongoing
+        periods = []
+        period = None
+        for (timestamp, delta, host_name) in points:
+            count = active.get(host_name, 0) + delta
+            if count > 0:
+                active[host_name] = count
+            else:
+                active.pop(host_name, None)
+            if period is not None:
+                if len(active) >= self.min_hosts:
+                    period['peak'] = max(period['peak'], len(active))
+                    if count == 1 and delta == 1:
+                        period['hosts'].add(host_name)
+                    continue
+                period['end'] = timestamp
+                period = None
+            elif len(active) >= self.min_hosts:
+                if periods and periods[-1]['end'] == timestamp:
+                    # Continue a period interrupted within this moment.
+                    period = periods[-1]
+                    period['hosts'].update(active)
+                    period['peak'] = max(period['peak'], len(active))
+                else:
+                    period = {'start' : timestamp, 'end' : None,
+                              'peak' : len(active), 'hosts' : set(active)}
+                    periods.append(period)
+        for period in periods:
+            period['hosts'] = sorted(period['hosts'])
+        return [period for period in periods
+                if period['end'] > period['start']]
+
+
+    def report(self):
+        """Return the analysis as a dictionary: the period covered, the
+        number of outages, the figures of each host and of each service by
+        host, and the correlated() failures."""
+        services = {}
+        for ((host_name, svc_desc), stats) in self.services.iteritems():
+            services.setdefault(host_name, {})[svc_desc] = \
+                self.figures(stats)
+        return {'first' : self.first,
+                'last' : self.last,
+                'outages' : len(self.intervals),
+                'min_hosts' : self.min_hosts,
+                'hosts' : dict((host_name, self.figures(stats))
+                               for (host_name, stats)
+                               in self.hosts.iteritems()),
+                'services' : services,
+                'correlated' : self.correlated()}
+
+
+    def save(self, filename):
+        """Write the report() as a JSON document into filename, and return
+        it."""
+        report = self.report()
+        with open(filename, 'wb') as f:
+            json.dump(report, f, sort_keys=True, indent=1)
+            f.write('\n')
+        return report
+
+
+
+class Checkpoint(object):
+    """State persisted between incremental runs, stored in a file next to
+    the output.
+
+    The checkpoint holds the events ongoing at the end of the previous run,
+    its last_timestamp, the output offset at which the ongoing events were
+    flushed, and the byte offset up to which each input log was read. The
+    input logs are identified by device and inode, so that log files
+    renamed by Nagios' log rotation are still recognised."""
+    VERSION = 1
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.last_timestamp = 0
+        self.ongoing_events = []
+        self.output_offset = None
+        # (st_dev, st_ino) : (filename, offset, size of the file)
+        self.inputs = {}
+
+
+    def load(self):
+        """Read the checkpoint file. Returns False if it does not exist.
+
+        Raises ValueError if the file is not a checkpoint we understand."""
+        if not File_exists(self.filename):
+            return False
+        with open(self.filename, 'rb') as f:
+            try:
+                state = pickle.load(f)
+            except (pickle.UnpicklingError, EOFError, ImportError,
+                    AttributeError, IndexError):
+                state = None
+        if not isinstance(state, dict) or \
+           state.get('version') != self.VERSION:
+            raise ValueError, "%s is not a valid checkpoint." % self.filename
+        self.last_timestamp = state['last_timestamp']
+        self.ongoing_events = state['ongoing_events']
+        self.output_offset = state['output_offset']
+        self.inputs = state['inputs']
+        return True
+
+
+    def save(self):
+        """Write the checkpoint file, replacing the previous one atomically."""
+        state = {'version' : self.VERSION,
+                 'last_timestamp' : self.last_timestamp,
+                 'ongoing_events' : self.ongoing_events,
+                 'output_offset' : self.output_offset,
+                 'inputs' : self.inputs}
+        temporary = self.filename + '.tmp'
+        with open(temporary, 'wb') as f:
+            pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(temporary, self.filename)
+
+
+    def input_offset(self, filename):
+        """Return the byte offset up to which filename has been read.
+
+        A file which has shrunk since is assumed to have been truncated and
+        is read from the beginning. The offset of a compressed log counts
+        its uncompressed bytes, so the size of the file itself is compared
+        to the one recorded with the offset instead. Checkpoints of earlier
+        versions have no size, and compare the offset."""
+        st = os.stat(filename)
+        entry = self.inputs.get((st.st_dev, st.st_ino))
+        if entry is None:
+            return 0
+        size = entry[1]
+        if len(entry) > 2:
+            size = entry[2]
+        if size > st.st_size:
+            return 0
+        return entry[1]
+
+
+    def consumed(self, filename, offset, st=None):
+        """Record that filename has been read up to byte offset.
+
+        st may give the os.stat() result of the file read, if filename may no
+        longer refer to it."""
+        if st is None:
+            st = os.stat(filename)
+        self.inputs[(st.st_dev, st.st_ino)] = (filename, offset, st.st_size)
 
 
     def get_ongoing_events(self):
-        """Parse XML doc for duration events with ending dates larger than the
-        last_timestamp attribute of the doc.
+        """Return the ongoing events in the form accepted by
+        NagiosLogReader.set_ongoing_events()."""
+        return as_ongoing(self.ongoing_events)
+
+
+
+class Inotify(object):
+    """Minimal ctypes binding to the inotify interface of Linux.
+
+    LogFollower uses it to sleep until the directory of the log changes.
+    Raises OSError if inotify is not available."""
+    IN_MODIFY = 0x00000002
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    WATCH_MASK = IN_MODIFY | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | \
+                 IN_DELETE
+
+    def __init__(self, directory):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        if not hasattr(libc, 'inotify_init'):
+            raise OSError, "inotify is not available"
+        self.fd = libc.inotify_init()
+        if self.fd < 0:
+            raise OSError, "inotify_init failed: %s" % \
+                  os.strerror(ctypes.get_errno())
+        if libc.inotify_add_watch(self.fd, directory, self.WATCH_MASK) < 0:
+            os.close(self.fd)
+            raise OSError, "inotify_add_watch failed: %s" % \
+                  os.strerror(ctypes.get_errno())
+
+
+    def wait(self, timeout):
+        """Wait at most timeout seconds for a change in the directory."""
+        try:
+            (ready, w, x) = select.select([self.fd], [], [], timeout)
+        except select.error, e:
+            if e.args[0] != errno.EINTR:
+                raise
+            return
+        if ready:
+            # The events themselves are not needed, just discard them.
+            os.read(self.fd, 65536)
+
+
+    def close(self):
+        os.close(self.fd)
+
+
+
+class LogFollower(object):
+    """Follows a live Nagios log, feeding appended lines to a NagiosLogReader.
+
+    The log is reopened when Nagios rotates or truncates it. Closed events
+    are synced to the TimelineWriter once batch events are pending or the
+    oldest has waited for latency seconds, and the reader state is saved into
+    the Checkpoint every interval seconds, so that a restart resumes where
+    we left off. Waiting for new data uses inotify where available, and
+    otherwise sleeps for POLL_INTERVAL seconds at a time."""
+    READ_SIZE = 1 << 20
+    POLL_INTERVAL = 1.0
+
+    def __init__(self, reader, filename, checkpoint=None, latency=5.0,
+                 batch=100, interval=60.0):
+        self.reader = reader
+        self.filename = filename
+        self.checkpoint = checkpoint
+        self.latency = latency
+        self.batch = batch
+        self.interval = interval
+        self.running = False
+        self.fd = None
+        self.offset = 0         # bytes of complete lines fed
+        self.partial = ''       # incomplete last line read
+        self.synced = reader.events_output
+        self.pending_since = None
+        self.saved = time.time()
+        offset = 0
+        if checkpoint is not None:
+            offset = checkpoint.input_offset(filename)
+        self.open_log(offset)
+        try:
+            self.inotify = Inotify(os.path.dirname(os.path.abspath(filename)))
+        except OSError:
+            self.inotify = None
+
+
+    def open_log(self, offset=0):
+        """(Re)open the log and continue reading at byte offset."""
+        if self.fd is not None:
+            os.close(self.fd)
+        self.fd = os.open(self.filename, os.O_RDONLY)
+        os.lseek(self.fd, offset, 0)
+        self.offset = offset
+        self.partial = ''
+
 
-        Thus, duration events may span multiple module executions."""
-        ongoing_events = {}
-        for node in self.root.childNodes:
-            if node.localName == 'event':
-                if node.getAttribute('end') == self.last_timestamp + 1:
-                    event['timestamp_start'] = node.getAttribute('start')
-                    event['title'] = node.getAttribute('title')
-                    # TODO: plugin_start and plugin_end
-        return ongoing_events
+    def read(self):
+        """Feed the complete lines appended to the log since the last read."""
+        while True:
+            data = os.read(self.fd, self.READ_SIZE)
+            if not data:
+                break
+            data = self.partial + data
+            end = data.rfind('\n') + 1
+            self.partial = data[end:]
+            if end:
+                self.reader.feed(StringIO(data[:end]), self.filename)
+                self.offset += end
+
+
+    def reopen_if_rotated(self):
+        """Reopen the log if it has been rotated or truncated.
+
+        The rest of a rotated log is read first."""
+        try:
+            st = os.stat(self.filename)
+        except OSError:
+            # Rotated, but the new log does not exist yet.
+            return
+        own = os.fstat(self.fd)
+        if (st.st_dev, st.st_ino) != (own.st_dev, own.st_ino):
+            self.read()
+            if self.partial:
+                self.reader.feed([self.partial], self.filename)
+            self.open_log(0)
+        elif own.st_size < self.offset:
+            self.open_log(0)
+
+
+    def poll(self):
+        """Read new log data, then sync and save state if it is time to."""
+        self.read()
+        self.reopen_if_rotated()
+        self.read()
+        now = time.time()
+        pending = self.reader.events_output - self.synced
+        if pending and self.pending_since is None:
+            self.pending_since = now
+        if pending >= self.batch or \
+           (pending and now - self.pending_since >= self.latency):
+            self.sync()
+        if self.checkpoint is not None and now - self.saved >= self.interval:
+            self.save()
+
+
+    def sync(self):
+        """Make the events output so far visible in the output file."""
+        self.reader.flush_pending()
+        self.reader.writer.sync(self.reader.last_timestamp)
+        self.synced = self.reader.events_output
+        self.pending_since = None
+
+
+    def save(self):
+        """Sync, then save the reader state into the Checkpoint."""
+        self.sync()
+        self.reader.save_state(self.checkpoint)
+        self.checkpoint.consumed(self.filename, self.offset,
+                                 os.fstat(self.fd))
+        self.checkpoint.save()
+        self.saved = time.time()
+
+
+    def timeout(self):
+        """Return how long to wait for new data before polling again."""
+        deadlines = [self.interval]
+        if self.pending_since is not None:
+            deadlines.append(self.pending_since + self.latency - time.time())
+        if self.checkpoint is not None:
+            deadlines.append(self.saved + self.interval - time.time())
+        return max(0, min(deadlines))
+
+
+    def run(self):
+        """Follow the log until stop() is called, then flush the ongoing
+        events and save the Checkpoint."""
+        self.running = True
+        while self.running:
+            self.poll()
+            if not self.running:
+                break
+            if self.inotify is not None:
+                self.inotify.wait(self.timeout())
+            else:
+                time.sleep(min(self.timeout(), self.POLL_INTERVAL))
+        self.read()
+        self.reader.flush_events(self.checkpoint)
+        if self.checkpoint is not None:
+            self.checkpoint.consumed(self.filename, self.offset,
+                                     os.fstat(self.fd))
+            self.checkpoint.save()
+        self.close()
+
+
+    def stop(self):
+        """Make run() return after the current poll. Safe to call from a
+        signal handler."""
+        self.running = False
+
+
+    def close(self):
+        if self.inotify is not None:
+            self.inotify.close()
+            self.inotify = None
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+
+class LogSummary(TimelineWriter):
+    """The events of a single log file, processed without knowledge of the
+    events ongoing at its start.
+
+    closings lists the recoveries in the order they were read as tuples
+        (identifier, event, timestamp, plugin_output, first, line)
+    where event is None if the recovery had no ongoing event in this file,
+    and first is True for the first recovery of each identifier. Such
+    recoveries may close an event ongoing before the file instead, see
+    NagiosLogReader.merge_summary()."""
+
+    def __init__(self, filename=None, append=False, checkpoint=None):
+        self.filename = filename
+        self.closings = []
+        self.ongoing_events = {}
+        self.last_timestamp = 0
+        self.events_seen = 0
+        # Where reading of the file stopped
+        self.offset = 0
+        # Set by SummaryReader before each recovery is recorded
+        self.recovery = None
 
 
     def output(self, event):
-        """Write the given event to the output file.
+        """Record a recovery which closed an event found in this file."""
+        (identifier, first, timestamp, plugin_output) = self.recovery
+        self.closings.append((identifier, event, event['timestamp_end'],
+                              event.get('plugin_end'), first, None))
 
-        The output is potentially rewritten to conform with XML requirements.
 
-        Raises ValueError if not all required attributes are set."""
-        # Straight-forwardly record found event data as a new XML element's
-        # attributes. Conditionally existing data must be handled more
-        # carefully. See NagiosLogReader.record_event for possible attributes.
-        new_element = self.dom.createElement('event')
-        new_element.setAttribute('start',
-                                 self.format_time(event['timestamp_start']))
-        new_element.setAttribute('end',
-                                 self.format_time(event['timestamp_end']))
-        new_element.setAttribute('durationEvent', 'true')
-        # The title contains 'host_name' or 'host_name svc_desc'
-        new_element.setAttribute('title', event['title'])
-        content = ''
-        for i in ['plugin_start', 'plugin_end']:
-            if i in event:
-                content += "%s : %s\n" % (i, event[i].strip())
-        new_element.appendChild(self.dom.createTextNode(content))
-        self.root.appendChild(new_element)
-        
+    def unseen(self, line):
+        """Record a recovery with no ongoing event in this file."""
+        (identifier, first, timestamp, plugin_output) = self.recovery
+        self.closings.append((identifier, None, timestamp, plugin_output,
+                              first, line))
 
-    def flush_file(self, last_timestamp):
-        """Writes DOM tree to XML document and closes it."""
-        self.root.setAttribute('last_timestamp', str(last_timestamp))
-        with open(self.filename, 'w') as f:
-            # No indent for first node, then two spaces for each level
-            self.dom.writexml(f, '', '  ', '\n')
-        self.dom.unlink()
 
 
-class TimelineWriterJSON(TimelineWriter):
-    """Extends JSON-specific event attribute constraints.
+class SummaryReader(NagiosLogReader):
+    """Processes a single log file into a LogSummary."""
+
+    def __init__(self, filename, options):
+        NagiosLogReader.__init__(self, LogSummary(filename), options)
+        # Identifiers which have recovered at least once in this file
+        self.recovered = set()
+        # Limits are not applied in summaries, see process_many().
+        self.max_open = self.max_age = 0
+
+
+    def record_event(self, timestamp, host_name, state, svc_desc="",
+                     plugin_output="", kind=None):
+        """Record the event, noting whether a recovery is the first one of
+        its identifier."""
+        if state in self.RECOVERY_STATES:
+            identifier = self.identifier(host_name, svc_desc, kind)
+            first = identifier not in self.recovered
+            self.recovered.add(identifier)
+            self.writer.recovery = (identifier, first, int(timestamp),
+                                    plugin_output)
+        return NagiosLogReader.record_event(self, timestamp, host_name, state,
+                                            svc_desc, plugin_output, kind)
+
+
+    def record_notification(self, *args):
+        """Record the notification as a closing of no identifier, which
+        NagiosLogReader.merge_summary() passes on as it is."""
+        self.writer.recovery = (None, False, None, None)
+        return NagiosLogReader.record_notification(self, *args)
+
+
+    def emit(self, event):
+        """Pass the event to the LogSummary at once, while its recovery is
+        known."""
+        self.events_output += 1
+        self.writer.output(event)
+
+
+    def unseen_recovery(self, filename, line):
+        """Leave the warning to NagiosLogReader.merge_summary()."""
+        self.writer.unseen(line)
+
+
+    def summary(self):
+        """Return the LogSummary of the file processed."""
+        summary = self.writer
+        summary.ongoing_events = self.ongoing_events
+        summary.last_timestamp = self.last_timestamp
+        summary.events_seen = self.events_seen
+        summary.recovery = None
+        return summary
+
+
+def as_ongoing(events):
+    """Return events in the form accepted by
+    NagiosLogReader.set_ongoing_events(). The kind is only given for
+    overlay events."""
+    ongoing = []
+    for event in events:
+        item = {'timestamp' : event['timestamp_start'],
+                'host_name' : event['host_name'],
+                'state' : event['state'],
+                'svc_desc' : event.get('svc_desc'),
+                'plugin_output' : event.get('plugin_start')}
+        if event.get('kind') is not None:
+            item['kind'] = event['kind']
+        ongoing.append(item)
+    return ongoing
+
+
+def summarize(job):
+    """Process the log file of job = (filename, options, offset) into a
+    LogSummary.
+
+    Runs in the worker processes of NagiosLogReader.process_many()."""
+    (filename, options, offset) = job
+    reader = SummaryReader(filename, options)
+    end = reader.process(filename, offset)
+    summary = reader.summary()
+    summary.offset = end
+    return summary
+
+
+
+class IndexReader(NagiosLogReader):
+    """Processes a single log file from its start into the points of a
+    LogIndex. Nothing is output."""
+
+    def __init__(self, options, interval):
+        NagiosLogReader.__init__(self, None, options)
+        self.interval = interval
+        self.points = []
+        self.next_point = 0
+        # Identifiers which have recovered at least once so far
+        self.recovered = set()
+        # Points record every ongoing event, limits apply after carry_in().
+        self.max_open = self.max_age = 0
+
+
+    def record_event(self, timestamp, host_name, state, svc_desc="",
+                     plugin_output="", kind=None):
+        """Record the event, noting the identifiers of recoveries."""
+        if state in self.RECOVERY_STATES:
+            self.recovered.add(self.identifier(host_name, svc_desc, kind))
+        return NagiosLogReader.record_event(self, timestamp, host_name, state,
+                                            svc_desc, plugin_output, kind)
+
+
+    def emit(self, event):
+        pass
+
+
+    def unseen_recovery(self, filename, line):
+        pass
+
+
+    def feed(self, lines, filename):
+        """Add a point at the start of the block of an AlertScanner once
+        interval bytes have been read since the last point."""
+        if isinstance(lines, AlertScanner) and \
+           lines.offset >= self.next_point:
+            buffer = lines.buffer
+            close = buffer.find(']', 1, 32)
+            if buffer.startswith('[') and buffer[1:close].isdigit():
+                self.add_point(int(buffer[1:close]), lines.offset)
+                self.next_point = lines.offset + self.interval
+        NagiosLogReader.feed(self, lines, filename)
+
+
+    def add_point(self, timestamp, offset):
+        """Record the state of the reader at byte offset."""
+        self.points.append((timestamp, offset,
+                            as_ongoing(self.ongoing_events.itervalues()),
+                            frozenset(self.recovered)))
+
+
+
+class LogIndex(object):
+    """A sparse index of a log file, stored in a file next to it.
+
+    points lists tuples (timestamp, offset, ongoing_events, recovered) taken
+    every INTERVAL bytes of the log, give or take a block, and at its end.
+    Each has the timestamp of the line at byte offset, the events ongoing
+    there in the form accepted by NagiosLogReader.set_ongoing_events(), and
+    the identifiers which recovered at least once before it. Both are as
+    found by reading the file from its start alone, see
+    NagiosLogReader.carry_in(). The end point has the last timestamp seen.
+
+    The index is rebuilt whenever the log changes in size or modification
+    time, or is read with a different set of states, kinds of lines or
+    host and service filters.
+    Offsets into compressed logs refer to the uncompressed log."""
+    VERSION = 2
+    INTERVAL = 1 << 22
+
+    def __init__(self, filename, options):
+        self.filename = filename
+        self.index_file = filename + '.index'
+        self.options = options
+        self.points = []
+        self.timestamps = []
+
+
+    def signature(self):
+        """Return what the index depends on."""
+        st = os.stat(self.filename)
+        reader = NagiosLogReader(None, self.options)
+        return (self.VERSION, st.st_size, st.st_mtime) + reader.signature()
+
+
+    def update(self):
+        """Load the index file, or rebuild and save it if it is missing or
+        out of date."""
+        signature = self.signature()
+        if not self.load(signature):
+            self.build()
+            self.save(signature)
+        self.timestamps = [point[0] for point in self.points]
+
+
+    def load(self, signature):
+        """Read the index file. Returns False if it is missing, invalid or
+        does not match signature."""
+        if not File_exists(self.index_file):
+            return False
+        with open(self.index_file, 'rb') as f:
+            try:
+                state = pickle.load(f)
+            except (pickle.UnpicklingError, EOFError, ImportError,
+                    AttributeError, IndexError, ValueError):
+                return False
+        if not isinstance(state, dict) or \
+           state.get('signature') != signature:
+            return False
+        self.points = state['points']
+        return True
+
+
+    def build(self):
+        """Read the whole log into index points."""
+        reader = IndexReader(self.options, self.INTERVAL)
+        end = reader.process(self.filename)
+        timestamp = reader.last_timestamp
+        if reader.points:
+            timestamp = max(timestamp, reader.points[-1][0])
+        reader.add_point(timestamp, end)
+        self.points = reader.points
+
+
+    def save(self, signature):
+        """Write the index file, replacing the previous one atomically.
+
+        Logs in directories we cannot write to are simply indexed again on
+        each run."""
+        state = {'signature' : signature,
+                 'points' : self.points}
+        temporary = self.index_file + '.tmp'
+        try:
+            with open(temporary, 'wb') as f:
+                pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+            os.rename(temporary, self.index_file)
+        except (IOError, OSError):
+            pass
+
+
+    def start(self, since):
+        """Return the last point before since, or None if reading should
+        start from the beginning of the log."""
+        if since is None:
+            return None
+        i = bisect.bisect_left(self.timestamps, since) - 1
+        if i < 0:
+            return None
+        return self.points[i]
+
+
+    def stop(self, until):
+        """Return the offset of the first point after until, or None if
+        reading should continue to the end of the log."""
+        if until is None:
+            return None
+        i = bisect.bisect_right(self.timestamps, until)
+        if i == len(self.points):
+            return None
+        return self.points[i][1]
+
+
+
+class LogSource(object):
+    """The logs of one Nagios instance, read as a single stream of alert
+    lines for merge_sources().
+
+    path is a log file or a directory of them, such as the log archive of
+    Nagios, or a list of log files. The files of a directory are read in
+    the order of their first timestamps, those of a list in the order
+    given. Compressed logs are read as in NagiosLogReader.process(),
+    and the .index files of LogIndex are skipped.
+
+    With a prefix, each host name is prefixed with "prefix/", so that the
+    hosts of different instances are told apart. Only the lines containing
+    token are read, see NagiosLogReader.token()."""
+
+    def __init__(self, path, prefix=None, token=NagiosLogReader.ALERT_TOKEN):
+        self.path = path
+        self.prefix = prefix
+        self.token = token
+        if isinstance(path, list):
+            self.path = ' '.join(path)
+            self.filenames = path
+        elif os.path.isdir(path):
+            names = [os.path.join(path, name) for name in os.listdir(path)
+                     if not name.endswith('.index')]
+            names = [name for name in names if os.path.isfile(name)]
+            self.filenames = sorted(names,
+                                    key=lambda name: (first_timestamp(name),
+                                                      name))
+        else:
+            self.filenames = [path]
+
+
+    def __iter__(self):
+        """Yield (timestamp, line) for each alert line of the files in
+        turn. Lines without a timestamp are given that of the line before
+        them."""
+        token = self.token
+        prefix = self.prefix and self.prefix + '/'
+        timestamp = 0
+        for filename in self.filenames:
+            log = open_archive(filename) or open(filename, 'rb')
+            try:
+                scanner = AlertScanner(token, log)
+                for lines in scanner.blocks(NagiosLogReader.READ_SIZE):
+                    for line in lines:
+                        close = line.find(']')
+                        if line.startswith('[') and line[1:close].isdigit():
+                            timestamp = int(line[1:close])
+                        if prefix:
+                            colon = line.find(': ') + 2
+                            # Notifications name the contact first.
+                            if line[:colon].endswith('NOTIFICATION: '):
+                                colon = line.find(';', colon) + 1
+                            line = line[:colon] + prefix + line[colon:]
+                        yield (timestamp, line)
+            finally:
+                log.close()
+
+
+
+def first_timestamp(filename):
+    """Return the timestamp of the first line of the log filename, or 0 if
+    it has none."""
+    log = open_archive(filename) or open(filename, 'rb')
+    try:
+        line = log.readline()
+    finally:
+        log.close()
+    close = line.find(']')
+    if line.startswith('[') and line[1:close].isdigit():
+        return int(line[1:close])
+    return 0
+
+
+def parse_source(spec):
+    """Return the LogSource of a --source option "[PREFIX=]PATH"."""
+    (prefix, sep, path) = spec.partition('=')
+    if not sep or os.sep in prefix:
+        return LogSource(spec)
+    return LogSource(path, prefix)
+
+
+def merge_sources(sources):
+    """Yield the alert lines of the LogSources given in timestamp order.
+
+    This is a k-way merge on a heap holding the next line of each source.
+    Lines with equal timestamps come in the order of the sources, and the
+    lines of each source in their own order."""
+    heap = []
+    for (index, source) in enumerate(sources):
+        lines = iter(source)
+        for (timestamp, line) in lines:
+            heap.append((timestamp, index, line, lines))
+            break
+    heapq.heapify(heap)
+    while heap:
+        (timestamp, index, line, lines) = heap[0]
+        yield line
+        for (timestamp, line) in lines:
+            heapq.heapreplace(heap, (timestamp, index, line, lines))
+            break
+        else:
+            heapq.heappop(heap)
+
+
+
+def array_code(size, codes):
+    """Return the first of the array typecodes given whose items take size
+    bytes. Raises ValueError if there is none on this platform."""
+    for code in codes:
+        if array.array(code).itemsize == size:
+            return code
+    raise ValueError, "No array type of %d bytes on this platform" % size
+
+
+def load_numpy():
+    """Return the numpy module, or None if it is not installed.
+
+    NumPy is optional and slow to import, so it is only imported by the
+    first caller, like the modules of LazyModule."""
+    global numpy
+    if numpy is None:
+        try:
+            import numpy as module
+        except ImportError:
+            module = False
+        numpy = module
+    return numpy or None
+
+
+
+class ParsedDump(object):
+    """Collects the alert lines read by a NagiosLogReader, and writes them
+    into a columnar binary file for ParsedAlerts to replay, see
+    --dump-parsed.
+
+    The file starts with HEADER: MAGIC, VERSION, the number of alerts, the
+    length of the heap of plugin outputs and those of the host, service and
+    state names. The columns follow, as arrays of little-endian integers:
+    the timestamps (int64), the offsets of the plugin outputs in the heap
+    (int64, one more than there are alerts), and the host, service and
+    state codes (uint32) of each alert. Then come the heap and the names,
+    separated by newlines, in the order of their codes. Host alerts have
+    the empty service name of code 0.
+
+    The columns are collected in arrays of the machine's integers, which
+    are appended every BATCH alerts to temporary files of their own next to
+    filename, as are the plugin outputs to the heap. close() puts them
+    together behind the header, so that only the names are kept in memory
+    however many alerts are dumped."""
+    MAGIC = 'N2TALERT'
+    VERSION = 1
+    HEADER = struct.Struct('<8sI4x5Q8x')
+    # The columns, in the order of the file
+    COLUMNS = ('timestamps', 'offsets', 'hosts', 'services', 'states')
+    BATCH = 4096
+
+    def __init__(self, filename):
+        """Raises ValueError if the platform has no arrays of 64-bit
+        integers, and IOError if the temporary files cannot be created."""
+        self.filename = filename
+        int64 = array_code(8, 'il')
+        uint32 = array_code(4, 'IL')
+        self.count = 0
+        self.heap_size = 0
+        self.timestamps = array.array(int64)
+        self.offsets = array.array(int64, [0])
+        self.hosts = array.array(uint32)
+        self.services = array.array(uint32)
+        self.states = array.array(uint32)
+        self.heap = []
+        self.files = {}
+        try:
+            for column in self.COLUMNS + ('heap',):
+                self.files[column] = open(self.temporary(column), 'wb')
+        except IOError:
+            self.remove()
+            raise
+        # The names of each column, and their codes
+        self.names = ([], [''], [])
+        self.codes = ({}, {'' : 0}, {})
+
+
+    def temporary(self, column):
+        """Return the name of the temporary file of column."""
+        return '%s.%s.tmp' % (self.filename, column)
+
+
+    def encode(self, column, name):
+        """Return the code of name in column 0, 1 or 2 for hosts, services
+        and states, adding it if it is new."""
+        codes = self.codes[column]
+        code = codes.get(name)
+        if code is None:
+            code = codes[name] = len(codes)
+            self.names[column].append(name)
+        return code
+
+
+    def add(self, timestamp, host_name, svc_desc, state, plugin_output):
+        """Add an alert, as split by NagiosLogReader.tokenize()."""
+        self.timestamps.append(int(timestamp))
+        self.hosts.append(self.encode(0, host_name))
+        self.services.append(self.encode(1, svc_desc or ''))
+        self.states.append(self.encode(2, state))
+        self.heap.append(plugin_output)
+        self.heap_size += len(plugin_output)
+        self.offsets.append(self.heap_size)
+        self.count += 1
+        if len(self.heap) == self.BATCH:
+            self.flush()
+
+
+    def flush(self):
+        """Append the columns and plugin outputs collected to their
+        temporary files."""
+        for column in self.COLUMNS:
+            values = getattr(self, column)
+            if sys.byteorder == 'big':
+                values = array.array(values.typecode, values)
+                values.byteswap()
+            values.tofile(self.files[column])
+            del getattr(self, column)[:]
+        self.files['heap'].write(''.join(self.heap))
+        self.heap = []
+
+
+    def remove(self):
+        """Close and remove the temporary files."""
+        for (column, f) in self.files.items():
+            f.close()
+            if File_exists(self.temporary(column)):
+                os.remove(self.temporary(column))
+        self.files = {}
+
+
+    def close(self):
+        """Write the alerts added into the file, replacing it atomically,
+        and remove the temporary files."""
+        names = ['\n'.join(names) for names in self.names]
+        temporary = self.filename + '.tmp'
+        try:
+            self.flush()
+            for f in self.files.values():
+                f.close()
+            with open(temporary, 'wb') as f:
+                f.write(self.HEADER.pack(self.MAGIC, self.VERSION,
+                                         self.count, self.heap_size,
+                                         *[len(text) for text in names]))
+                for column in self.COLUMNS + ('heap',):
+                    with open(self.temporary(column), 'rb') as part:
+                        shutil.copyfileobj(part, f)
+                for text in names:
+                    f.write(text)
+            os.rename(temporary, self.filename)
+        finally:
+            self.remove()
+
+
+
+class ParsedAlerts(object):
+    """The alerts of a file written by ParsedDump, memory-mapped for
+    NagiosLogReader.replay().
+
+    select() picks the alerts a reader records with its options a column
+    at a time: the names are matched once per distinct name instead of
+    once per alert, and the result looked up by the codes of each alert.
+    With NumPy, the columns are arrays over the mapped file itself and the
+    lookups vectorized. Without it, they are copied into arrays and looked
+    up alert by alert. Either way, strings are only made of the alerts
+    selected."""
+    # The NumPy and array types of the integers of each size in the columns
+    TYPES = {8 : ('<i8', 'il'), 4 : ('<u4', 'IL')}
+
+    def __init__(self, filename):
+        """Raises ValueError if filename is not a dump of parsed alerts, and
+        IOError if it cannot be read."""
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < ParsedDump.HEADER.size:
+                raise ValueError, "%s is not a dump of parsed alerts" % \
+                      filename
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, count, heap, hosts, services, states) = \
+                ParsedDump.HEADER.unpack_from(self.map)
+        if magic != ParsedDump.MAGIC or version != ParsedDump.VERSION:
+            self.map.close()
+            raise ValueError, "%s is not a dump of parsed alerts" % filename
+        self.count = count
+        # Where each column starts in the file
+        self.timestamps = ParsedDump.HEADER.size
+        self.offsets = self.timestamps + 8 * count
+        self.codes = self.offsets + 8 * (count + 1)
+        self.heap = self.codes + 3 * 4 * count
+        position = self.heap + heap
+        if position + hosts + services + states != size:
+            self.map.close()
+            raise ValueError, "%s is truncated" % filename
+        self.names = []
+        for length in (hosts, services, states):
+            self.names.append(self.map[position:position + length]
+                              .split('\n'))
+            position += length
+
+
+    def column(self, position, size, count):
+        """Return the column of count integers of size bytes at position,
+        as a NumPy array if available, else as an array."""
+        (dtype, codes) = self.TYPES[size]
+        if load_numpy() is not None:
+            return numpy.frombuffer(self.map, dtype, count, position)
+        values = array.array(array_code(size, codes))
+        values.fromstring(self.map[position:position + size * count])
+        if sys.byteorder == 'big':
+            values.byteswap()
+        return values
+
+
+    def tables(self, reader):
+        """Return whether reader records each host, service and state name,
+        as lists indexed by their codes."""
+        (hosts, services, states) = self.names
+        host_filter = reader.host_filter
+        service_filter = reader.service_filter
+        enabled = reader.enabled_states()
+        return ([host_filter is None or host_filter.accepts(name)
+                 for name in hosts],
+                [not reader.options.services] +
+                [not reader.options.hosts and
+                 (service_filter is None or service_filter.accepts(name))
+                 for name in services[1:]],
+                [name in enabled for name in states])
+
+
+    def select(self, reader):
+        """Yield the alerts which reader records with its options as tuples
+        (timestamp, host_name, svc_desc, state, plugin_output), like
+        NagiosLogReader.feed() would."""
+        count = self.count
+        timestamps = self.column(self.timestamps, 8, count)
+        hosts = self.column(self.codes, 4, count)
+        services = self.column(self.codes + 4 * count, 4, count)
+        states = self.column(self.codes + 8 * count, 4, count)
+        offsets = self.column(self.offsets, 8, count + 1)
+        (host_table, service_table, state_table) = self.tables(reader)
+        if load_numpy() is not None:
+            mask = numpy.array(host_table, bool)[hosts] & \
+                   numpy.array(service_table, bool)[services] & \
+                   numpy.array(state_table, bool)[states]
+            selected = numpy.flatnonzero(mask).tolist()
+        else:
+            # Only the columns with names not recorded narrow the selection.
+            selected = xrange(count)
+            for (table, codes) in ((state_table, states),
+                                   (service_table, services),
+                                   (host_table, hosts)):
+                if not all(table):
+                    selected = [i for i in selected if table[codes[i]]]
+        (host_names, svc_descs, state_names) = self.names
+        heap = self.heap
+        data = self.map
+        for i in selected:
+            yield (int(timestamps[i]), host_names[hosts[i]],
+                   svc_descs[services[i]] or None, state_names[states[i]],
+                   data[heap + int(offsets[i]):heap + int(offsets[i + 1])])
+
+
+    def close(self):
+        self.map.close()
+
+
+
+class NagiosConfig(object):
+    """Host and service descriptions from the Nagios object configuration.
+
+    paths lists nagios.cfg files, whose cfg_file and cfg_dir directives are
+    followed, object configuration files, or directories searched for
+    *.cfg files. Templates are resolved as Nagios does: the templates named
+    by use are applied left first, and values starting with + are appended
+    to the inherited ones.
+
+    The text added to the description of each host and service is built
+    once and kept in hosts and services, indexed by the host name and by
+    (host name, service description), so describe() is a dictionary lookup.
+    Both are cached in index_file, which is rebuilt whenever any of the
+    files read changes in size or modification time."""
+    VERSION = 1
+    HOST_FIELDS = ['alias', 'address', 'notes', 'hostgroups', 'contacts',
+                   'contact_groups']
+    SERVICE_FIELDS = ['display_name', 'notes', 'servicegroups', 'contacts',
+                      'contact_groups']
+
+    def __init__(self, paths, index_file=None):
+        self.paths = [os.path.abspath(path) for path in paths]
+        self.index_file = index_file or paths[0].rstrip(os.sep) + '.index'
+        self.hosts = {}
+        self.services = {}
+
+
+    def files(self):
+        """Return the configuration files found under paths, in order."""
+        found = []
+        pending = list(self.paths)
+        while pending:
+            path = pending.pop(0)
+            if os.path.isdir(path):
+                for (dirpath, dirnames, filenames) in os.walk(path):
+                    dirnames.sort()
+                    for name in sorted(filenames):
+                        filename = os.path.join(dirpath, name)
+                        if name.endswith('.cfg') and filename not in found:
+                            found.append(filename)
+            elif path not in found:
+                found.append(path)
+                # A main configuration file refers to the object files.
+                directory = os.path.dirname(path)
+                with open(path) as f:
+                    for line in f:
+                        (key, sep, value) = line.strip().partition('=')
+                        if sep and key in ('cfg_file', 'cfg_dir'):
+                            pending.append(os.path.join(directory,
+                                                        value.strip()))
+        return found
+
+
+    def signature(self, files):
+        """Return what the index depends on."""
+        signature = [self.VERSION]
+        for filename in files:
+            st = os.stat(filename)
+            signature.append((filename, st.st_size, st.st_mtime))
+        return signature
+
+
+    def update(self):
+        """Load the index file, or read the configuration and save it if
+        the index is missing or out of date.
+
+        Raises IOError or OSError if a configuration file cannot be read."""
+        files = self.files()
+        signature = self.signature(files)
+        if not self.load(signature):
+            self.build(files)
+            self.save(signature)
+
+
+    def load(self, signature):
+        """Read the index file. Returns False if it is missing, invalid or
+        does not match signature."""
+        if not File_exists(self.index_file):
+            return False
+        with open(self.index_file, 'rb') as f:
+            try:
+                state = pickle.load(f)
+            except (pickle.UnpicklingError, EOFError, ImportError,
+                    AttributeError, IndexError, ValueError):
+                return False
+        if not isinstance(state, dict) or \
+           state.get('signature') != signature:
+            return False
+        self.hosts = state['hosts']
+        self.services = state['services']
+        return True
+
+
+    def save(self, signature):
+        """Write the index file, replacing the previous one atomically.
+
+        Configurations in directories we cannot write to are simply read
+        again on each run, unless index_file is given elsewhere."""
+        state = {'signature' : signature,
+                 'hosts' : self.hosts,
+                 'services' : self.services}
+        temporary = self.index_file + '.tmp'
+        try:
+            with open(temporary, 'wb') as f:
+                pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+            os.rename(temporary, self.index_file)
+        except (IOError, OSError):
+            pass
+
+
+    def build(self, files):
+        """Read and resolve the object definitions of files."""
+        objects = collections.defaultdict(list)
+        for filename in files:
+            with open(filename) as f:
+                for (kind, definition) in self.definitions(f):
+                    objects[kind].append(definition)
+        resolved = {}
+        for kind in objects:
+            templates = dict((definition['name'], definition)
+                             for definition in objects[kind]
+                             if 'name' in definition)
+            resolved[kind] = [self.resolve(definition, templates, [])
+                              for definition in objects[kind]
+                              if definition.get('register') != '0']
+
+        # Hosts join the host groups listing them as members.
+        hosts = {}
+        for host in resolved.get('host', []):
+            if 'host_name' in host:
+                hosts[host['host_name']] = host
+        members = collections.defaultdict(list)
+        for group in resolved.get('hostgroup', []):
+            name = group.get('hostgroup_name')
+            for host_name in split_list(group.get('members', '')):
+                if host_name == '*':
+                    for host in hosts.itervalues():
+                        add_to_list(host, 'hostgroups', name)
+                elif host_name in hosts:
+                    add_to_list(hosts[host_name], 'hostgroups', name)
+                members[name].append(host_name)
+        for host in hosts.itervalues():
+            for name in split_list(host.get('hostgroups', '')):
+                if host['host_name'] not in members[name]:
+                    members[name].append(host['host_name'])
+
+        self.hosts = dict((name, self.text(host, self.HOST_FIELDS))
+                          for (name, host) in hosts.iteritems())
+        self.services = {}
+        for service in resolved.get('service', []):
+            svc_desc = service.get('service_description')
+            if svc_desc is None:
+                continue
+            text = self.text(service, self.SERVICE_FIELDS)
+            for host_name in self.service_hosts(service, hosts, members):
+                self.services[(host_name, svc_desc)] = \
+                    text + self.hosts.get(host_name, '')
+
+
+    def definitions(self, lines):
+        """Generate (type, directives) for each object defined in lines."""
+        definition = None
+        continued = ''
+        for line in lines:
+            line = continued + line.strip()
+            if line.endswith('\\'):
+                continued = line[:-1]
+                continue
+            continued = ''
+            if not line or line[0] in '#;':
+                continue
+            line = re.sub(r'(?<!\\);.*', '', line).replace(r'\;', ';').strip()
+            if definition is None:
+                if line.startswith('define'):
+                    kind = line[6:].strip().rstrip('{').strip()
+                    definition = {}
+                continue
+            closed = line.endswith('}')
+            if closed:
+                line = line[:-1].strip()
+            fields = line.split(None, 1)
+            if fields:
+                definition[fields[0]] = len(fields) > 1 and fields[1] or ''
+            if closed:
+                yield (kind, definition)
+                definition = None
+
+
+    def resolve(self, definition, templates, seen):
+        """Return definition with the templates it uses applied."""
+        resolved = {}
+        for name in reversed(split_list(definition.get('use', ''))):
+            # Circular or missing templates are ignored, as in Nagios.
+            if name in templates and name not in seen:
+                resolved.update(self.resolve(templates[name], templates,
+                                             seen + [name]))
+        for (key, value) in definition.iteritems():
+            if value.startswith('+'):
+                value = value[1:]
+                if resolved.get(key):
+                    value = resolved[key] + ',' + value
+            resolved[key] = value
+        for key in ('use', 'name', 'register'):
+            resolved.pop(key, None)
+        return resolved
+
+
+    def service_hosts(self, service, hosts, members):
+        """Return the names of the hosts service is defined for."""
+        names = []
+        excluded = set()
+        for name in split_list(service.get('host_name', '')):
+            if name == '*':
+                names.extend(hosts)
+            elif name.startswith('!'):
+                excluded.add(name[1:])
+            else:
+                names.append(name)
+        for group in split_list(service.get('hostgroup_name', '')):
+            if group == '*':
+                names.extend(hosts)
+            elif group.startswith('!'):
+                excluded.update(members[group[1:]])
+            else:
+                names.extend(members[group])
+        return [name for name in names if name not in excluded]
+
+
+    def text(self, definition, fields):
+        """Return the lines describing definition."""
+        content = ''
+        for i in fields:
+            if definition.get(i):
+                content += "%s : %s\n" % (i, definition[i])
+        return content
+
+
+    def describe(self, host_name, svc_desc=None):
+        """Return the lines to add to the description of an event."""
+        if svc_desc is None:
+            return self.hosts.get(host_name, '')
+        try:
+            return self.services[(host_name, svc_desc)]
+        except KeyError:
+            return self.hosts.get(host_name, '')
+
+
+def split_list(value):
+    """Split a comma separated list of a Nagios object definition."""
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+
+def add_to_list(definition, key, item):
+    """Append item to the comma separated list key of definition."""
+    items = split_list(definition.get(key, ''))
+    if item not in items:
+        definition[key] = ','.join(items + [item])
+
+
+
+class TimelineWriterXML(TimelineWriter):
+    """Extends XML-specific event attribute constraints.
+
+    Events are streamed to the output file as soon as they are given to
+    output(), so the memory requirement does not grow with the number of
+    events written. The root element is written with a fixed-width
+    last_timestamp attribute, which flush_file() overwrites in place."""
+
+    # The last_timestamp attribute is zero-padded to a fixed width so that
+    # it can be rewritten without moving the rest of the document.
+    XML_DECLARATION = '<?xml version="1.0" ?>\n'
+    XML_ROOT = '<data last_timestamp="%020d">\n'
+    XML_FOOTER = '</data>\n'
+    XML_EVENT = '  <event durationEvent="true" end="%s" start="%s" ' + \
+                'title="%s">%s</event>\n'
+    # Overlay events carry their kind as the classname
+    XML_OVERLAY = '  <event classname="%s" durationEvent="%s" end="%s" ' + \
+                  'start="%s" title="%s">%s</event>\n'
+    # Matches the root element of documents written by this class or by
+    # earlier, minidom-based versions of it.
+    RE_ROOT = LazyPattern(r'<data(?: last_timestamp="(\d*)")?\s*(/?)>')
+
+    def __init__(self, filename, append=False, checkpoint=None):
+        """Create or append to XML document filename.
+
+        If append is set to True, we will try to read the last-seen attribute
+        of the XML document. The file itself is not opened until the first
+        event is written or flush_file() is called. When appending with a
+        Checkpoint, the document is truncated at its output offset.
+
+        TODO: wiki-url, wiki-section."""
+        self.filename = filename
+        self.append = append
+        self.checkpoint = checkpoint
+        self.file = None
+        # File offset of the last_timestamp attribute value
+        self.root_offset = None
+        self.last_timestamp = 0
+        if append:
+            with open(filename, 'rb') as f:
+                match = self.RE_ROOT.search(f.read(4096))
+            if not (match and match.group(1)):
+                raise ValueError, "XML document does not contain " + \
+                      "last_timestamp attribute and append mode requested."
+            self.last_timestamp = int(match.group(1))
+        elif File_exists(filename):
+            raise IOError, \
+                "File %s exists and not instructed to append." % filename
+
+
+    def open_file(self):
+        """Open the output file for writing, unless already opened.
+
+        A new document gets its declaration and root element written. An
+        existing document is positioned just before its closing root tag,
+        converting the root element into the fixed-width form first if the
+        document was written by an older version."""
+        if self.file is not None:
+            return
+        if not self.append:
+            self.file = self.open_output()
+            self.file.write(self.XML_DECLARATION)
+            self.root_offset = self.file.tell() + len('<data last_timestamp="')
+            self.file.write(self.XML_ROOT % self.last_timestamp)
+            return
+        self.file = open(self.filename, 'r+b')
+        match = self.RE_ROOT.search(self.file.read(4096))
+        if match.group(0) != (self.XML_ROOT % self.last_timestamp).rstrip():
+            self.rewrite_root(match)
+            self.file.close()
+            self.file = open(self.filename, 'r+b')
+            match = self.RE_ROOT.search(self.file.read(4096))
+        self.root_offset = match.start(1)
+        self.file.seek(0, 2)
+        size = self.file.tell()
+        if self.checkpoint is not None:
+            # Drop the events flushed as ongoing by the previous run, they
+            # are continued from the checkpoint instead.
+            offset = self.checkpoint.output_offset
+            if offset is None or not match.end() < offset <= size:
+                raise ValueError, \
+                    "Checkpoint does not match XML document %s." % \
+                    self.filename
+            self.file.seek(offset)
+            self.file.truncate()
+            return
+        # Drop the closing root tag, the events will be written in its place.
+        self.file.seek(0, 2)
+        size = self.file.tell()
+        tail_offset = max(size - 4096, match.end())
+        self.file.seek(tail_offset)
+        footer = self.file.read().rfind('</data>')
+        if footer == -1:
+            raise ValueError, \
+                "XML document %s is missing its closing root tag." % \
+                self.filename
+        self.file.seek(tail_offset + footer)
+        self.file.truncate()
+
+
+    def rewrite_root(self, match):
+        """Copy the document into a new file with a fixed-width root element.
+
+        The copy is made in constant memory, after which the new file replaces
+        the original one."""
+        temporary = self.filename + '.tmp'
+        with open(temporary, 'wb') as f:
+            f.write(self.XML_DECLARATION)
+            f.write(self.XML_ROOT % self.last_timestamp)
+            if match.group(2):
+                # A self-closing root element contains no events.
+                f.write(self.XML_FOOTER)
+            else:
+                self.file.seek(match.end())
+                # Skip the newline written after the old root element.
+                if self.file.read(1) != '\n':
+                    self.file.seek(-1, 1)
+                shutil.copyfileobj(self.file, f)
+        os.rename(temporary, self.filename)
+
+
+    def get_ongoing_events(self):
+        """Return events which were still ongoing at the end of the last run,
+        in the form accepted by NagiosLogReader.set_ongoing_events().
+
+        The event elements do not record the state of the object, so the
+        ongoing events cannot be recovered from the XML alone. They are read
+        from the Checkpoint given instead, without one we return an empty
+        list."""
+        if self.checkpoint is None:
+            return []
+        return self.checkpoint.get_ongoing_events()
+
+
+    def tell(self):
+        """Return the file offset at which the next event will be written."""
+        self.open_file()
+        return self.file.tell()
+
+
+    def output(self, event):
+        """Write the given event to the output file, see output_many()."""
+        self.output_many((event,))
+
+
+    def output_many(self, events):
+        """Write the given events to the output file with a single write.
+
+        The output is potentially rewritten to conform with XML requirements.
+
+        Raises ValueError if not all required attributes are set."""
+        # Straight-forwardly record found event data as a new XML element's
+        # attributes. Conditionally existing data must be handled more
+        # carefully. See NagiosLogReader.record_event for possible attributes.
+        self.open_file()
+        template = self.XML_EVENT
+        format_time = self.format_time
+        describe = self.describe
+        # The formatted times contain nothing to escape. The title contains
+        # 'host_name' or 'host_name svc_desc'.
+        self.file.write(''.join([template % (
+            format_time(event['timestamp_end']),
+            format_time(event['timestamp_start']),
+            xml_escape(event['title']),
+            xml_escape(describe(event)))
+            if event.get('kind') is None else self.overlay(event)
+            for event in events]))
+
+
+    def overlay(self, event):
+        """Return the element of an overlay event. Instant events, such as
+        notifications, are not duration events."""
+        return self.XML_OVERLAY % (
+            event['kind'],
+            event['timestamp_end'] != event['timestamp_start'] and
+            'true' or 'false',
+            self.format_time(event['timestamp_end']),
+            self.format_time(event['timestamp_start']),
+            xml_escape(event['title']),
+            xml_escape(self.describe(event)))
+
+
+    def sync(self, last_timestamp):
+        """Write the closing root tag and last_timestamp, so that the document
+        on disk is complete. The next event overwrites the closing tag."""
+        self.open_file()
+        offset = self.file.tell()
+        self.file.write(self.XML_FOOTER)
+        self.file.seek(self.root_offset)
+        self.file.write('%020d' % last_timestamp)
+        self.file.flush()
+        self.file.seek(offset)
+
+
+    def flush_file(self, last_timestamp):
+        """Writes the closing root tag and last_timestamp, then closes the
+        XML document."""
+        self.open_file()
+        self.file.write(self.XML_FOOTER)
+        self.file.seek(self.root_offset)
+        self.file.write('%020d' % last_timestamp)
+        self.file.close()
+        self.file = None
+        self.append = True
+        self.last_timestamp = last_timestamp
+
+
+class TimelineWriterJSON(TimelineWriter):
+    """Extends JSON-specific event attribute constraints.
+
+    Events are streamed to the output file as soon as they are given to
+    output(), one event object per line:
+        {"events": [
+        {"durationEvent": true, "end": ..., "start": ..., "title": ...},
+        ...
+        ],
+        "last_timestamp": 1256844672}
+    The last_timestamp follows the events, so that nothing written before
+    them needs to be rewritten when the file is flushed."""
+
+    JSON_HEADER = '{"events": ['
+    JSON_FOOTER = '\n],\n"last_timestamp": %d}\n'
+    JSON_EVENT = '{"description": %s, "durationEvent": true, ' + \
+                 '"end": "%s", "start": "%s", "title": %s}'
+    JSON_OVERLAY = '{"classname": "%s", "description": %s, ' + \
+                   '"durationEvent": %s, "end": "%s", "start": "%s", ' + \
+                   '"title": %s}'
+    RE_FOOTER = LazyPattern(r'\n\],\n"last_timestamp": (\d+)\}\n?$')
+
+    def __init__(self, filename, append=False, checkpoint=None):
+        """Create or append to JSON document filename.
+
+        If append is set to True, we will read the last_timestamp of the
+        document. The file itself is not opened until the first event is
+        written or flush_file() is called. When appending with a Checkpoint,
+        the document is truncated at its output offset."""
+        self.filename = filename
+        self.append = append
+        self.checkpoint = checkpoint
+        self.file = None
+        self.empty = True       # no events written into the document yet
+        self.last_timestamp = 0
+        self.footer = None      # offset of the footer of an old document
+        if append:
+            with open(filename, 'rb') as f:
+                f.seek(0, 2)
+                tail_offset = max(f.tell() - 4096, 0)
+                f.seek(tail_offset)
+                match = self.RE_FOOTER.search(f.read())
+            if not match:
+                raise ValueError, "JSON document does not contain " + \
+                      "last_timestamp and append mode requested."
+            self.last_timestamp = int(match.group(1))
+            self.footer = tail_offset + match.start()
+        elif File_exists(filename):
+            raise IOError, \
+                "File %s exists and not instructed to append." % filename
+
+
+    def open_file(self):
+        """Open the output file for writing, unless already opened.
+
+        A new document gets its header written. An existing document is
+        truncated before its footer, or at the output offset of the
+        Checkpoint."""
+        if self.file is not None:
+            return
+        if not self.append:
+            self.file = self.open_output()
+            self.file.write(self.JSON_HEADER)
+            return
+        self.file = open(self.filename, 'r+b')
+        offset = self.footer
+        if self.checkpoint is not None:
+            offset = self.checkpoint.output_offset
+            if offset is None or not \
+               len(self.JSON_HEADER) <= offset <= self.footer:
+                raise ValueError, \
+                    "Checkpoint does not match JSON document %s." % \
+                    self.filename
+        self.file.seek(offset - 1)
+        self.empty = self.file.read(1) == '['
+        self.file.truncate()
+
+
+    def get_ongoing_events(self):
+        """Return events which were still ongoing at the end of the last run,
+        in the form accepted by NagiosLogReader.set_ongoing_events().
+
+        As with TimelineWriterXML, these can only be read from a Checkpoint."""
+        if self.checkpoint is None:
+            return []
+        return self.checkpoint.get_ongoing_events()
+
+
+    def tell(self):
+        """Return the file offset at which the next event will be written."""
+        self.open_file()
+        return self.file.tell()
+
+
+    def encode(self, event):
+        """Return the event as a JSON object understood by Timeline.
+
+        The result equals json.dumps() of the object with sorted keys, but
+        only the title and description are passed through the json module:
+        the formatted times need no escaping. Overlay events carry their
+        kind as the classname, and instant ones are not duration events."""
+        if event.get('kind') is not None:
+            return self.JSON_OVERLAY % (
+                event['kind'],
+                json.dumps(json_text(self.describe(event))),
+                event['timestamp_end'] != event['timestamp_start'] and
+                'true' or 'false',
+                self.format_time(event['timestamp_end']),
+                self.format_time(event['timestamp_start']),
+                json.dumps(json_text(event['title'])))
+        return self.JSON_EVENT % (
+            json.dumps(json_text(self.describe(event))),
+            self.format_time(event['timestamp_end']),
+            self.format_time(event['timestamp_start']),
+            json.dumps(json_text(event['title'])))
+
+
+    def output(self, event):
+        """Write the given event to the output file, see output_many()."""
+        self.output_many((event,))
+
+
+    def output_many(self, events):
+        """Write the given events to the output file with a single write.
+
+        Raises ValueError if not all required attributes are set."""
+        if not events:
+            return
+        self.open_file()
+        if self.empty:
+            separator = '\n'
+            self.empty = False
+        else:
+            separator = ',\n'
+        encode = self.encode
+        self.file.write(separator +
+                        ',\n'.join([encode(event) for event in events]))
+
+
+    def sync(self, last_timestamp):
+        """Write the footer, so that the document on disk is complete. The
+        next event overwrites the footer."""
+        self.open_file()
+        offset = self.file.tell()
+        self.file.write(self.JSON_FOOTER % last_timestamp)
+        self.file.flush()
+        self.file.seek(offset)
+
+
+    def flush_file(self, last_timestamp):
+        """Writes the footer with last_timestamp and closes the document."""
+        self.open_file()
+        self.file.write(self.JSON_FOOTER % last_timestamp)
+        self.file.close()
+        self.file = None
+        self.append = True
+        self.footer = None
+        self.last_timestamp = last_timestamp
+
+
+
+class TimelineWriterJSONChunks(TimelineWriter):
+    """Splits JSON output into one document per day or week.
+
+    Each event goes to the TimelineWriterJSON document of the period its
+    timestamp_start falls into, named after the output file and the first
+    day of the period in UTC, e.g. nagios-20091029.json. The output file
+    itself becomes a small index of the documents:
+        {"chunks": [
+        {"end": ..., "events": 3, "file": "nagios-20091029.json",
+         "start": ...},
+        ...
+        ],
+        "last_timestamp": 1256844672}
+    At most MAX_OPEN documents are kept open at a time."""
+
+    PERIODS = {'day' : 86400, 'week' : 7 * 86400}
+    # The epoch was a Thursday, weeks are made to start on Mondays.
+    PERIOD_OFFSETS = {'day' : 0, 'week' : 3 * 86400}
+    MAX_OPEN = 8
+
+    def __init__(self, filename, append=False, checkpoint=None,
+                 period='day'):
+        """Create or append to the chunked JSON output indexed by filename.
+
+        Raises ValueError for unknown periods or if a Checkpoint is given:
+        chunked output cannot be truncated at a single offset."""
+        if period not in self.PERIODS:
+            raise ValueError, "Unknown chunk period %s" % period
+        if checkpoint is not None:
+            raise ValueError, "Chunked JSON output does not support " + \
+                  "checkpoints."
+        self.filename = filename
+        self.period = period
+        self.chunks = {}        # period start : index entry
+        self.writers = {}       # period start : open TimelineWriterJSON
+        self.used = {}          # period start : when last written to
+        self.uses = 0
+        self.evicted = set()    # period starts closed before flush_file()
+        self.last_timestamp = 0
+        if append:
+            with open(filename) as f:
+                index = json.load(f)
+            self.last_timestamp = index['last_timestamp']
+            for chunk in index['chunks']:
+                self.chunks[chunk['period']] = chunk
+        elif File_exists(filename):
+            raise IOError, \
+                "File %s exists and not instructed to append." % filename
+
+
+    def chunk_writer(self, timestamp):
+        """Return the index entry and open writer of the period timestamp
+        falls into."""
+        length = self.PERIODS[self.period]
+        offset = self.PERIOD_OFFSETS[self.period]
+        start = (int(timestamp) + offset) // length * length - offset
+        self.uses += 1
+        self.used[start] = self.uses
+        if start in self.writers:
+            return (self.chunks[start], self.writers[start])
+        if len(self.writers) >= self.MAX_OPEN:
+            # Close the document of the period written to longest ago, it
+            # will be appended to should it be needed again.
+            oldest = min(self.writers, key=self.used.get)
+            self.writers.pop(oldest).flush_file(self.last_timestamp)
+            self.evicted.add(oldest)
+        (base, ext) = os.path.splitext(self.filename)
+        if start not in self.chunks:
+            name = '%s-%s%s' % (base, time.strftime('%Y%m%d',
+                                                    time.gmtime(start)), ext)
+            self.chunks[start] = {
+                'period' : start,
+                'file' : os.path.basename(name),
+                'start' : self.format_time(start),
+                'end' : self.format_time(start + length),
+                'events' : 0}
+        chunk = self.chunks[start]
+        name = self.chunk_path(chunk)
+        self.writers[start] = TimelineWriterJSON(name, File_exists(name))
+        self.evicted.discard(start)
+        return (chunk, self.writers[start])
+
+
+    def chunk_path(self, chunk):
+        """Return the path of the document of an index entry."""
+        return os.path.join(os.path.dirname(self.filename), chunk['file'])
+
+
+    def get_ongoing_events(self):
+        """Ongoing events cannot be recovered without a Checkpoint."""
+        return []
+
+
+    def output(self, event):
+        """Write the given event into the document of its period."""
+        self.output_many((event,))
+
+
+    def output_many(self, events):
+        """Write the given events into the documents of their periods, each
+        run of events of the same period as a block."""
+        length = self.PERIODS[self.period]
+        offset = self.PERIOD_OFFSETS[self.period]
+        run = []
+        run_start = None
+        for event in events:
+            start = (int(event['timestamp_start']) + offset) // length
+            if start != run_start and run:
+                self.output_run(run)
+                run = []
+            run_start = start
+            run.append(event)
+        if run:
+            self.output_run(run)
+
+
+    def output_run(self, events):
+        """Write events of a single period into its document."""
+        (chunk, writer) = self.chunk_writer(events[0]['timestamp_start'])
+        chunk['events'] += len(events)
+        writer.output_many(events)
+
+
+    def flush_file(self, last_timestamp):
+        """Close all documents and write the index.
+
+        Documents closed earlier in the run were closed with the
+        last_timestamp of the previous run, so their footers are rewritten
+        with the one given."""
+        for writer in self.writers.itervalues():
+            writer.flush_file(last_timestamp)
+        self.writers = {}
+        for start in self.evicted:
+            TimelineWriterJSON(self.chunk_path(self.chunks[start]),
+                               True).flush_file(last_timestamp)
+        self.evicted = set()
+        chunks = []
+        for start in sorted(self.chunks):
+            chunks.append(json.dumps(self.chunks[start], sort_keys=True))
+        with open(self.filename, 'wb') as f:
+            f.write('{"chunks": [\n' + ',\n'.join(chunks) + \
+                    TimelineWriterJSON.JSON_FOOTER % last_timestamp)
+        self.last_timestamp = last_timestamp
+
+
+
+class TimelineWriterLevels(TimelineWriter):
+    """Writes the events at three levels of detail, for Timeline bands of
+    different zoom.
+
+    For an output file nagios.xml, the levels are written with writer_class
+    into
+        nagios-day.xml : the events of the last day as they are
+        nagios-month.xml : one event per host and hour of the last month
+        nagios-year.xml : one event per day of the last year
+    The periods end at the last_timestamp given to flush_file(). The hourly
+    and daily rollups count the outages overlapping their period, the
+    seconds of downtime within it, and the hosts involved, and carry the
+    worst state seen. See demo/levels.html for a page using them.
+
+    The events and rollups are kept in memory only for the length of their
+    level, so memory does not grow with the length of the logs. Nothing is
+    written until flush_file(), and the outputs are rewritten on each run,
+    so appending is not supported."""
+
+    LEVELS = [('day', 86400), ('month', 30 * 86400), ('year', 365 * 86400)]
+    # States from the least to the most severe
+    SEVERITY = ['WARNING', 'UNKNOWN', 'CRITICAL', 'UNREACHABLE', 'DOWN']
+
+    def __init__(self, filename, writer_class, append=False,
+                 checkpoint=None):
+        """Raises ValueError if asked to append or given a Checkpoint."""
+        if append or checkpoint is not None:
+            raise ValueError, "Level output does not support appending."
+        self.filename = filename
+        self.writer_class = writer_class
+        self.lengths = dict(self.LEVELS)
+        self.events = collections.deque()   # events of the last day
+        self.hours = {}         # (hour, host_name) : rollup of the month
+        self.days = {}          # day : rollup of the year
+        self.now = 0            # latest end seen
+        self.pruned = 0         # when rollups outside the levels were dropped
+
+
+    def level_file(self, level):
+        """Return the name of the output of level."""
+        (base, ext) = os.path.splitext(self.filename)
+        return '%s-%s%s' % (base, level, ext)
+
+
+    def output_many(self, events):
+        """Add the events to the raw events and rollups of each level."""
+        for event in events:
+            end = int(event['timestamp_end'])
+            if self.now < end:
+                self.now = end
+            self.events.append(event)
+            # Only outages are rolled up.
+            if event.get('kind') is not None:
+                continue
+            self.roll_up(event, self.hours, 3600, 'month',
+                         event['host_name'])
+            self.roll_up(event, self.days, 86400, 'year', None)
+        day = self.now - self.lengths['day']
+        while self.events and self.events[0]['timestamp_end'] < day:
+            self.events.popleft()
+        if self.now - self.pruned >= 86400:
+            self.prune(self.now)
+
+
+    def output(self, event):
+        self.output_many((event,))
+
+
+    def roll_up(self, event, rollups, period, level, host_name):
+        """Add the event to the rollups of each period it overlaps within
+        level. Rollups are keyed by period number, and host_name if not
+        None."""
+        start = int(event['timestamp_start'])
+        end = int(event['timestamp_end'])
+        horizon = self.now - self.lengths[level]
+        # Outages starting and ending within a second still count.
+        for number in xrange(max(start, horizon) // period,
+                             (max(end, start + 1) - 1) // period + 1):
+            key = number
+            if host_name is not None:
+                key = (number, host_name)
+            rollup = rollups.get(key)
+            if rollup is None:
+                rollup = rollups[key] = {'outages' : 0, 'seconds' : 0,
+                                         'hosts' : set(), 'severity' : 0}
+            rollup['outages'] += 1
+            rollup['seconds'] += min(end, (number + 1) * period) - \
+                                 max(start, number * period)
+            rollup['hosts'].add(event['host_name'])
+            if event['state'] in self.SEVERITY:
+                rollup['severity'] = max(rollup['severity'],
+                                         self.SEVERITY.index(event['state']))
+
+
+    def prune(self, now):
+        """Drop the rollups which have fallen out of their level."""
+        hour = (now - self.lengths['month']) // 3600
+        for key in [key for key in self.hours if key[0] < hour]:
+            del self.hours[key]
+        day = (now - self.lengths['year']) // 86400
+        for key in [key for key in self.days if key < day]:
+            del self.days[key]
+        self.pruned = now
+
+
+    def rollup_event(self, start, length, title, rollup):
+        """Return a rollup as an event for a TimelineWriter."""
+        minutes = rollup['seconds'] // 60
+        return {'timestamp_start' : start,
+                'timestamp_end' : start + length,
+                'host_name' : ', '.join(sorted(rollup['hosts'])),
+                'state' : self.SEVERITY[rollup['severity']],
+                'title' : title,
+                'description' : "%d outages, %d h %02d min down\n%s\n" % \
+                    (rollup['outages'], minutes // 60, minutes % 60,
+                     ', '.join(sorted(rollup['hosts'])))}
+
+
+    def write_level(self, level, events, last_timestamp):
+        """Write events into the output of level."""
+        writer = self.writer_class(self.level_file(level))
+        writer.configs = self.configs
+        writer.output_many(events)
+        writer.flush_file(last_timestamp)
+
+
+    def flush_file(self, last_timestamp):
+        """Write the outputs of all levels, ending at last_timestamp."""
+        self.prune(last_timestamp)
+        day = last_timestamp - self.lengths['day']
+        self.write_level('day', [event for event in self.events
+                                 if event['timestamp_end'] >= day],
+                         last_timestamp)
+        self.write_level('month', [
+            self.rollup_event(hour * 3600, 3600, '%s: %d outages' % \
+                              (host_name, rollup['outages']), rollup)
+            for ((hour, host_name), rollup) in sorted(self.hours.items())],
+                         last_timestamp)
+        self.write_level('year', [
+            self.rollup_event(number * 86400, 86400,
+                              '%d outages on %d hosts' % \
+                              (rollup['outages'], len(rollup['hosts'])),
+                              rollup)
+            for (number, rollup) in sorted(self.days.items())],
+                         last_timestamp)
+
+
+    def get_ongoing_events(self):
+        """Ongoing events are not recovered from level output."""
+        return []
+
+
+
+class TimelineWriterSQLite(TimelineWriter):
+    """Stores events in an SQLite database instead of an event source file.
+
+    The events table is indexed by (host_name, timestamp_start), svc_desc
+    and state. The kind column is NULL for outages. Each batch given to
+    output_many() is inserted in a single transaction, and the database
+    runs in WAL mode, so that it can be queried while being written to.
+    flush_file() records last_timestamp in the meta table and marks the
+    events ending at last_timestamp + 1 as ongoing. When appending, those
+    events are removed and returned by get_ongoing_events(), so that they
+    are continued like with the other writers.
+
+    export() regenerates Timeline documents for a subset of hosts and a
+    time window from the database, without reading the logs again."""
+
+    SCHEMA = [
+        'CREATE TABLE IF NOT EXISTS events (' + \
+            'id INTEGER PRIMARY KEY, ' + \
+            'host_name TEXT NOT NULL, svc_desc TEXT, state TEXT NOT NULL, ' + \
+            'timestamp_start INTEGER NOT NULL, ' + \
+            'timestamp_end INTEGER NOT NULL, ' + \
+            'plugin_start TEXT, plugin_end TEXT, ' + \
+            'ongoing INTEGER NOT NULL DEFAULT 0, kind TEXT)',
+        'CREATE INDEX IF NOT EXISTS events_host ' + \
+            'ON events (host_name, timestamp_start)',
+        'CREATE INDEX IF NOT EXISTS events_svc ON events (svc_desc)',
+        'CREATE INDEX IF NOT EXISTS events_state ON events (state)',
+        'CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)']
+    COLUMNS = ('host_name', 'svc_desc', 'state', 'timestamp_start',
+               'timestamp_end', 'plugin_start', 'plugin_end', 'kind')
+    INSERT = 'INSERT INTO events (%s) VALUES (%s)' % \
+             (', '.join(COLUMNS), ', '.join(['?'] * len(COLUMNS)))
+    # Events passed to the writer at a time by export()
+    BATCH_SIZE = 256
+
+    def __init__(self, filename, append=False, checkpoint=None):
+        """Create or append to the database filename.
+
+        The ongoing events of a Checkpoint take precedence over those marked
+        in the database. Either way, the events flushed as ongoing by the
+        previous run are removed.
+
+        Raises IOError if the file exists and append is not set."""
+        if not append and File_exists(filename):
+            raise IOError, \
+                "File %s exists and not instructed to append." % filename
+        self.filename = filename
+        self.checkpoint = checkpoint
+        self.db = sqlite3.connect(filename)
+        # Plugin output is not necessarily UTF-8, store it as is.
+        self.db.text_factory = str
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        for statement in self.SCHEMA:
+            self.db.execute(statement)
+        # Databases of earlier versions have no kind column.
+        columns = [row[1] for row in
+                   self.db.execute('PRAGMA table_info(events)')]
+        if 'kind' not in columns:
+            self.db.execute('ALTER TABLE events ADD COLUMN kind TEXT')
+        self.last_timestamp = 0
+        row = self.db.execute("SELECT value FROM meta " + \
+                              "WHERE key = 'last_timestamp'").fetchone()
+        if row is not None:
+            self.last_timestamp = int(row[0])
+        self.ongoing_events = []
+        if append:
+            self.ongoing_events = as_ongoing(
+                self.select("ongoing = 1", ()))
+            self.db.execute('DELETE FROM events WHERE ongoing = 1')
+        self.db.commit()
+        # Events stored by this run have larger ids
+        self.first_id = self.db.execute(
+            'SELECT COALESCE(MAX(id), 0) FROM events').fetchone()[0]
+
+
+    def select(self, where='1', parameters=(), order='id'):
+        """Yield the events matching the SQL condition where as Event
+        objects, ordered by order."""
+        cursor = self.db.execute(
+            'SELECT %s FROM events WHERE %s ORDER BY %s' % \
+            (', '.join(self.COLUMNS), where, order), parameters)
+        for (host_name, svc_desc, state, timestamp_start, timestamp_end,
+             plugin_start, plugin_end, kind) in cursor:
+            event = Event(timestamp_start, host_name, state, svc_desc,
+                          plugin_start, kind)
+            event.timestamp_end = timestamp_end
+            event.plugin_end = plugin_end
+            yield event
+
+
+    def get_ongoing_events(self):
+        """Return events which were still ongoing at the end of the last run,
+        in the form accepted by NagiosLogReader.set_ongoing_events()."""
+        if self.checkpoint is not None:
+            return self.checkpoint.get_ongoing_events()
+        return self.ongoing_events
+
+
+    def output(self, event):
+        """Store the given event, see output_many()."""
+        self.output_many((event,))
+
+
+    def output_many(self, events):
+        """Store the given events in a single transaction."""
+        self.db.executemany(self.INSERT, [
+            (event['host_name'], event.get('svc_desc'), event['state'],
+             int(event['timestamp_start']), int(event['timestamp_end']),
+             event.get('plugin_start'), event.get('plugin_end'),
+             event.get('kind'))
+            for event in events])
+        self.db.commit()
+
+
+    def set_last_timestamp(self, last_timestamp):
+        """Record last_timestamp in the meta table."""
+        self.db.execute("INSERT OR REPLACE INTO meta (key, value) " + \
+                        "VALUES ('last_timestamp', ?)", (last_timestamp,))
+        self.last_timestamp = last_timestamp
+
+
+    def sync(self, last_timestamp):
+        """Record last_timestamp, the events are committed already."""
+        self.set_last_timestamp(last_timestamp)
+        self.db.commit()
+
+
+    def flush_file(self, last_timestamp):
+        """Record last_timestamp, mark the events flushed as ongoing and
+        close the database."""
+        self.set_last_timestamp(last_timestamp)
+        self.db.execute('UPDATE events SET ongoing = 1 ' + \
+                        'WHERE id > ? AND timestamp_end = ?',
+                        (self.first_id, last_timestamp + 1))
+        self.db.commit()
+        self.db.close()
+
+
+    def export(self, writer, host_names=None, since=None, until=None,
+               host_filter=None, service_filter=None):
+        """Pass the stored events of host_names overlapping the window from
+        since to until to writer, then flush it with our last_timestamp.
+        The events may be narrowed down further by NameFilters of their
+        host and service names.
+
+        Any of the criteria may be None for all. The events are given in
+        the order they were stored, BATCH_SIZE at a time. Returns the
+        number of events exported."""
+        conditions = []
+        parameters = []
+        if host_names:
+            conditions.append('host_name IN (%s)' % \
+                              ', '.join(['?'] * len(host_names)))
+            parameters.extend(host_names)
+        if since is not None:
+            conditions.append('timestamp_end >= ?')
+            parameters.append(since)
+        if until is not None:
+            conditions.append('timestamp_start <= ?')
+            parameters.append(until)
+        events = self.select(' AND '.join(conditions) or '1', parameters)
+        count = 0
+        batch = []
+        for event in events:
+            if host_filter is not None and \
+               not host_filter.accepts(event.host_name):
+                continue
+            if event.svc_desc and service_filter is not None and \
+               not service_filter.accepts(event.svc_desc):
+                continue
+            batch.append(event)
+            if len(batch) >= self.BATCH_SIZE:
+                writer.output_many(batch)
+                count += len(batch)
+                batch = []
+        if batch:
+            writer.output_many(batch)
+            count += len(batch)
+        writer.flush_file(self.last_timestamp)
+        return count
+
+
+
+# The writer of each output format, by its name given to --format
+WRITERS = {'XML' : TimelineWriterXML,
+           'JSON' : TimelineWriterJSON,
+           'SQLITE' : TimelineWriterSQLite}
+
+
+def render(writer_class, events, last_timestamp, configs=None):
+    """Return the document a writer of writer_class writes of events, ending
+    at last_timestamp, without touching the file system."""
+    # No file is named '', so the writer does not refuse to create it.
+    writer = writer_class('')
+    writer.configs = configs
+    document = StringIO()
+    writer.open_output = lambda: document
+    writer.output_many(events)
+    writer.sync(last_timestamp)
+    return document.getvalue()
+
+
+def gzip_data(data):
+    """Return data compressed into the gzip format."""
+    compressed = StringIO()
+    f = gzip.GzipFile(fileobj=compressed, mode='wb')
+    f.write(data)
+    f.close()
+    return compressed.getvalue()
+
+
+
+class EventStore(TimelineWriter):
+    """Keeps the events output in memory, for TimelineService.
+
+    The events are ordered by their end, so that the events overlapping a
+    time window are found by bisecting for its start. Readers close events
+    in nearly that order, so adding one is usually an append."""
+
+    def __init__(self, filename=None, append=False, checkpoint=None):
+        self.events = []
+        self.ends = []
+        self.last_timestamp = 0
+
+
+    def output(self, event):
+        """Store the given event, see output_many()."""
+        self.output_many((event,))
+
+
+    def output_many(self, events):
+        """Store the given events in the order of their ends."""
+        for event in events:
+            end = event['timestamp_end']
+            i = bisect.bisect_right(self.ends, end)
+            self.ends.insert(i, end)
+            self.events.insert(i, event)
+
+
+    def window(self, since=None, until=None):
+        """Return the events overlapping the window from since to until,
+        either of which may be None."""
+        start = 0
+        if since is not None:
+            start = bisect.bisect_left(self.ends, since)
+        if until is None:
+            return self.events[start:]
+        return [event for event in self.events[start:]
+                if event['timestamp_start'] <= until]
+
+
+    def sync(self, last_timestamp=0):
+        self.last_timestamp = last_timestamp
+
+
+    def flush_file(self, last_timestamp=0):
+        self.last_timestamp = last_timestamp
+
+
+
+class ResponseCache(object):
+    """Keeps the size most recently used responses of a TimelineService.
+
+    Each response is stored with the tick of its last use, and the least
+    recently used one is evicted when the cache is full. Caches are small,
+    so finding it by a linear search is cheap next to rendering a
+    response."""
+
+    def __init__(self, size):
+        self.size = size
+        self.responses = {}     # key : [tick, response]
+        self.tick = 0
+        self.hits = 0
+        self.misses = 0
+
+
+    def get(self, key):
+        """Return the response cached for key, or None."""
+        entry = self.responses.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.tick += 1
+        entry[0] = self.tick
+        return entry[1]
+
+
+    def put(self, key, response):
+        """Cache response for key, evicting the least recently used one if
+        the cache is full."""
+        if self.size <= 0:
+            return
+        if key not in self.responses and len(self.responses) >= self.size:
+            oldest = min(self.responses.iteritems(),
+                         key=lambda item: item[1][0])[0]
+            del self.responses[oldest]
+        self.tick += 1
+        self.responses[key] = [self.tick, response]
+
+
+    def clear(self):
+        self.responses.clear()
+
+
+
+class TimelineService(object):
+    """Answers Timeline event source requests from the resident state of a
+    NagiosLogReader, for serve mode.
+
+    All but the last of the logs given are read once. The last one is
+    followed as in follow mode, reading whatever Nagios appended to it
+    before answering each request, and any new data clears the
+    ResponseCache. A response is an XML or JSON document of the closed and
+    still ongoing events overlapping a time window, narrowed down by host
+    and service patterns and states given as query parameters:
+        /events.xml?since=2009-10-29&host=lc2-*&state=DOWN,CRITICAL
+    Each response carries an ETag, so that reloads of an unchanged document
+    are answered with 304 Not Modified, and is compressed with gzip for
+    clients which accept it, under an ETag of its own. Responses are cached
+    as compressed and uncompressed bodies.
+
+    The reader is not thread-safe, so requests are answered one at a time.
+    Answering from the cache only takes a refresh and a lookup."""
+    PATHS = {'/events.xml' : (TimelineWriterXML, 'text/xml; charset=utf-8'),
+             '/events.json' : (TimelineWriterJSON,
+                               'application/json; charset=utf-8')}
+    # Query parameters taking NameFilter patterns, see parse_query()
+    PATTERNS = ('host', 'exclude_host', 'service', 'exclude_service')
+
+    def __init__(self, filenames, options, configs=None, cache_size=64):
+        self.store = EventStore()
+        self.reader = NagiosLogReader(self.store, options)
+        self.configs = configs
+        self.cache = ResponseCache(cache_size)
+        self.lock = threading.Lock()
+        for filename in filenames[:-1]:
+            self.reader.process(filename)
+        self.follower = LogFollower(self.reader, filenames[-1])
+        self.position = None
+        self.refresh()
+
+
+    def refresh(self):
+        """Read the data appended to the followed log since the last
+        refresh, clearing the cache if there was any."""
+        follower = self.follower
+        follower.read()
+        follower.reopen_if_rotated()
+        follower.read()
+        self.reader.flush_pending()
+        position = (os.fstat(follower.fd).st_ino, follower.offset)
+        if position != self.position:
+            self.position = position
+            self.cache.clear()
+
+
+    def parse_query(self, query):
+        """Return the parameters of the query string query as a tuple
+        (since, until, patterns, states), where patterns has a tuple of
+        patterns for each of PATTERNS.
+
+        Raises ValueError for unknown parameters, invalid times and
+        patterns."""
+        since = until = None
+        patterns = dict((name, ()) for name in self.PATTERNS)
+        states = ()
+        for (name, values) in sorted(urlparse.parse_qs(query).iteritems()):
+            if name in ('since', 'until'):
+                timestamp = to_timestamp(values[-1])
+                if name == 'since':
+                    since = timestamp
+                else:
+                    until = timestamp
+            elif name in patterns:
+                patterns[name] = tuple(sorted(values))
+            elif name == 'state':
+                states = tuple(sorted(set(state.strip().upper()
+                                          for value in values
+                                          for state in value.split(',')
+                                          if state.strip())))
+            else:
+                raise ValueError, "unknown parameter %s" % name
+        # Invalid regular expressions are rejected here.
+        NameFilter(patterns['host'], patterns['exclude_host'])
+        NameFilter(patterns['service'], patterns['exclude_service'])
+        return (since, until,
+                tuple(patterns[name] for name in self.PATTERNS), states)
+
+
+    def respond(self, path, query, gzip_accepted=False, etag=None):
+        """Return the status, headers and body of the response to a GET of
+        path with the query string query.
+
+        The body is compressed if gzip_accepted, and its ETag then has a
+        "-gz" suffix, so that caches never take one encoding for the other.
+        A request whose etag matches that of the response is answered with
+        an empty body and status 304."""
+        if path not in self.PATHS:
+            return (404, [('Content-Type', 'text/plain')],
+                    "No such event source %s\n" % path)
+        try:
+            parameters = self.parse_query(query)
+        except ValueError, e:
+            return (400, [('Content-Type', 'text/plain')], "%s\n" % e)
+        key = (path, parameters)
+        with self.lock:
+            self.refresh()
+            response = self.cache.get(key)
+            if response is None:
+                response = self.render(path, parameters)
+                self.cache.put(key, response)
+        (tag, body, compressed) = response
+        if gzip_accepted:
+            tag = tag[:-1] + '-gz"'
+        headers = [('Content-Type', self.PATHS[path][1]),
+                   ('ETag', tag),
+                   ('Cache-Control', 'no-cache'),
+                   ('Vary', 'Accept-Encoding'),
+                   ('Access-Control-Allow-Origin', '*')]
+        if etag == tag:
+            return (304, headers, '')
+        if gzip_accepted:
+            headers.append(('Content-Encoding', 'gzip'))
+            body = compressed
+        return (200, headers, body)
+
+
+    def events(self, parameters):
+        """Return the events selected by parameters, as returned by
+        parse_query(). Ongoing events end after the last timestamp seen, as
+        when flushed by NagiosLogReader.flush_events()."""
+        (since, until, patterns, states) = parameters
+        (host, exclude_host, service, exclude_service) = patterns
+        host_filter = service_filter = None
+        if host or exclude_host:
+            host_filter = NameFilter(host, exclude_host)
+        if service or exclude_service:
+            service_filter = NameFilter(service, exclude_service)
+        end = self.reader.last_timestamp + 1
+        events = self.store.window(since, until)
+        if since is None or end >= since:
+            for event in self.reader.ongoing_events.itervalues():
+                if until is None or event['timestamp_start'] <= until:
+                    event = dict(event)
+                    event['timestamp_end'] = end
+                    events.append(event)
+        return [item for item in events
+                if (host_filter is None or
+                    host_filter.accepts(item['host_name'])) and
+                   (service_filter is None or not item.get('svc_desc') or
+                    service_filter.accepts(item['svc_desc'])) and
+                   (not states or item['state'] in states)]
+
+
+    def render(self, path, parameters):
+        """Return the ETag, body and compressed body of the response to a
+        request of path with parameters."""
+        body = render(self.PATHS[path][0], self.events(parameters),
+                      self.reader.last_timestamp, self.configs)
+        tag = '"%s"' % hashlib.md5(body).hexdigest()
+        return (tag, body, gzip_data(body))
+
+
+    def close(self):
+        self.follower.close()
+
+
+
+def http_server(address, service, verbose=False):
+    """Return a server answering HTTP requests from service on address, in a
+    thread per connection. Requests are logged if verbose.
+
+    BaseHTTPServer and SocketServer take longer to import than the rest of
+    the module, so they are imported, and the classes based on them
+    defined, only when serving."""
+    import BaseHTTPServer
+    import SocketServer
+
+    class TimelineRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+        """Answers GET requests from the TimelineService of the server.
+
+        Connections are kept alive, so that the periodic reloads of a
+        Timeline page do not reconnect each time. Responses are buffered and
+        Nagle's algorithm is disabled, so that no part of a response waits
+        for the delayed acknowledgement of the previous one."""
+        server_version = 'Nagios2Timeline/' + __version__
+        protocol_version = 'HTTP/1.1'
+        wbufsize = -1
+        disable_nagle_algorithm = True
+
+        def do_GET(self):
+            (path, separator, query) = self.path.partition('?')
+            gzip_accepted = 'gzip' in self.headers.get('Accept-Encoding', '')
+            (status, headers, body) = self.server.service.respond(
+                path, query, gzip_accepted,
+                self.headers.get('If-None-Match'))
+            self.send_response(status)
+            for (name, value) in headers:
+                self.send_header(name, value)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+
+        def log_message(self, format, *args):
+            """Log requests only if the server is verbose."""
+            if self.server.verbose:
+                BaseHTTPServer.BaseHTTPRequestHandler.log_message(
+                    self, format, *args)
+
+
+    class TimelineHTTPServer(SocketServer.ThreadingMixIn,
+                             BaseHTTPServer.HTTPServer):
+        daemon_threads = True
+        allow_reuse_address = True
+
+    server = TimelineHTTPServer(address, TimelineRequestHandler)
+    server.service = service
+    server.verbose = verbose
+    return server
 
-    Under development."""
-    pass
 
 
 def demo():
@@ -0,0 +1,881 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+"""Benchmarks for the Nagios2Timeline module.
+
+The benchmarks operate on copies of ``examples/nagios.log'' concatenated
+until the requested size is reached. The timestamps of each copy are shifted
+by one day, so the resulting log looks like a long archive to the reader.
+With --synthetic, they operate on a log generated by synthetic_log() for a
+given number of hosts, services and days instead.
+
+Copyright: GPL version 3 or later. See the file LICENSE for details."""
+from __future__ import with_statement
+import bz2
+import collections
+import gzip
+import heapq
+import httplib
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urlparse
+from optparse import OptionParser, OptionGroup
+import Nagios2Timeline
+try:
+    import json
+except ImportError:
+    import simplejson as json
+__author__ = 'Pervilä <pervila@cs.helsinki.fi>'
+
+EXAMPLE_LOG = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           'examples', 'nagios.log')
+
+# The figures of each benchmark run, by name, for --json and --compare
+RESULTS = {}
+# The Timeline event sources requested by load_test()
+LOAD_PATHS = ['/events.xml', '/events.json', '/events.xml?state=CRITICAL',
+              '/events.json?state=DOWN,UNREACHABLE', '/events.xml?service=SSH',
+              '/events.xml?host=re:[0-9]$']
+# The server and load of the serve benchmark, see --url
+LOAD = {'url' : None, 'clients' : 8, 'requests' : 2000}
+# The command line tool run by the startup benchmark
+TOOL = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'N2T-tool.py')
+# The time importing the module may take, in seconds
+IMPORT_BUDGET = 0.02
+# Modules which the module imports only when needed, see LazyModule
+LAZY_MODULES = ['BaseHTTPServer', 'SocketServer', 'bz2', 'collections',
+                'ctypes', 'gzip', 'hashlib', 'json', 'multiprocessing',
+                'numpy', 'optparse', 'shutil', 'sqlite3', 'threading',
+                'urlparse', 'xml']
+
+
+class NullWriter(Nagios2Timeline.TimelineWriter):
+    """Discards all events, so that only the reader is measured."""
+
+    def output(self, event):
+        pass
+
+
+def scaled_log(filename, size_mb):
+    """Write copies of the example log into filename until it is at least
+    size_mb megabytes large."""
+    with open(EXAMPLE_LOG) as f:
+        lines = f.readlines()
+    # Split each line into its timestamp and the rest only once.
+    lines = [(int(line[1:line.index(']')]), line[line.index(']'):])
+             for line in lines]
+    limit = size_mb * 1024 * 1024
+    size = 0
+    shift = 0
+    with open(filename, 'w') as f:
+        while size < limit:
+            block = ''.join(['[%d%s' % (t + shift, rest) for (t, rest) in lines])
+            f.write(block)
+            size += len(block)
+            shift += 86400
+
+
+def example_outputs():
+    """Return the plugin outputs of examples/nagios.log as a dictionary of
+    service descriptions, or None for hosts, to pairs of lists of the
+    outputs of OK or UP states and of the other states."""
+    outputs = {}
+    with open(EXAMPLE_LOG) as f:
+        for line in f:
+            if ' HOST ALERT: ' in line or ' CURRENT HOST STATE: ' in line:
+                (host_name, state, kind, attempt, output) = \
+                            line[line.index(': ') + 2:-1].split(';', 4)
+                svc_desc = None
+            elif ' SERVICE ALERT: ' in line or \
+                 ' CURRENT SERVICE STATE: ' in line:
+                (host_name, svc_desc, state, kind, attempt, output) = \
+                            line[line.index(': ') + 2:-1].split(';', 5)
+            else:
+                continue
+            (ok, failed) = outputs.setdefault(svc_desc, ([], []))
+            if state in ('OK', 'UP'):
+                ok.append(output)
+            else:
+                failed.append(output)
+    # Keep the services seen both working and failing.
+    for (svc_desc, (ok, failed)) in outputs.items():
+        if not (ok and failed):
+            del outputs[svc_desc]
+    return outputs
+
+
+def synthetic_log(filename, hosts=100, services=10, failure_rate=0.002,
+                  flapping=0.05, days=30, seed=1):
+    """Write a synthetic Nagios log into filename, with the line shapes and
+    plugin outputs of examples/nagios.log.
+
+    Each of the hosts runs services services, every one of which fails with
+    the probability failure_rate in each hour of days days. Hosts go down
+    with the same probability per hour, taking their services with them.
+    The failures of the flapping fraction of the services come in bursts of
+    short outages with flapping notices. Each day starts with a rotation and
+    the current state of every host and service.
+
+    Return the number of outages written, which is the number of events the
+    log should result in."""
+    rng = random.Random(seed)
+    outputs = example_outputs()
+    (host_ok, host_down) = outputs.pop(None)
+    svc_names = sorted(outputs)
+    start = 1256767200
+    names = ['host-%d.cs.helsinki.fi' % i for i in range(hosts)]
+    checks = [(host_name, svc_desc)
+              for host_name in names
+              for svc_desc in [svc_names[i % len(svc_names)] +
+                               ('-%d' % (i // len(svc_names)) if
+                                i >= len(svc_names) else '')
+                               for i in range(services)]]
+    flappy = set(rng.sample(checks, int(len(checks) * flapping)))
+    services_of = dict([(host_name, []) for host_name in names])
+    for check in checks:
+        services_of[check[0]].append(check)
+    # Each check maps to the end of its latest outage, and its state and
+    # output while it lasts.
+    latest = dict([(check, (start, start, 'OK', '')) for check in
+                   checks + [(host_name, None) for host_name in names]])
+    # Lines waiting to be written, as (timestamp, sequence, line).
+    lines = []
+    seq = [0]
+    def add(timestamp, line):
+        seq[0] += 1
+        heapq.heappush(lines, (timestamp, seq[0], '[%d] %s\n' % (timestamp,
+                                                                  line)))
+    def base(svc_desc):
+        return svc_desc.rsplit('-', 1)[0] if svc_desc not in outputs else \
+               svc_desc
+    def outage(check, begin, length, state, output, recovery):
+        (host_name, svc_desc) = check
+        end = begin + length
+        latest[check] = (begin, end, state, output)
+        if svc_desc is None:
+            add(begin, 'HOST ALERT: %s;%s;SOFT;1;%s' % (host_name, state,
+                                                        output))
+            add(begin + 60, 'HOST ALERT: %s;%s;HARD;2;%s' % (host_name, state,
+                                                             output))
+            add(end, 'HOST ALERT: %s;UP;HARD;1;%s' % (host_name, recovery))
+        else:
+            add(begin, 'SERVICE ALERT: %s;%s;%s;SOFT;1;%s' % (
+                host_name, svc_desc, state, output))
+            add(begin + 60, 'SERVICE NOTIFICATION: nagiosadmin;%s;%s;%s;' \
+                'notify-service-by-email;%s' % (host_name, svc_desc, state,
+                                                output))
+            add(end, 'SERVICE ALERT: %s;%s;OK;HARD;1;%s' % (
+                host_name, svc_desc, recovery))
+    outages = 0
+    with open(filename, 'w') as f:
+        for day in range(days):
+            now = start + day * 86400
+            add(now, 'LOG ROTATION: DAILY')
+            add(now, 'LOG VERSION: 2.0')
+            for check in sorted(latest):
+                (begin, end, state, output) = latest[check]
+                (host_name, svc_desc) = check
+                if not begin <= now < end:
+                    (state, output) = ('OK', rng.choice(
+                        host_ok if svc_desc is None else
+                        outputs[base(svc_desc)][0]))
+                if svc_desc is None:
+                    add(now, 'CURRENT HOST STATE: %s;%s;HARD;1;%s' % (
+                        host_name, state == 'OK' and 'UP' or state, output))
+                else:
+                    add(now, 'CURRENT SERVICE STATE: %s;%s;%s;HARD;1;%s' % (
+                        host_name, svc_desc, state, output))
+            for hour in range(24):
+                now = start + day * 86400 + hour * 3600
+                add(now + 1800, 'Auto-save of retention data completed ' \
+                    'successfully.')
+                for host_name in names:
+                    if latest[(host_name, None)][1] >= now or \
+                       rng.random() >= failure_rate:
+                        continue
+                    begin = now + rng.randint(0, 3599)
+                    length = rng.randint(120, 7200)
+                    outage((host_name, None), begin, length, 'DOWN',
+                           rng.choice(host_down), rng.choice(host_ok))
+                    outages += 1
+                    # The services of the host fail while it is down.
+                    for check in services_of[host_name]:
+                        if latest[check][1] < begin:
+                            (ok, failed) = outputs[base(check[1])]
+                            outage(check, begin + 30, length - 60, 'CRITICAL',
+                                   rng.choice(failed), rng.choice(ok))
+                            outages += 1
+                for check in checks:
+                    if latest[check][1] >= now or \
+                       latest[(check[0], None)][1] >= now or \
+                       rng.random() >= failure_rate:
+                        continue
+                    (ok, failed) = outputs[base(check[1])]
+                    begin = now + rng.randint(0, 3599)
+                    state = rng.choice(('WARNING', 'CRITICAL', 'CRITICAL'))
+                    if check not in flappy:
+                        outage(check, begin, rng.randint(60, 3600), state,
+                               rng.choice(failed), rng.choice(ok))
+                        outages += 1
+                        continue
+                    add(begin, 'SERVICE FLAPPING ALERT: %s;%s;STARTED; ' \
+                        'Service appears to have started flapping' % check)
+                    for i in range(rng.randint(3, 8)):
+                        outage(check, begin, rng.randint(60, 300), state,
+                               rng.choice(failed), rng.choice(ok))
+                        outages += 1
+                        begin = latest[check][1] + rng.randint(60, 600)
+                    add(begin, 'SERVICE FLAPPING ALERT: %s;%s;STOPPED; ' \
+                        'Service appears to have stopped flapping' % check)
+                    latest[check] = (begin, begin, 'OK', '')
+            # Lines of outages still open at midnight go into the next day.
+            midnight = start + (day + 1) * 86400
+            if day == days - 1:
+                midnight = None
+            while lines and (midnight is None or lines[0][0] < midnight):
+                f.write(heapq.heappop(lines)[2])
+    return outages
+
+
+def legacy_process(reader, filename):
+    """The regexp-based NagiosLogReader.process() of version 1."""
+    with open(filename) as f:
+        linenum = 0
+        for line in f:
+            linenum += 1
+            match = None
+            if not reader.options.services:
+                match = reader.RE_HOST.match(line)
+            if not (match or reader.options.hosts):
+                match = reader.RE_SVC.match(line)
+            if match:
+                state = match.group(reader.RE_INDEX_STATE)
+                if (state == 'OK' or state == 'UP') or \
+                   ((state in \
+                     reader.HOST_NONOK_STATES + reader.SVC_NONOK_STATES) and \
+                    not reader.get_config(state)):
+                    reader.events_seen += 1
+                    svc = match.group(reader.RE_INDEX_SVC)
+                    if svc == ';':
+                        svc = None
+                    try:
+                        reader.record_event(
+                            match.group(reader.RE_INDEX_TIME),
+                            match.group(reader.RE_INDEX_HOST),
+                            state,
+                            svc,
+                            match.group(reader.RE_INDEX_PLUG))
+                    except Warning:
+                        pass
+                    except ValueError:
+                        pass
+
+
+def new_reader(*args):
+    """Return a NagiosLogReader with a NullWriter, and default options
+    unless other arguments are given."""
+    (options, args) = Nagios2Timeline.optparser().parse_args(list(args))
+    return Nagios2Timeline.NagiosLogReader(NullWriter(None), options)
+
+
+def measure(function, *args):
+    """Return the wall-clock time taken by function(*args) in seconds."""
+    start = time.time()
+    function(*args)
+    return time.time() - start
+
+
+def record(name, **figures):
+    """Keep the figures of a benchmark for saving with --json."""
+    RESULTS[name] = figures
+
+
+def report(name, seconds, size):
+    """Print a line of results for a benchmark."""
+    print "%-24s %8.2f s %8.1f MB/s" % \
+          (name, seconds, size / 1048576.0 / seconds)
+    record(name, seconds=seconds, mb_per_s=size / 1048576.0 / seconds)
+
+
+def bench_parser(logfile):
+    """Compare the regexp parser of version 1 against process()."""
+    size = os.path.getsize(logfile)
+    reader = new_reader()
+    report('parser: regexp', measure(legacy_process, reader, logfile), size)
+    legacy_events = reader.events_seen
+    reader = new_reader()
+    report('parser: tokenizer', measure(reader.process, logfile), size)
+    if reader.events_seen != legacy_events:
+        sys.stderr.write("Error: parsers disagree on the number of events\n")
+
+
+def legacy_format_time(timestamp):
+    """TimelineWriter.format_time() of version 1, without caching."""
+    return time.strftime("%b %d %Y %H:%M:%S GMT%z",
+                         time.gmtime(int(timestamp)))
+
+
+class TimestampWriter(Nagios2Timeline.TimelineWriter):
+    """Records the timestamps format_time() would be called for."""
+
+    def __init__(self, filename=None):
+        self.timestamps = []
+
+
+    def output(self, event):
+        self.timestamps.append(event['timestamp_start'])
+        self.timestamps.append(event['timestamp_end'])
+
+
+def bench_format(logfile):
+    """Compare formatting the timestamps of the events in logfile with and
+    without the caches of format_time()."""
+    (options, args) = Nagios2Timeline.optparser().parse_args([])
+    writer = TimestampWriter()
+    Nagios2Timeline.NagiosLogReader(writer, options).process(logfile)
+    # Repeat the timestamps to get measurable times on small logs.
+    timestamps = writer.timestamps * 10
+    def run(function):
+        for timestamp in timestamps:
+            function(timestamp)
+    for (name, function) in (('format: strftime', legacy_format_time),
+                             ('format: cached', writer.format_time)):
+        writer.hour_cache.clear()
+        seconds = measure(run, function)
+        print "%-24s %8.2f s %8.0f calls/s" % \
+              (name, seconds, len(timestamps) / seconds)
+        record(name, seconds=seconds, calls_per_s=len(timestamps) / seconds)
+
+
+def line_process(reader, filename):
+    """NagiosLogReader.process() of version 2, iterating over every line."""
+    with open(filename) as f:
+        reader.feed(f, filename)
+
+
+def bench_input(logfile):
+    """Compare reading a plain log line by line and memory-mapped, and
+    reading gzip and bzip2 compressed copies of it."""
+    size = os.path.getsize(logfile)
+    archives = [(logfile + '.gz', gzip.GzipFile),
+                (logfile + '.bz2', bz2.BZ2File)]
+    for (archive, opener) in archives:
+        with open(logfile, 'rb') as source:
+            target = opener(archive, 'wb')
+            try:
+                shutil.copyfileobj(source, target, 1 << 20)
+            finally:
+                target.close()
+    try:
+        reader = new_reader()
+        report('input: lines', measure(line_process, reader, logfile), size)
+        for (name, filename) in (('input: mmap', logfile),
+                                 ('input: gzip', archives[0][0]),
+                                 ('input: bzip2', archives[1][0])):
+            reader = new_reader()
+            report(name, measure(reader.process, filename), size)
+    finally:
+        for (archive, opener) in archives:
+            os.remove(archive)
+
+
+class EventWriter(Nagios2Timeline.TimelineWriter):
+    """Collects the events of the log for the writer benchmarks."""
+
+    def __init__(self, filename=None):
+        self.events = []
+
+
+    def output(self, event):
+        self.events.append(event)
+
+
+def write_events(writer, events, batch_size):
+    """Pass events to writer batch_size at a time, one by one through
+    output() for a batch_size of 1."""
+    if batch_size == 1:
+        for event in events:
+            writer.output(event)
+    else:
+        for i in xrange(0, len(events), batch_size):
+            writer.output_many(events[i:i + batch_size])
+    writer.flush_file(0)
+
+
+def bench_writers(logfile):
+    """Compare writing the events of logfile one at a time through output()
+    and in batches through output_many()."""
+    (options, args) = Nagios2Timeline.optparser().parse_args([])
+    collector = EventWriter()
+    reader = Nagios2Timeline.NagiosLogReader(collector, options)
+    reader.process(logfile)
+    reader.flush_events()
+    events = collector.events
+    (fd, output) = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        for (name, writer_class) in (
+                ('XML', Nagios2Timeline.TimelineWriterXML),
+                ('JSON', Nagios2Timeline.TimelineWriterJSON)):
+            for batch_size in (1, options.batch_size):
+                os.remove(output)
+                writer = writer_class(output)
+                seconds = measure(write_events, writer, events, batch_size)
+                label = 'writer: %s, batch %d' % (name, batch_size)
+                print "%-24s %8.2f s %8.0f events/s" % \
+                      (label, seconds, len(events) / seconds)
+                record(label, seconds=seconds,
+                       events_per_s=len(events) / seconds)
+    finally:
+        if os.path.exists(output):
+            os.remove(output)
+
+
+def resident_size():
+    """Return the resident set size of this process in bytes (Linux)."""
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def in_child(function, *args):
+    """Return function(*args) computed in a forked child process, so that
+    memory measurements do not disturb each other."""
+    (r, w) = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(r)
+        os.write(w, repr(function(*args)))
+        os._exit(0)
+    os.close(w)
+    result = ''
+    while True:
+        data = os.read(r, 4096)
+        if not data:
+            break
+        result += data
+    os.close(r)
+    os.waitpid(pid, 0)
+    return eval(result)
+
+
+def ongoing_memory(count, legacy):
+    """Return the bytes per ongoing event of count services failing at once,
+    recorded as dictionaries keyed by strings as in version 1, or through
+    record_event()."""
+    reader = new_reader()
+    lines = [('host-%d.cs.helsinki.fi' % (i // 20), 'rpcbind-%d' % (i % 20),
+              'CRITICAL: RPC program 100000 version 2 udp is not running')
+             for i in range(count)]
+    before = resident_size()
+    if legacy:
+        ongoing_events = {}
+        for (host_name, svc_desc, plugin_output) in lines:
+            # The names are taken from regexp matches, so each event holds
+            # its own copies of them in version 1.
+            identifier = host_name + ' ' + svc_desc
+            ongoing_events[identifier] = {
+                'timestamp_start' : 1256844672,
+                'host_name' : ''.join(host_name),
+                'state' : ''.join('CRITICAL'),
+                'title' : identifier,
+                'svc_desc' : ''.join(svc_desc),
+                'plugin_start' : ''.join(plugin_output)}
+    else:
+        for (host_name, svc_desc, plugin_output) in lines:
+            reader.record_event(1256844672, ''.join(host_name), 'CRITICAL',
+                                ''.join(svc_desc), ''.join(plugin_output))
+    return (resident_size() - before) / float(count)
+
+
+def bench_memory(logfile):
+    """Compare the memory used per ongoing event by the dictionaries of
+    version 1 and by Event records."""
+    count = 200000
+    for (name, legacy) in (('memory: dict', True),
+                           ('memory: Event', False)):
+        size = in_child(ongoing_memory, count, legacy)
+        print "%-24s %8.0f bytes per ongoing event" % (name, size)
+        record(name, bytes_per_event=size)
+
+
+def convert(logfile, output, writer_class):
+    """Convert logfile into output with a writer of writer_class, or without
+    writing for None. Return the seconds taken, the number of events and the
+    peak resident set size in bytes."""
+    (options, args) = Nagios2Timeline.optparser().parse_args([])
+    if writer_class is None:
+        writer = NullWriter(None)
+    else:
+        writer = writer_class(output)
+    start = time.time()
+    reader = Nagios2Timeline.NagiosLogReader(writer, options)
+    reader.process(logfile)
+    reader.flush_events()
+    seconds = time.time() - start
+    # ru_maxrss is in kilobytes on Linux.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return (seconds, reader.events_output, peak)
+
+
+def count_lines(filename):
+    """Return the number of lines in filename."""
+    lines = 0
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), ''):
+            lines += block.count('\n')
+    return lines
+
+
+def bench_throughput(logfile):
+    """Measure the lines and events per second and the peak memory of
+    converting logfile with each writer, each in a child process of its
+    own."""
+    lines = count_lines(logfile)
+    directory = tempfile.mkdtemp()
+    try:
+        for (name, writer_class, suffix) in (
+                ('reader', None, ''),
+                ('XML', Nagios2Timeline.TimelineWriterXML, '.xml'),
+                ('JSON', Nagios2Timeline.TimelineWriterJSON, '.json'),
+                ('SQLite', Nagios2Timeline.TimelineWriterSQLite, '.db')):
+            output = os.path.join(directory, 'output' + suffix)
+            (seconds, events, peak) = in_child(convert, logfile, output,
+                                               writer_class)
+            label = 'throughput: %s' % name
+            print "%-24s %8.2f s %9.0f lines/s %8.0f events/s %6.1f MB peak" % \
+                  (label, seconds, lines / seconds, events / seconds,
+                   peak / 1048576.0)
+            record(label, seconds=seconds, lines_per_s=lines / seconds,
+                   events_per_s=events / seconds, peak_rss=peak)
+    finally:
+        shutil.rmtree(directory)
+
+
+def load_test(address, clients, requests, revalidate=True):
+    """Send requests GETs of LOAD_PATHS in turn from clients concurrent
+    keep-alive connections to the server at address, a (host, port) tuple,
+    accepting gzip. With revalidate, each client sends back the ETag it got
+    for a path, as the reloads of a Timeline page do. Return the seconds
+    taken, the sorted latencies of the requests and the number of
+    responses of each status."""
+    latencies = []
+    statuses = collections.defaultdict(int)
+    lock = threading.Lock()
+    def client(count):
+        connection = httplib.HTTPConnection(*address)
+        etags = {}
+        for i in xrange(count):
+            path = LOAD_PATHS[i % len(LOAD_PATHS)]
+            headers = {'Accept-Encoding' : 'gzip'}
+            if revalidate and path in etags:
+                headers['If-None-Match'] = etags[path]
+            start = time.time()
+            connection.request('GET', path, headers=headers)
+            response = connection.getresponse()
+            response.read()
+            latency = time.time() - start
+            etags[path] = response.getheader('ETag')
+            with lock:
+                latencies.append(latency)
+                statuses[response.status] += 1
+        connection.close()
+    threads = [threading.Thread(target=client, args=(requests // clients,))
+               for i in range(clients)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    latencies.sort()
+    return (time.time() - start, latencies, dict(statuses))
+
+
+def report_load(name, seconds, latencies, statuses):
+    """Print and record the requests per second and latencies of a
+    load_test()."""
+    count = len(latencies)
+    median = latencies[count // 2]
+    p99 = latencies[min(count - 1, count * 99 // 100)]
+    print "%-24s %8.0f requests/s %7.1f ms median %7.1f ms 99%% %s" % \
+          (name, count / seconds, median * 1000, p99 * 1000,
+           ' '.join('%d:%d' % item for item in sorted(statuses.items())))
+    record(name, requests_per_s=count / seconds, median_ms=median * 1000,
+           p99_ms=p99 * 1000)
+
+
+def bench_serve(logfile):
+    """Load-test serve mode on logfile in this process, or the instance at
+    LOAD['url'] if given: fetching cached responses, revalidating them as
+    page reloads do, and rendering every response anew."""
+    url = LOAD['url']
+    service = server = None
+    if url is None:
+        (options, args) = Nagios2Timeline.optparser().parse_args([])
+        service = Nagios2Timeline.TimelineService([logfile], options)
+        server = Nagios2Timeline.http_server(('127.0.0.1', 0),
+                                             service)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        address = server.server_address
+    else:
+        location = urlparse.urlparse(url)
+        address = (location.hostname, location.port or 80)
+    try:
+        clients = LOAD['clients']
+        requests = LOAD['requests']
+        report_load('serve: fetch', *load_test(address, clients, requests,
+                                               False))
+        report_load('serve: reload', *load_test(address, clients, requests))
+        if service is not None:
+            service.cache.size = 0
+            service.cache.clear()
+            report_load('serve: uncached',
+                        *load_test(address, clients,
+                                   max(clients, requests // 20), False))
+    finally:
+        if server is not None:
+            server.shutdown()
+            thread.join()
+            server.server_close()
+            service.close()
+
+
+def dump_process(reader, filename):
+    """process() filename, writing a dump of its alerts."""
+    reader.process(filename)
+    reader.dump.close()
+
+
+def replay(reader, filename):
+    """Replay the dump of parsed alerts filename into reader."""
+    alerts = Nagios2Timeline.ParsedAlerts(filename)
+    try:
+        reader.replay(alerts)
+    finally:
+        alerts.close()
+
+
+def bench_parsed(logfile):
+    """Compare parsing the log with process() against replaying a dump of
+    its parsed alerts with and without filters, and time writing the
+    dump."""
+    size = os.path.getsize(logfile)
+    dump = logfile + '.alerts'
+    reader = new_reader()
+    report('parsed: text', measure(reader.process, logfile), size)
+    events = reader.events_seen
+    reader = new_reader()
+    reader.dump = Nagios2Timeline.ParsedDump(dump)
+    try:
+        report('parsed: dumping', measure(dump_process, reader, logfile),
+               size)
+        print "%-24s %8.1f MB" % ('parsed: dump size',
+                                  os.path.getsize(dump) / 1048576.0)
+        if Nagios2Timeline.load_numpy() is None:
+            print "%-24s %8s" % ('parsed: numpy', 'no')
+        reader = new_reader()
+        report('parsed: replay', measure(replay, reader, dump), size)
+        if reader.events_seen != events:
+            sys.stderr.write("Error: replay disagrees on the number of "
+                             "events\n")
+        reader = new_reader('--exclude-service', '*')
+        report('parsed: host replay', measure(replay, reader, dump), size)
+    finally:
+        os.remove(dump)
+
+
+def python_times(arguments, runs, setup=None):
+    """Return the sorted wall-clock times of running a fresh interpreter
+    with arguments runs times, calling setup() before each run.
+
+    Byte code is written as usual, so that the runs after the first one
+    load the module compiled, as runs from cron do."""
+    environment = dict(os.environ)
+    environment.pop('PYTHONDONTWRITEBYTECODE', None)
+    times = []
+    with open(os.devnull, 'w') as null:
+        for i in range(runs):
+            if setup is not None:
+                setup()
+            start = time.time()
+            subprocess.check_call([sys.executable] + arguments,
+                                  stdout=null, stderr=null, env=environment,
+                                  cwd=os.path.dirname(TOOL))
+            times.append(time.time() - start)
+    return sorted(times)
+
+
+def bench_startup(logfile):
+    """Measure the time taken to start Python and import the module against
+    IMPORT_BUDGET, and that of the short incremental runs of N2T-tool.py
+    made from cron, on deltas of logfile."""
+    runs = 10
+    interpreter = python_times(['-c', 'pass'], runs)[runs // 2]
+    module = python_times(['-c', 'import Nagios2Timeline'], runs)[runs // 2]
+    imported = module - interpreter
+    print "%-24s %8.1f ms, %.1f ms of it importing (budget %.1f ms)" % \
+          ('startup: import', module * 1000, imported * 1000,
+           IMPORT_BUDGET * 1000)
+    record('startup: import', import_ms=imported * 1000)
+    if imported > IMPORT_BUDGET:
+        sys.stderr.write("Error: importing the module exceeds its budget\n")
+    directory = tempfile.mkdtemp()
+    try:
+        with open(logfile, 'rb') as f:
+            deltas = [''.join(f.readline() for i in range(100))
+                      for run in range(runs + 1)]
+        def append_delta():
+            with open(os.path.join(directory, 'log'), 'ab') as f:
+                f.write(deltas.pop(0))
+        command = [TOOL, '-q', '-i', os.path.join(directory, 'log'),
+                   os.path.join(directory, 'log.xml')]
+        # The first run sets up the checkpoint.
+        python_times(command, 1, append_delta)
+        seconds = python_times(command, runs, append_delta)[runs // 2]
+        print "%-24s %8.1f ms per run" % ('startup: cron', seconds * 1000)
+        record('startup: cron', run_ms=seconds * 1000)
+    finally:
+        shutil.rmtree(directory)
+
+
+def compare(filename):
+    """Print the change of each figure in RESULTS from those saved into
+    filename by an earlier run."""
+    with open(filename) as f:
+        previous = json.load(f)['results']
+    print "Compared with %s:" % filename
+    for name in sorted(RESULTS):
+        for (figure, value) in sorted(RESULTS[name].items()):
+            before = previous.get(name, {}).get(figure)
+            if before:
+                print "%-24s %-14s %+7.1f %%" % \
+                      (name, figure, (value - before) * 100.0 / before)
+
+
+BENCHMARKS = {'parser' : bench_parser,
+              'memory' : bench_memory,
+              'input' : bench_input,
+              'writers' : bench_writers,
+              'format' : bench_format,
+              'throughput' : bench_throughput,
+              'serve' : bench_serve,
+              'startup' : bench_startup,
+              'parsed' : bench_parsed}
+
+
+def main():
+    usage = "usage: %prog [options] [benchmark ...]"
+    parser = OptionParser(usage=usage)
+    parser.add_option("-s", "--size", metavar="MB",
+                      action="store", dest="size", type="int",
+                      help="size of the generated log [default: %default]")
+    parser.add_option("-l", "--log", metavar="FILE",
+                      action="store", dest="log", type="string",
+                      help="use FILE instead of generating a log")
+    parser.add_option("-j", "--json", metavar="FILE",
+                      action="store", dest="json", type="string",
+                      help="save the results into FILE as JSON")
+    parser.add_option("-c", "--compare", metavar="FILE",
+                      action="store", dest="compare", type="string",
+                      help="compare the results with those saved into FILE")
+    group = OptionGroup(parser, "Synthetic log",
+                        "Generate the log with synthetic_log() instead "
+                        "of copying the example log; --size is ignored.")
+    group.add_option("--synthetic",
+                      action="store_true", dest="synthetic",
+                      help="use a synthetic log")
+    group.add_option("--generate", metavar="FILE",
+                      action="store", dest="generate", type="string",
+                      help="only write the synthetic log into FILE")
+    group.add_option("--hosts", metavar="N",
+                      action="store", dest="hosts", type="int",
+                      help="number of hosts [default: %default]")
+    group.add_option("--services", metavar="N",
+                      action="store", dest="services", type="int",
+                      help="services per host [default: %default]")
+    group.add_option("--failure-rate", metavar="P",
+                      action="store", dest="failure_rate", type="float",
+                      help="probability of a host or service failing " + \
+                      "in an hour [default: %default]")
+    group.add_option("--flapping", metavar="P",
+                      action="store", dest="flapping", type="float",
+                      help="fraction of flapping services [default: %default]")
+    group.add_option("--days", metavar="N",
+                      action="store", dest="days", type="int",
+                      help="days of logs [default: %default]")
+    group.add_option("--seed", metavar="N",
+                      action="store", dest="seed", type="int",
+                      help="seed of the random numbers [default: %default]")
+    parser.add_option_group(group)
+    group = OptionGroup(parser, "Serve mode load test",
+                        "The serve benchmark starts a server on the log "
+                        "in this process, unless given the URL of one "
+                        "started with N2T-tool.py serve.")
+    group.add_option("--url", metavar="URL",
+                      action="store", dest="url", type="string",
+                      help="load-test the server at URL, such as " + \
+                      "http://localhost:8080/")
+    group.add_option("--clients", metavar="N",
+                      action="store", dest="clients", type="int",
+                      help="concurrent connections [default: %default]")
+    group.add_option("--requests", metavar="N",
+                      action="store", dest="requests", type="int",
+                      help="requests per run [default: %default]")
+    parser.add_option_group(group)
+    parser.set_defaults(size=1024, log=None, json=None, compare=None,
+                        synthetic=False, generate=None, hosts=100,
+                        services=10, failure_rate=0.002, flapping=0.05,
+                        days=30, seed=1, url=None, clients=8,
+                        requests=2000)
+    (options, names) = parser.parse_args()
+    LOAD.update(url=options.url, clients=options.clients,
+                requests=options.requests)
+    for name in names:
+        if name not in BENCHMARKS:
+            parser.error("unknown benchmark %s" % name)
+    synthetic = (options.hosts, options.services, options.failure_rate,
+                 options.flapping, options.days, options.seed)
+    if options.generate:
+        outages = synthetic_log(options.generate, *synthetic)
+        print "Wrote %d outages into %s" % (outages, options.generate)
+        return
+    logfile = options.log
+    if logfile is None:
+        (fd, logfile) = tempfile.mkstemp(suffix='.log')
+        os.close(fd)
+        if options.synthetic:
+            synthetic_log(logfile, *synthetic)
+        else:
+            scaled_log(logfile, options.size)
+    try:
+        print "Log file %s, %.1f MB" % \
+              (logfile, os.path.getsize(logfile) / 1048576.0)
+        for name in sorted(names or BENCHMARKS):
+            BENCHMARKS[name](logfile)
+    finally:
+        if options.log is None:
+            os.remove(logfile)
+    if options.compare:
+        compare(options.compare)
+    if options.json:
+        log = {'size' : os.path.getsize(logfile) if options.log else None}
+        if options.log is None:
+            log = {'synthetic' : options.synthetic, 'size_mb' : options.size}
+            if options.synthetic:
+                log.update(zip(('hosts', 'services', 'failure_rate',
+                                'flapping', 'days', 'seed'), synthetic))
+        with open(options.json, 'w') as f:
+            json.dump({'version' : Nagios2Timeline.__version__,
+                       'time' : int(time.time()),
+                       'log' : log,
+                       'results' : RESULTS}, f, sort_keys=True, indent=1)
+            f.write('\n')
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+// Each band shows its own level of the output written by
+// N2T-tool.py --levels examples/nagios.log demo/levels.xml
+var tl;
+function onLoad() {
+  var dayEvents = new Timeline.DefaultEventSource();
+  var monthEvents = new Timeline.DefaultEventSource();
+  var yearEvents = new Timeline.DefaultEventSource();
+  var bandInfos = [
+    Timeline.createBandInfo({
+      eventSource:    dayEvents,
+      date:           "Oct 29 2009 12:00:00 GMT",     
+      width:          "50%", 
+      intervalUnit:   Timeline.DateTime.HOUR,
+      intervalPixels: 100
+    }),
+    Timeline.createBandInfo({
+      eventSource:    monthEvents,
+      date:           "Oct 29 2009 12:00:00 GMT",     
+      width:          "30%", 
+      intervalUnit:   Timeline.DateTime.DAY,
+      intervalPixels: 100
+    }),
+    Timeline.createBandInfo({
+      eventSource:    yearEvents,
+      date:           "Oct 29 2009 12:00:00 GMT",
+      width:          "20%", 
+      intervalUnit:   Timeline.DateTime.MONTH,
+      intervalPixels: 100
+    }),
+  ];
+  bandInfos[1].syncWith = 0;
+  bandInfos[1].highlight = true;
+  bandInfos[2].syncWith = 1;
+  bandInfos[2].highlight = true;
+
+  tl = Timeline.create(document.getElementById("nagios-timeline"), bandInfos);
+  Timeline.loadXML('levels-day.xml', function(xml, url) { dayEvents.loadXML(xml, url); });
+  Timeline.loadXML('levels-month.xml', function(xml, url) { monthEvents.loadXML(xml, url); });
+  Timeline.loadXML('levels-year.xml', function(xml, url) { yearEvents.loadXML(xml, url); });
+}
+
+var resizeTimerID = null;
+function onResize() {
+   if (resizeTimerID == null) {
+       resizeTimerID = window.setTimeout(function() {
+           resizeTimerID = null;
+           tl.layout();
+       }, 500);
+   }
+}
@@ -5,8 +5,26 @@
 # information on writing these tests.
 #
 """This module tests a number of methods of Nagios2Timeline.py."""
+import bz2
+import gzip
+import os
+import pickle
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
 import unittest
+import urllib2
+from StringIO import StringIO
+try:
+    import json
+except ImportError:
+    import simplejson as json
+import xml.dom.minidom
+import xml.sax.saxutils
 import Nagios2Timeline
+import bench_Nagios2Timeline
 __author__ = 'Pervilä <pervila@cs.helsinki.fi>'
 
 class TestSeq(unittest.TestCase):
@@ -16,7 +34,15 @@ class TestSeq(unittest.TestCase):
         self.writer = Nagios2Timeline.TimelineWriterXML('test-output.xml')
         self.reader = Nagios2Timeline.NagiosLogReader(self.writer, options)
 
-        
+
+    def tearDown(self):
+        # The XML writer streams events into the file as they are output.
+        if self.writer.file is not None:
+            self.writer.file.close()
+        if os.path.exists('test-output.xml'):
+            os.remove('test-output.xml')
+
+
     def test_getConfigIllegal(self):
         self.assertRaises(ValueError,
                           self.reader.get_config, 'NOT_EXIST')
@@ -69,8 +95,8 @@ class TestSeq(unittest.TestCase):
                    'state' : 'UNKNOWN',
                    'host_name' : 'melkinpaasi.cs.helsinki.fi'}]
         self.reader.set_ongoing_events(events)
-        self.assert_('melkinpaasi.cs.helsinki.fi globalcatTCPworldwide' in
-                     self.reader.ongoing_events)
+        self.assert_(('melkinpaasi.cs.helsinki.fi', 'globalcatTCPworldwide')
+                     in self.reader.ongoing_events)
 
 
     # Second event doesn't contain the state field.
@@ -93,10 +119,1568 @@ class TestSeq(unittest.TestCase):
         self.assertRaises(IOError, self.reader.process, '__NOT_EXISTING_FILE__')
 
 
+    def test_tokenize(self):
+        # The tokenizer must agree with the regexps it replaces.
+        lines = open('examples/nagios.log').readlines() + [
+            '[1256805642] HOST ALERT: svm-5;DOWN;SOFT;2;a;b;c\n',
+            '[1256805642] HOST ALERT: svm-5;DOWN;SOFT;2;\n',
+            '[1256805642] SERVICE ALERT: svm-5;;OK;HARD;1;fine\n',
+            '[12568x5642] SERVICE ALERT: svm-5;SSH;OK;HARD;1;fine\n',
+            '[1256805642] SERVICE FLAPPING ALERT: svm-5;SSH;STARTED; x\n']
+        for line in lines:
+            match = self.reader.RE_HOST.match(line) or \
+                    self.reader.RE_SVC.match(line)
+            tokens = self.reader.tokenize(line)
+            if match is None:
+                self.assertEqual(tokens, None)
+                continue
+            svc = match.group(self.reader.RE_INDEX_SVC)
+            self.assertEqual(tokens,
+                             (match.group(self.reader.RE_INDEX_TIME),
+                              match.group(self.reader.RE_INDEX_HOST),
+                              svc != ';' and svc or None,
+                              match.group(self.reader.RE_INDEX_STATE),
+                              match.group(self.reader.RE_INDEX_PLUG)))
+
+
     def test_process(self):
         self.reader.process('examples/nagios.log')
         self.assert_(len(self.reader.ongoing_events) == 0)
         
 
-suite = unittest.TestLoader().loadTestsFromTestCase(TestSeq)
+class TestEvent(unittest.TestCase):
+    def setUp(self):
+        self.event = Nagios2Timeline.Event(1256844672, 'lc2-6', 'CRITICAL',
+                                           'SSH', 'No route to host')
+
+
+    def test_dictView(self):
+        self.assertEqual(self.event['title'], 'lc2-6 SSH')
+        self.assert_('plugin_start' in self.event)
+        self.assert_('plugin_end' not in self.event)
+        self.assertRaises(KeyError, lambda: self.event['plugin_end'])
+        self.assertEqual(self.event.get('timestamp_end', 5), 5)
+        self.event['timestamp_end'] = 1256844700
+        self.assertEqual(dict(self.event),
+                         {'timestamp_start' : 1256844672,
+                          'timestamp_end' : 1256844700,
+                          'host_name' : 'lc2-6',
+                          'svc_desc' : 'SSH',
+                          'state' : 'CRITICAL',
+                          'title' : 'lc2-6 SSH',
+                          'plugin_start' : 'No route to host'})
+        self.assertRaises(KeyError, self.event.__setitem__, 'colour', 'red')
+
+
+    def test_pickle(self):
+        copy = pickle.loads(pickle.dumps(self.event))
+        self.assertEqual(dict(copy), dict(self.event))
+
+
+
+class TestWriterXML(unittest.TestCase):
+    def setUp(self):
+        self.filename = 'test-writer.xml'
+        self.event = {'timestamp_start' : 1256844672,
+                      'timestamp_end' : 1256844732,
+                      'host_name' : 'lc2-6.cs.helsinki.fi',
+                      'state' : 'DOWN',
+                      'title' : 'lc2-6.cs.helsinki.fi',
+                      'plugin_start' : 'CRITICAL - Host <Unreachable> & "gone"'}
+
+
+    def tearDown(self):
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+
+    def parse(self):
+        dom = xml.dom.minidom.parse(self.filename)
+        root = dom.documentElement
+        return (int(root.getAttribute('last_timestamp')),
+                root.getElementsByTagName('event'))
+
+
+    def test_streamEvents(self):
+        writer = Nagios2Timeline.TimelineWriterXML(self.filename)
+        writer.output(self.event)
+        writer.output(self.event)
+        writer.flush_file(1256844800)
+        (last_timestamp, events) = self.parse()
+        self.assertEqual(last_timestamp, 1256844800)
+        self.assertEqual(len(events), 2)
+        self.assertEqual(events[0].getAttribute('title'), self.event['title'])
+        self.assert_('<Unreachable> & "gone"' in events[0].firstChild.data)
+
+
+    def test_appendEvents(self):
+        writer = Nagios2Timeline.TimelineWriterXML(self.filename)
+        writer.output(self.event)
+        writer.flush_file(1256844800)
+        writer = Nagios2Timeline.TimelineWriterXML(self.filename, True)
+        self.assertEqual(writer.last_timestamp, 1256844800)
+        writer.output(self.event)
+        writer.flush_file(1256844900)
+        (last_timestamp, events) = self.parse()
+        self.assertEqual(last_timestamp, 1256844900)
+        self.assertEqual(len(events), 2)
+
+
+    def test_appendMinidomDocument(self):
+        f = open(self.filename, 'w')
+        f.write('<?xml version="1.0" ?>\n<data last_timestamp="5"/>\n')
+        f.close()
+        writer = Nagios2Timeline.TimelineWriterXML(self.filename, True)
+        writer.output(self.event)
+        writer.flush_file(10)
+        (last_timestamp, events) = self.parse()
+        self.assertEqual(last_timestamp, 10)
+        self.assertEqual(len(events), 1)
+
+
+    def test_existingFile(self):
+        open(self.filename, 'w').close()
+        self.assertRaises(IOError,
+                          Nagios2Timeline.TimelineWriterXML, self.filename)
+
+
+class TestFormatTime(unittest.TestCase):
+    def setUp(self):
+        self.writer = Nagios2Timeline.TimelineWriter(None)
+        self.writer.hour_cache.clear()
+        self.writer.rfc2822_cache.clear()
+        # Every second of a day, twice, DST changes of 2009 in Helsinki, the epoch
+        # and some pseudorandom instants across four decades.
+        self.timestamps = range(1256774400, 1256774400 + 86400) * 2
+        for start in (1238288400, 1256432400, 0):
+            self.timestamps += range(start - 7200, start + 7200, 7)
+        self.timestamps += [(i * 7919 * 86413) % 1300000000
+                            for i in range(10000)]
+
+
+    def test_timelineFormat(self):
+        for timestamp in self.timestamps:
+            self.assertEqual(
+                self.writer.format_time(timestamp),
+                time.strftime("%b %d %Y %H:%M:%S GMT%z",
+                              time.gmtime(timestamp)))
+
+
+    def test_rfc2822Format(self):
+        old_tz = os.environ.get('TZ')
+        os.environ['TZ'] = 'Europe/Helsinki'
+        time.tzset()
+        try:
+            for timestamp in self.timestamps:
+                self.assertEqual(
+                    self.writer.format_time(
+                        timestamp, self.writer.TFORMAT_RFC2822),
+                    time.strftime("%a, %d %b %Y %H:%M:%S %z",
+                                  time.localtime(timestamp)))
+        finally:
+            if old_tz is None:
+                del os.environ['TZ']
+            else:
+                os.environ['TZ'] = old_tz
+            time.tzset()
+            self.writer.hour_cache.clear()
+        self.writer.rfc2822_cache.clear()
+
+
+    def test_cacheBounded(self):
+        for timestamp in self.timestamps:
+            self.writer.format_time(timestamp)
+            self.writer.format_time(timestamp, self.writer.TFORMAT_RFC2822)
+        self.assert_(len(self.writer.hour_cache) <=
+                     self.writer.TIME_CACHE_SIZE)
+        self.assert_(len(self.writer.rfc2822_cache) <=
+                     self.writer.TIME_CACHE_SIZE)
+
+
+
+class TestWriterJSON(unittest.TestCase):
+    def setUp(self):
+        self.files = ['test-writer.json']
+        self.event = {'timestamp_start' : 1256844672,
+                      'timestamp_end' : 1256844732,
+                      'host_name' : 'lc2-6.cs.helsinki.fi',
+                      'state' : 'DOWN',
+                      'title' : 'lc2-6.cs.helsinki.fi',
+                      'plugin_start' : 'CRITICAL - Host \xe4 "gone"'}
+
+
+    def tearDown(self):
+        for filename in self.files:
+            if os.path.exists(filename):
+                os.remove(filename)
+
+
+    def load(self, filename):
+        return json.load(open(filename))
+
+
+    def test_streamAndAppend(self):
+        writer = Nagios2Timeline.TimelineWriterJSON(self.files[0])
+        writer.flush_file(1256844600)
+        self.assertEqual(self.load(self.files[0]),
+                         {'events' : [], 'last_timestamp' : 1256844600})
+        writer = Nagios2Timeline.TimelineWriterJSON(self.files[0], True)
+        self.assertEqual(writer.last_timestamp, 1256844600)
+        writer.output(self.event)
+        writer.output(self.event)
+        writer.flush_file(1256844800)
+        document = self.load(self.files[0])
+        self.assertEqual(document['last_timestamp'], 1256844800)
+        self.assertEqual(len(document['events']), 2)
+        self.assertEqual(document['events'][0]['title'], self.event['title'])
+        self.assert_(u'\xe4 "gone"' in document['events'][0]['description'])
+
+
+    def test_chunks(self):
+        self.files += ['test-writer-20091028.json',
+                       'test-writer-20091029.json']
+        writer = Nagios2Timeline.TimelineWriterJSONChunks(self.files[0])
+        writer.MAX_OPEN = 1
+        for start in (1256844672, 1256744672, 1256844000):
+            self.event['timestamp_start'] = start
+            writer.output(self.event)
+        writer.flush_file(1256844800)
+        index = self.load(self.files[0])
+        self.assertEqual([(chunk['file'], chunk['events'])
+                          for chunk in index['chunks']],
+                         [(self.files[1], 1), (self.files[2], 2)])
+        self.assertEqual(len(self.load(self.files[2])['events']), 2)
+        # The 20091028 document was closed early, but not left behind.
+        for filename in self.files[1:]:
+            self.assertEqual(self.load(filename)['last_timestamp'],
+                             1256844800)
+
+
+    def test_chunksCheckpoint(self):
+        checkpoint = Nagios2Timeline.Checkpoint('test-writer.checkpoint')
+        self.assertRaises(ValueError, Nagios2Timeline.TimelineWriterJSONChunks,
+                          self.files[0], False, checkpoint)
+
+
+
+class TestWriterSQLite(unittest.TestCase):
+    def setUp(self):
+        self.files = ['test-writer.sqlite', 'test-writer.sqlite-wal',
+                      'test-writer.sqlite-shm', 'test-writer.xml',
+                      'test-export.xml', 'test-writer.log']
+
+
+    def tearDown(self):
+        for filename in self.files:
+            if os.path.exists(filename):
+                os.remove(filename)
+
+
+    def run_reader(self, writer, filename):
+        (options, args) = Nagios2Timeline.optparser().parse_args([])
+        reader = Nagios2Timeline.NagiosLogReader(writer, options)
+        reader.set_ongoing_events(writer.get_ongoing_events())
+        reader.last_timestamp = max(reader.last_timestamp,
+                                    writer.last_timestamp)
+        reader.process(filename)
+        reader.flush_events()
+
+
+    def test_exportSameAsXML(self):
+        self.run_reader(Nagios2Timeline.TimelineWriterSQLite(self.files[0]),
+                        'examples/nagios.log')
+        self.run_reader(Nagios2Timeline.TimelineWriterXML(self.files[3]),
+                        'examples/nagios.log')
+        database = Nagios2Timeline.TimelineWriterSQLite(self.files[0], True)
+        count = database.export(
+            Nagios2Timeline.TimelineWriterXML(self.files[4]))
+        self.assertEqual(open(self.files[4]).read(),
+                         open(self.files[3]).read())
+        self.assertEqual(count, 20)
+        writer = ListWriter()
+        database.export(writer, ['lc2-6.cs.helsinki.fi'], 1256800000)
+        self.assert_(writer.events)
+        for event in writer.events:
+            self.assertEqual(event['host_name'], 'lc2-6.cs.helsinki.fi')
+            self.assert_(event['timestamp_end'] >= 1256800000)
+
+
+    def test_ongoingAcrossRuns(self):
+        f = open(self.files[5], 'w')
+        f.write('[100] HOST ALERT: lc2-1;DOWN;HARD;1;down\n' + \
+                '[110] SERVICE ALERT: lc2-2;SSH;CRITICAL;HARD;1;refused\n' + \
+                '[120] SERVICE ALERT: lc2-2;SSH;OK;HARD;1;ok\n')
+        f.close()
+        self.run_reader(Nagios2Timeline.TimelineWriterSQLite(self.files[0]),
+                        self.files[5])
+        self.assertRaises(IOError, Nagios2Timeline.TimelineWriterSQLite,
+                          self.files[0])
+        f = open(self.files[5], 'w')
+        f.write('[200] HOST ALERT: lc2-1;UP;HARD;1;up\n')
+        f.close()
+        writer = Nagios2Timeline.TimelineWriterSQLite(self.files[0], True)
+        self.assertEqual(writer.last_timestamp, 120)
+        self.assertEqual(writer.get_ongoing_events(),
+                         [{'timestamp' : 100, 'host_name' : 'lc2-1',
+                           'state' : 'DOWN', 'svc_desc' : None,
+                           'plugin_output' : 'down'}])
+        self.run_reader(writer, self.files[5])
+        writer = ListWriter()
+        database = Nagios2Timeline.TimelineWriterSQLite(self.files[0], True)
+        self.assertEqual(database.get_ongoing_events(), [])
+        database.export(writer)
+        self.assertEqual([(event['title'], event['timestamp_start'],
+                           event['timestamp_end'])
+                          for event in writer.events],
+                         [('lc2-2 SSH', 110, 120), ('lc2-1', 100, 200)])
+
+
+
+class TestWriterLevels(unittest.TestCase):
+    def setUp(self):
+        self.files = ['test-levels-day.json', 'test-levels-month.json',
+                      'test-levels-year.json']
+
+
+    def tearDown(self):
+        for filename in self.files:
+            if os.path.exists(filename):
+                os.remove(filename)
+
+
+    def event(self, host_name, state, start, end):
+        return {'timestamp_start' : start, 'timestamp_end' : end,
+                'host_name' : host_name, 'state' : state,
+                'title' : host_name, 'plugin_start' : state}
+
+
+    def test_levels(self):
+        day = 86400
+        last = 40 * day
+        writer = Nagios2Timeline.TimelineWriterLevels(
+            'test-levels.json', Nagios2Timeline.TimelineWriterJSON)
+        writer.output_many([self.event('old', 'DOWN', day, day + 60),
+                            self.event('a', 'WARNING', 20 * day, 20 * day + 60),
+                            self.event('b', 'CRITICAL', 20 * day + 1800,
+                                       20 * day + 5400)])
+        writer.output(self.event('a', 'DOWN', last - 100, last - 40))
+        writer.flush_file(last)
+        documents = [json.load(open(filename)) for filename in self.files]
+        self.assertEqual([e['title'] for e in documents[0]['events']], ['a'])
+        self.assertEqual([e['title'] for e in documents[1]['events']],
+                         ['a: 1 outages', 'b: 1 outages', 'b: 1 outages',
+                          'a: 1 outages'])
+        self.assert_('0 h 30 min down' in
+                     documents[1]['events'][1]['description'])
+        self.assertEqual([e['title'] for e in documents[2]['events']],
+                         ['1 outages on 1 hosts', '2 outages on 2 hosts',
+                          '1 outages on 1 hosts'])
+        self.assert_('1 h 01 min down' in
+                     documents[2]['events'][1]['description'])
+
+
+    def test_noAppend(self):
+        self.assertRaises(ValueError, Nagios2Timeline.TimelineWriterLevels,
+                          'test-levels.json',
+                          Nagios2Timeline.TimelineWriterJSON, True)
+
+
+
+class ListWriter(Nagios2Timeline.TimelineWriter):
+    """Collects the events output into a list."""
+
+    def __init__(self, filename=None, append=False):
+        self.events = []
+
+
+    def output(self, event):
+        self.events.append(dict(event))
+
+
+
+class BatchWriter(ListWriter):
+    """Records the size of each batch given to output_many()."""
+
+    def __init__(self, filename=None, append=False, checkpoint=None):
+        ListWriter.__init__(self)
+        self.batches = []
+
+
+    def output_many(self, events):
+        self.batches.append(len(events))
+        ListWriter.output_many(self, events)
+
+
+
+class TestBatches(unittest.TestCase):
+    def run_reader(self, writer, batch_size):
+        (options, args) = Nagios2Timeline.optparser().parse_args(
+            ['--batch-size', str(batch_size)])
+        reader = Nagios2Timeline.NagiosLogReader(writer, options)
+        reader.process('examples/nagios.log')
+        # Nothing may be held back once process() returns.
+        self.assertEqual(len(writer.events), reader.events_output)
+        reader.flush_events()
+        return writer
+
+
+    def test_batchSize(self):
+        events = self.run_reader(ListWriter(), 1).events
+        writer = self.run_reader(BatchWriter(), 4)
+        self.assertEqual(writer.events, events)
+        self.assertEqual(sum(writer.batches), len(events))
+        self.assertEqual(max(writer.batches), 4)
+
+
+    def test_outputShim(self):
+        events = self.run_reader(ListWriter(), 256).events
+        writer = Nagios2Timeline.TimelineWriterJSON('test-batches.json')
+        try:
+            for event in events[:3]:
+                writer.output(event)
+            writer.output_many(events[3:])
+            writer.flush_file(0)
+            self.assertEqual(len(json.load(open('test-batches.json'))
+                                 ['events']), len(events))
+        finally:
+            os.remove('test-batches.json')
+
+
+
+class TestOngoingLimits(unittest.TestCase):
+    def reader(self, *args):
+        (options, args) = Nagios2Timeline.optparser().parse_args(list(args))
+        return Nagios2Timeline.NagiosLogReader(ListWriter(), options)
+
+
+    def ended(self, reader):
+        reader.flush_pending()
+        return [(e['host_name'], e['timestamp_start'], e['timestamp_end'])
+                for e in reader.writer.events]
+
+
+    def test_maxAge(self):
+        reader = self.reader('--max-age', '300', '--batch-size', '1')
+        reader.record_event(100, 'a', 'DOWN')
+        reader.record_event(150, 'b', 'DOWN')
+        reader.record_event(420, 'c', 'DOWN')
+        self.assertEqual(self.ended(reader), [('a', 100, 400)])
+        # A recovery logged closes its event, even once past max_age.
+        reader.record_event(460, 'b', 'UP')
+        reader.record_event(800, 'd', 'DOWN')
+        self.assertEqual(self.ended(reader)[1:],
+                         [('b', 150, 460), ('c', 420, 720)])
+        self.assert_(reader.writer.events[0]['plugin_end'].startswith(
+            'Truncated: '))
+        self.assertEqual(reader.writer.events[1].get('plugin_end'), None)
+        # The recovery of a truncated event is an unseen one.
+        self.assertRaises(Warning, reader.record_event, 810, 'a', 'UP')
+        self.assertEqual(reader.truncated, 2)
+        self.assertEqual(reader.ongoing_events.keys(), [('d', None)])
+
+
+    def test_maxOpen(self):
+        reader = self.reader('--max-open', '2')
+        for (start, host_name) in ((100, 'a'), (200, 'b'), (300, 'c')):
+            reader.record_event(start, host_name, 'DOWN')
+        reader.record_event(400, 'b', 'UP')
+        reader.record_event(500, 'd', 'DOWN')
+        reader.record_event(600, 'e', 'DOWN')
+        self.assertEqual(self.ended(reader),
+                         [('a', 100, 300), ('b', 200, 400), ('c', 300, 600)])
+        self.assertEqual(sorted(reader.ongoing_events),
+                         [('d', None), ('e', None)])
+        self.assertEqual(reader.truncated, 2)
+
+
+    def test_staleEntries(self):
+        reader = self.reader('--max-open', '10')
+        reader.STALE_OPENED = 4
+        reader.record_event(1, 'a', 'DOWN')
+        for timestamp in range(2, 200, 2):
+            reader.record_event(timestamp, 'b', 'DOWN')
+            reader.record_event(timestamp + 1, 'b', 'UP')
+        self.assert_(len(reader.opened) <= 2 * 1 + 4 + 1)
+        self.assertEqual(reader.truncated, 0)
+
+
+    def test_log(self):
+        reader = self.reader('--max-open', '1')
+        stats = Nagios2Timeline.RunStats()
+        stats.instrument(reader)
+        reader.process('examples/nagios.log')
+        reader.flush_events()
+        totals = stats.totals()
+        self.assertEqual(totals['peak_ongoing'], 1)
+        self.assert_(totals['truncated'] > 0)
+        self.assertEqual(totals['truncated'], reader.truncated)
+        self.assertEqual(len([event for event in reader.writer.events
+                              if event['plugin_end'].startswith('Truncated')]),
+                         reader.truncated)
+
+
+
+class TestFlapFilter(unittest.TestCase):
+    def event(self, title, start, end):
+        return {'title' : title, 'host_name' : title, 'state' : 'WARNING',
+                'timestamp_start' : start, 'timestamp_end' : end,
+                'plugin_start' : 'WARNING %d' % start,
+                'plugin_end' : 'OK %d' % end}
+
+
+    def test_merge(self):
+        writer = ListWriter()
+        flap = Nagios2Timeline.FlapFilter(writer, 60, 30)
+        # Events come in the order they end.
+        flap.output_many([self.event('a', 100, 110),
+                          self.event('a', 150, 160),
+                          self.event('c', 170, 175),
+                          self.event('b', 100, 200)])
+        # a may still be merged, nothing has passed its deadline yet.
+        self.assertEqual(writer.events, [])
+        flap.output(self.event('a', 400, 410))
+        self.assertEqual([(e['title'], e['timestamp_start'],
+                           e['timestamp_end']) for e in writer.events],
+                         [('a', 100, 160), ('b', 100, 200)])
+        self.assertEqual(writer.events[0]['plugin_end'], 'OK 160')
+        flap.flush_file(409)
+        # c was too short, but the final a is still ongoing.
+        self.assertEqual([(e['title'], e['timestamp_start'])
+                          for e in writer.events],
+                         [('a', 100), ('b', 100), ('a', 400)])
+        self.assertEqual((flap.merged, flap.dropped), (1, 1))
+
+
+    def test_reader(self):
+        (options, args) = Nagios2Timeline.optparser().parse_args([])
+        writer = ListWriter()
+        flap = Nagios2Timeline.FlapFilter(writer, 3600)
+        reader = Nagios2Timeline.NagiosLogReader(flap, options)
+        reader.process('examples/nagios.log')
+        reader.flush_events()
+        self.assertEqual(len(writer.events) + flap.merged, 20)
+        self.assert_(flap.merged > 0)
+
+
+
+class TestOutageAnalytics(unittest.TestCase):
+    def event(self, start, end, host_name, svc_desc=None):
+        event = {'timestamp_start' : start, 'timestamp_end' : end,
+                 'host_name' : host_name, 'state' : 'DOWN',
+                 'title' : host_name}
+        if svc_desc:
+            event.update(svc_desc=svc_desc, state='CRITICAL',
+                         title=host_name + ' ' + svc_desc)
+        return event
+
+
+    def test_figures(self):
+        writer = ListWriter()
+        analytics = Nagios2Timeline.OutageAnalytics(writer)
+        analytics.output_many([self.event(100, 200, 'a'),
+                               self.event(150, 250, 'b', 'SSH'),
+                               self.event(180, 190, 'c'),
+                               self.event(300, 350, 'a'),
+                               self.event(500, 600, 'e'),
+                               self.event(600, 700, 'f')])
+        analytics.output(dict(self.event(120, 120, 'a'),
+                              kind='notification'))
+        self.assertEqual(len(writer.events), 7)
+        report = analytics.report()
+        self.assertEqual((report['first'], report['last'],
+                          report['outages']), (100, 700, 6))
+        self.assertEqual(report['hosts']['a'],
+                         {'failures' : 2, 'downtime' : 150, 'mttr' : 75.0,
+                          'mtbf' : 100.0})
+        self.assertEqual(report['services']['b']['SSH']['mtbf'], None)
+        # Outages which only touch do not overlap.
+        self.assertEqual(report['correlated'],
+                         [{'start' : 150, 'end' : 200, 'peak' : 3,
+                           'hosts' : ['a', 'b', 'c']}])
+        analytics.min_hosts = 3
+        self.assertEqual(analytics.correlated(),
+                         [{'start' : 180, 'end' : 190, 'peak' : 3,
+                           'hosts' : ['a', 'b', 'c']}])
+
+
+    def test_zeroLength(self):
+        analytics = Nagios2Timeline.OutageAnalytics(ListWriter())
+        analytics.output_many([self.event(100, 100, 'a'),
+                               self.event(50, 500, 'b'),
+                               self.event(100, 300, 'c')])
+        self.assertEqual(analytics.correlated(),
+                         [{'start' : 100, 'end' : 300, 'peak' : 2,
+                           'hosts' : ['b', 'c']}])
+        self.assertEqual(analytics.report()['hosts']['a']['failures'], 1)
+
+
+    def test_reader(self):
+        (options, args) = Nagios2Timeline.optparser().parse_args(
+            ['--merge-gap', '600'])
+        analytics = Nagios2Timeline.OutageAnalytics(ListWriter())
+        output = Nagios2Timeline.FlapFilter(analytics, options.merge_gap)
+        reader = Nagios2Timeline.NagiosLogReader(output, options)
+        reader.process('examples/nagios.log')
+        reader.flush_events()
+        report = analytics.report()
+        self.assertEqual(report['outages'], len(analytics.inner.events))
+        self.assertEqual(sum(figures['failures'] for figures in
+                             report['hosts'].values()) + \
+                         sum(figures['failures']
+                             for services in report['services'].values()
+                             for figures in services.values()),
+                         report['outages'])
+
+
+class TestNameFilter(unittest.TestCase):
+    def test_patterns(self):
+        names = Nagios2Timeline.NameFilter(['lc2-*', 're:^svm-[0-9]$'],
+                                           ['lc2-1?'])
+        self.assertEqual([name for name in ['lc2-1', 'lc2-12', 'svm-5',
+                                            'svm-55', 'xlc2-1']
+                          if names.accepts(name)], ['lc2-1', 'svm-5'])
+        self.assertEqual(names.cache['lc2-12'], False)
+        self.assert_(Nagios2Timeline.NameFilter([], ['re:rpc']).accepts('SSH'))
+        self.assertRaises(ValueError, Nagios2Timeline.NameFilter, ['re:('])
+
+
+    def test_exactNames(self):
+        hosts = ['lc2-%d' % i for i in range(5000)]
+        names = Nagios2Timeline.NameFilter(hosts + ['svm-*'], ['lc2-7'])
+        self.assertEqual(len(names.include), 1)
+        self.assertEqual(names.exclude, [])
+        self.assertEqual([name for name in ['lc2-1', 'lc2-7', 'lc2-5000',
+                                            'svm-5', 'lc2-1?']
+                          if names.accepts(name)], ['lc2-1', 'svm-5'])
+
+
+    def test_reader(self):
+        f = open('test-hosts.txt', 'w')
+        f.write('# The hosts\n\nlc2-6.cs.helsinki.fi\nsvm-5*\n')
+        f.close()
+        try:
+            (options, args) = Nagios2Timeline.optparser().parse_args(
+                ['--host-file', 'test-hosts.txt', '--exclude-service',
+                 're:^rpcbind'])
+            writer = ListWriter()
+            reader = Nagios2Timeline.NagiosLogReader(writer, options)
+            reader.process('examples/nagios.log')
+            reader.flush_events()
+        finally:
+            os.remove('test-hosts.txt')
+        titles = set([event['title'] for event in writer.events])
+        self.assert_('svm-5.cs.helsinki.fi SSH' in titles)
+        self.assert_('lc2-6.cs.helsinki.fi' in titles)
+        for event in writer.events:
+            self.assert_(event['host_name'] in ('lc2-6.cs.helsinki.fi',
+                                                'svm-5.cs.helsinki.fi'))
+            self.failIf(event.get('svc_desc', '').startswith('rpcbind'))
+        (options, args) = Nagios2Timeline.optparser().parse_args(
+            ['--host-file', 'test-hosts.txt'])
+        self.assertRaises(ValueError, Nagios2Timeline.name_filters, options)
+
+
+    def test_shared(self):
+        # The readers of a run share the filters built from its options.
+        (options, args) = Nagios2Timeline.optparser().parse_args(
+            ['--host', 'lc2-*'])
+        filters = Nagios2Timeline.name_filters(options)
+        reader = Nagios2Timeline.NagiosLogReader(ListWriter(), options)
+        self.assert_(reader.host_filter is filters[0])
+        (options, args) = Nagios2Timeline.optparser().parse_args(
+            ['--host', 'lc2-*', '--service', 'SSH'])
+        self.assert_(Nagios2Timeline.name_filters(options)[1] is not None)
+
+
+class TestLineKinds(unittest.TestCase):
+    LOG = [
+'[1000] CURRENT HOST STATE: h1;DOWN;HARD;3;down already',
+'[1000] CURRENT HOST STATE: h2;UP;HARD;1;fine',
+'[1000] CURRENT SERVICE STATE: h2;SSH;CRITICAL;HARD;3;refused',
+'[1100] HOST DOWNTIME ALERT: h2;STARTED; Host has entered downtime',
+'[1150] SERVICE NOTIFICATION: alice;h2;SSH;ACKNOWLEDGEMENT (CRITICAL);' \
+    'notify-service-by-email;refused;bob;Rebooting',
+'[1150] SERVICE NOTIFICATION: carol;h2;SSH;ACKNOWLEDGEMENT (CRITICAL);' \
+    'notify-service-by-email;refused;bob;Rebooting',
+'[1160] HOST NOTIFICATION: alice;h1;DOWN;notify-host-by-email;still down',
+'[1200] HOST ALERT: h1;UP;HARD;1;up',
+'[1250] SERVICE ALERT: h2;SSH;OK;HARD;1;ok',
+'[1300] HOST DOWNTIME ALERT: h2;STOPPED; Host has exited downtime',
+'[1400] SERVICE DOWNTIME ALERT: h2;HTTP;STARTED; Service has entered downtime']
+
+    def run_reader(self, args):
+        (options, args) = Nagios2Timeline.optparser().parse_args(args)
+        writer = ListWriter()
+        reader = Nagios2Timeline.NagiosLogReader(writer, options)
+        reader.feed([line + '\n' for line in self.LOG], 'test')
+        reader.flush_events()
+        return [(e['title'], e.get('kind'), e['state'], e['timestamp_start'],
+                 e['timestamp_end']) for e in writer.events]
+
+
+    def test_default(self):
+        # Only the recovery of h1 is seen, as a warning.
+        self.assertEqual(self.run_reader([]), [])
+
+
+    def test_snapshots(self):
+        self.assertEqual(self.run_reader(['--snapshots']),
+                         [('h1', None, 'DOWN', 1000, 1200),
+                          ('h2 SSH', None, 'CRITICAL', 1000, 1250)])
+
+
+    def test_overlays(self):
+        self.assertEqual(self.run_reader(['--downtime', '--acks',
+                                          '--notifications']),
+                         [('h2 SSH', 'acknowledgement', 'CRITICAL', 1150,
+                           1150),
+                          ('h1', 'notification', 'DOWN', 1160, 1160),
+                          ('h2', 'downtime', 'DOWNTIME', 1100, 1300),
+                          ('h2 HTTP', 'downtime', 'DOWNTIME', 1400, 1401)])
+        self.assertEqual(self.run_reader(['--acks'])[0][1],
+                         'acknowledgement')
+
+
+    def test_writers(self):
+        event = Nagios2Timeline.Event(1150, 'h2', 'CRITICAL', 'SSH',
+                                      'bob: Rebooting', 'acknowledgement')
+        event.timestamp_end = 1150
+        writer = Nagios2Timeline.TimelineWriterJSON('test-kinds.json')
+        try:
+            writer.output(event)
+            writer.flush_file(1150)
+            data = json.load(open('test-kinds.json'))['events'][0]
+        finally:
+            os.remove('test-kinds.json')
+        self.assertEqual(data['classname'], 'acknowledgement')
+        self.assertEqual(data['durationEvent'], False)
+
+
+    def test_oldPickle(self):
+        event = Nagios2Timeline.Event(0, 'h1', 'DOWN')
+        event.__setstate__((100, 200, 'h1', None, 'DOWN', 'down', 'up'))
+        self.assertEqual(event.kind, None)
+        self.assertEqual(event['timestamp_end'], 200)
+
+
+class TestNagiosConfig(unittest.TestCase):
+    NAGIOS_CFG = """# Main configuration
+log_file=/var/log/nagios/nagios.log
+cfg_file=hosts.cfg
+cfg_dir=services
+"""
+    HOSTS_CFG = """define host {
+    name            generic-host ; a template
+    contacts        admins
+    register        0
+}
+define host{
+    use             generic-host
+    host_name       lc2-6.cs.helsinki.fi
+    alias           Lab \; rack 2
+    address         10.0.0.6
+    contacts        +oncall
+    }
+define host {
+    use             generic-host
+    host_name       svm-5.cs.helsinki.fi
+    hostgroups      servers
+}
+define hostgroup {
+    hostgroup_name  labs
+    members         lc2-6.cs.helsinki.fi
+}
+"""
+    SERVICES_CFG = """define service {
+    name                 generic-service
+    notes                Checked every five minutes
+    register             0
+}
+define service {
+    use                  generic-service
+    hostgroup_name       labs,servers
+    service_description  SSH
+    contact_groups       unix
+}
+define service {
+    use                  generic-service
+    host_name            *,!svm-5.cs.helsinki.fi
+    service_description  rpcbind
+}
+"""
+
+    def setUp(self):
+        self.directory = 'test-configs'
+        os.makedirs(os.path.join(self.directory, 'services'))
+        for (name, content) in [('nagios.cfg', self.NAGIOS_CFG),
+                                ('hosts.cfg', self.HOSTS_CFG),
+                                ('services/services.cfg',
+                                 self.SERVICES_CFG)]:
+            f = open(os.path.join(self.directory, name), 'w')
+            f.write(content)
+            f.close()
+        self.main = os.path.join(self.directory, 'nagios.cfg')
+
+
+    def tearDown(self):
+        for name in ['nagios.cfg', 'nagios.cfg.index', 'hosts.cfg',
+                     'services/services.cfg']:
+            path = os.path.join(self.directory, name)
+            if os.path.exists(path):
+                os.remove(path)
+        os.rmdir(os.path.join(self.directory, 'services'))
+        os.rmdir(self.directory)
+
+
+    def test_resolve(self):
+        configs = Nagios2Timeline.NagiosConfig([self.main])
+        configs.update()
+        self.assertEqual(configs.describe('lc2-6.cs.helsinki.fi'),
+                         'alias : Lab ; rack 2\naddress : 10.0.0.6\n' + \
+                         'hostgroups : labs\ncontacts : admins,oncall\n')
+        self.assertEqual(configs.describe('svm-5.cs.helsinki.fi', 'SSH'),
+                         'notes : Checked every five minutes\n' + \
+                         'contact_groups : unix\n' + \
+                         'hostgroups : servers\ncontacts : admins\n')
+        self.assert_(('lc2-6.cs.helsinki.fi', 'rpcbind') in configs.services)
+        self.failIf(('svm-5.cs.helsinki.fi', 'rpcbind') in configs.services)
+        self.assertEqual(configs.describe('svm-5.cs.helsinki.fi', 'rpcbind'),
+                         configs.describe('svm-5.cs.helsinki.fi'))
+        self.assertEqual(configs.describe('unknown'), '')
+
+
+    def test_index(self):
+        configs = Nagios2Timeline.NagiosConfig([self.directory],
+                                               self.main + '.index')
+        configs.update()
+        self.assert_(os.path.exists(self.main + '.index'))
+        files = configs.files()
+        self.assertEqual(len(files), 3)
+        self.assert_(configs.load(configs.signature(files)))
+        # Changing any file invalidates the index.
+        path = os.path.join(self.directory, 'hosts.cfg')
+        f = open(path, 'a')
+        f.write('define host {\n    host_name new\n    alias New\n}\n')
+        f.close()
+        self.failIf(configs.load(configs.signature(files)))
+        configs.update()
+        self.assertEqual(configs.describe('new'), 'alias : New\n')
+
+
+    def test_writer(self):
+        configs = Nagios2Timeline.NagiosConfig([self.main])
+        configs.update()
+        writer = ListWriter()
+        writer.configs = configs
+        event = {'host_name' : 'svm-5.cs.helsinki.fi', 'svc_desc' : 'SSH',
+                 'plugin_start' : 'SSH CRITICAL '}
+        self.assertEqual(writer.describe(event),
+                         'plugin_start : SSH CRITICAL\n' + \
+                         configs.describe('svm-5.cs.helsinki.fi', 'SSH'))
+        self.assertEqual(ListWriter().describe(event),
+                         'plugin_start : SSH CRITICAL\n')
+
+
+class TestRunStats(unittest.TestCase):
+    def test_counts(self):
+        (options, args) = Nagios2Timeline.optparser().parse_args([])
+        writer = ListWriter()
+        reader = Nagios2Timeline.NagiosLogReader(writer, options)
+        stats = Nagios2Timeline.RunStats()
+        stats.instrument(reader)
+        reader.process('examples/nagios.log')
+        reader.flush_events()
+        self.assertEqual([name for (name, fields) in stats.files],
+                         ['examples/nagios.log', '(flush)'])
+        fields = stats.files[0][1]
+        self.assertEqual(fields['lines'], 823)
+        self.assertEqual((fields['host_alerts'], fields['service_alerts']),
+                         (7, 52))
+        self.assertEqual(fields['unmatched'], 1)
+        self.assertEqual(fields['peak_ongoing'], 7)
+        self.assertEqual(stats.totals()['events'], len(writer.events))
+        self.assertEqual(stats.totals()['events'], reader.events_output)
+        out = StringIO()
+        stats.report(out)
+        self.assertEqual(len(out.getvalue().splitlines()), 4)
+
+
+    def test_save(self):
+        stats = Nagios2Timeline.RunStats()
+        stats.lines = 10
+        stats.finish('a.log', 2.0)
+        try:
+            stats.save('test-stats.json')
+            data = json.load(open('test-stats.json'))
+        finally:
+            os.remove('test-stats.json')
+        self.assertEqual(data['files'][0]['file'], 'a.log')
+        self.assertEqual(data['files'][0]['parsing'], 2.0)
+        self.assertEqual(data['totals']['lines'], 10)
+        self.assertEqual(stats.lines, 0)
+
+
+class TestSyntheticLog(unittest.TestCase):
+    def test_events(self):
+        try:
+            outages = bench_Nagios2Timeline.synthetic_log(
+                'test-synthetic.log', 10, 5, 0.02, 0.2, 3, 7)
+            self.assertEqual(open('test-synthetic.log').read(),
+                             self.generate())
+            (options, args) = Nagios2Timeline.optparser().parse_args([])
+            writer = ListWriter()
+            reader = Nagios2Timeline.NagiosLogReader(writer, options)
+            reader.process('test-synthetic.log')
+            reader.flush_events()
+        finally:
+            os.remove('test-synthetic.log')
+        self.assert_(outages > 0)
+        # Each outage is an event, none of them left open.
+        self.assertEqual(len(writer.events), outages)
+        self.assert_(reader.last_timestamp + 1 not in
+                     [e['timestamp_end'] for e in writer.events])
+
+
+    def generate(self):
+        """Return the log generated again with the same seed."""
+        try:
+            bench_Nagios2Timeline.synthetic_log('test-synthetic-2.log', 10, 5,
+                                                0.02, 0.2, 3, 7)
+            return open('test-synthetic-2.log').read()
+        finally:
+            os.remove('test-synthetic-2.log')
+
+
+class TestStartup(unittest.TestCase):
+    def test_lazyImports(self):
+        modules = subprocess.Popen(
+            [sys.executable, '-c',
+             'import sys, Nagios2Timeline; print " ".join(sys.modules)'],
+            stdout=subprocess.PIPE).communicate()[0].split()
+        for name in bench_Nagios2Timeline.LAZY_MODULES:
+            self.failIf(name in modules, name)
+        self.assertEqual(Nagios2Timeline.sqlite3.sqlite_version,
+                         sqlite3.sqlite_version)
+        self.assert_(Nagios2Timeline.sqlite3 is sqlite3)
+
+
+    def test_xmlEscape(self):
+        data = '<a href="x">&amp; \'y\'</a>'
+        self.assertEqual(Nagios2Timeline.xml_escape(data),
+                         xml.sax.saxutils.escape(data, {'"' : '&quot;'}))
+
+
+class TestProcessMany(unittest.TestCase):
+    # Each list is written into its own log file. The events of lc2-1 and
+    # lc2-3 span the file boundaries.
+    LOGS = [['[100] HOST ALERT: lc2-1;DOWN;HARD;1;down',
+             '[110] SERVICE ALERT: lc2-2;SSH;CRITICAL;HARD;1;refused'],
+            ['[200] HOST ALERT: lc2-1;DOWN;HARD;1;still down',
+             '[300] HOST ALERT: lc2-1;UP;HARD;1;up',
+             '[310] SERVICE ALERT: lc2-2;SSH;OK;HARD;1;ok',
+             '[400] HOST ALERT: lc2-1;DOWN;HARD;1;down again',
+             '[500] HOST ALERT: lc2-1;UP;HARD;1;up again'],
+            ['[600] HOST ALERT: lc2-4;UP;HARD;1;never down',
+             '[650] SERVICE ALERT: lc2-3;NFS;WARNING;HARD;1;slow'],
+            ['[700] SERVICE ALERT: lc2-3;NFS;CRITICAL;HARD;1;stuck']]
+
+    def setUp(self):
+        self.filenames = []
+        for (i, lines) in enumerate(self.LOGS):
+            filename = 'test-process-%d.log' % i
+            f = open(filename, 'w')
+            f.write('\n'.join(lines) + '\n')
+            f.close()
+            self.filenames.append(filename)
+        # Split the example log into files, too.
+        lines = open('examples/nagios.log').readlines()
+        for (i, start) in enumerate(range(0, len(lines), 100)):
+            filename = 'test-process-example-%d.log' % i
+            f = open(filename, 'w')
+            f.writelines(lines[start:start + 100])
+            f.close()
+            self.filenames.append(filename)
+
+
+    def tearDown(self):
+        for filename in self.filenames:
+            os.remove(filename)
+
+
+    def run_reader(self, parallel, args=()):
+        (options, args) = Nagios2Timeline.optparser().parse_args(list(args))
+        writer = ListWriter()
+        reader = Nagios2Timeline.NagiosLogReader(writer, options)
+        if parallel:
+            reader.process_many(self.filenames, 2)
+        else:
+            for filename in self.filenames:
+                reader.process(filename)
+        ongoing_events = dict([(identifier, dict(event)) for
+                               (identifier, event) in
+                               reader.ongoing_events.iteritems()])
+        return (writer.events, ongoing_events, reader.last_timestamp,
+                reader.events_seen)
+
+
+    def test_sameAsSequential(self):
+        sequential = self.run_reader(False)
+        self.assertEqual(self.run_reader(True), sequential)
+        self.assertEqual(sequential[0][0]['timestamp_start'], 100)
+        self.assertEqual(sequential[0][0]['timestamp_end'], 300)
+        self.assertEqual(
+            sequential[1][('lc2-3', 'NFS')]['timestamp_start'], 650)
+
+
+    def test_limits(self):
+        # Outages are truncated as they would be reading the files in turn.
+        sequential = self.run_reader(False, ['--max-open', '2'])
+        self.assertEqual(self.run_reader(True, ['--max-open', '2']),
+                         sequential)
+        self.assert_([event for event in sequential[0]
+                      if event['plugin_end'].startswith('Truncated')])
+
+
+
+class TestSources(unittest.TestCase):
+    # Two pollers watching the same host, the second in two log files.
+    LOGS = {'test-source-a.log' :
+                ['[100] HOST ALERT: lc2-1;DOWN;HARD;1;down',
+                 '[300] HOST ALERT: lc2-1;UP;HARD;1;up',
+                 '[310] SERVICE ALERT: lc2-2;SSH;CRITICAL;HARD;1;refused'],
+            'test-source-b/nagios-2.log' :
+                ['[400] HOST ALERT: lc2-1;UP;HARD;1;up',
+                 '[500] SERVICE ALERT: lc2-2;SSH;OK;HARD;1;ok'],
+            'test-source-b/nagios-1.log' :
+                ['[200] HOST ALERT: lc2-1;DOWN;HARD;1;down',
+                 'Not a log line',
+                 '[305] CURRENT HOST STATE: lc2-1;DOWN;HARD;1;down'],
+            'test-source-b/nagios-1.log.index' : ['[0] not a log']}
+
+    def setUp(self):
+        os.mkdir('test-source-b')
+        for (filename, lines) in self.LOGS.iteritems():
+            f = open(filename, 'w')
+            f.write('\n'.join(lines) + '\n')
+            f.close()
+
+
+    def tearDown(self):
+        for filename in self.LOGS:
+            os.remove(filename)
+        os.rmdir('test-source-b')
+
+
+    def test_merge(self):
+        source = Nagios2Timeline.LogSource('test-source-b')
+        self.assertEqual(source.filenames, ['test-source-b/nagios-1.log',
+                                            'test-source-b/nagios-2.log'])
+        lines = list(Nagios2Timeline.merge_sources(
+            [Nagios2Timeline.parse_source('test-source-a.log'),
+             Nagios2Timeline.parse_source('b=test-source-b')]))
+        self.assertEqual([int(line[1:4]) for line in lines],
+                         [100, 200, 300, 310, 400, 500])
+        self.assertEqual(lines[1],
+                         '[200] HOST ALERT: b/lc2-1;DOWN;HARD;1;down\n')
+
+
+    def test_reader(self):
+        (options, args) = Nagios2Timeline.optparser().parse_args([])
+        writer = ListWriter()
+        reader = Nagios2Timeline.NagiosLogReader(writer, options)
+        reader.process_sources(
+            [Nagios2Timeline.LogSource('test-source-a.log', 'a'),
+             Nagios2Timeline.LogSource('test-source-b', 'b')])
+        reader.flush_events()
+        self.assertEqual([(e['title'], e['timestamp_start'],
+                           e['timestamp_end']) for e in writer.events],
+                         [('a/lc2-1', 100, 300), ('b/lc2-1', 200, 400),
+                          ('a/lc2-2 SSH', 310, 501)])
+        # The recovery of b/lc2-2 was never seen failing.
+        self.assertEqual(reader.events_seen, 6)
+
+
+class TestCompressedInput(unittest.TestCase):
+    def setUp(self):
+        self.log = open('examples/nagios.log').read()
+        self.filenames = ['test-input.log.gz', 'test-input.log.bz2',
+                          'test-input.xz']
+        f = gzip.GzipFile(self.filenames[0], 'wb')
+        f.write(self.log)
+        f.close()
+        f = bz2.BZ2File(self.filenames[1], 'w')
+        f.write(self.log)
+        f.close()
+
+
+    def tearDown(self):
+        for filename in self.filenames:
+            if os.path.exists(filename):
+                os.remove(filename)
+
+
+    def run_reader(self, filename, offset=0):
+        (options, args) = Nagios2Timeline.optparser().parse_args([])
+        writer = ListWriter()
+        reader = Nagios2Timeline.NagiosLogReader(writer, options)
+        end = reader.process(filename, offset)
+        return (writer.events, sorted(reader.ongoing_events), end)
+
+
+    def test_sameAsPlain(self):
+        plain = self.run_reader('examples/nagios.log')
+        self.assertEqual(plain[2], len(self.log))
+        for filename in self.filenames[:2]:
+            self.assertEqual(self.run_reader(filename), plain)
+
+
+    def test_offset(self):
+        offset = self.log.index('\n', len(self.log) // 2) + 1
+        for filename in self.filenames[:2]:
+            self.assertEqual(self.run_reader(filename, offset),
+                             self.run_reader('examples/nagios.log', offset))
+
+
+    def test_xz(self):
+        f = open(self.filenames[2], 'wb')
+        f.write('\xfd7zXZ\x00')
+        f.close()
+        if Nagios2Timeline.lzma is None:
+            self.assertRaises(IOError,
+                              Nagios2Timeline.open_archive, self.filenames[2])
+
+
+    def test_scanner(self):
+        log = StringIO('a\n[1] HOST ALERT: x\nb\nc ALERT: y\nd\ne ALERT: z')
+        scanner = Nagios2Timeline.AlertScanner(' ALERT: ', log)
+        lines = list(scanner.scan(log.read(33)))
+        self.assertEqual(lines, ['[1] HOST ALERT: x\n', 'c ALERT: y\n'])
+        self.assertEqual(scanner.linenum(), 4)
+        self.assertEqual(list(scanner.scan(log.read())), ['e ALERT: z'])
+        self.assertEqual(scanner.linenum(), 6)
+        self.assertEqual(log.tell(), 45)
+
+
+
+class TestParsedAlerts(unittest.TestCase):
+    def setUp(self):
+        self.filename = 'test-parsed.alerts'
+        (options, args) = Nagios2Timeline.optparser().parse_args([])
+        reader = Nagios2Timeline.NagiosLogReader(ListWriter(), options)
+        reader.dump = Nagios2Timeline.ParsedDump(self.filename)
+        reader.process('examples/nagios.log')
+        reader.dump.close()
+
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+
+    def run_reader(self, args, replay):
+        (options, args) = Nagios2Timeline.optparser().parse_args(args)
+        writer = ListWriter()
+        reader = Nagios2Timeline.NagiosLogReader(writer, options)
+        if replay:
+            alerts = Nagios2Timeline.ParsedAlerts(self.filename)
+            try:
+                reader.replay(alerts)
+            finally:
+                alerts.close()
+        else:
+            reader.process('examples/nagios.log')
+        reader.flush_events()
+        return (writer.events, reader.last_timestamp, reader.events_seen)
+
+
+    def test_sameAsLog(self):
+        # The dump holds every alert, whatever the options it was made with.
+        for args in ([], ['-s'], ['-o', '-w'], ['--host', 'lc2-*'],
+                     ['--exclude-service', 'SSH', '-c']):
+            self.assertEqual(self.run_reader(args, True),
+                             self.run_reader(args, False))
+
+
+    def test_withoutNumpy(self):
+        events = self.run_reader(['-w'], True)
+        numpy = Nagios2Timeline.numpy
+        Nagios2Timeline.numpy = False
+        try:
+            self.assertEqual(self.run_reader(['-w'], True), events)
+        finally:
+            Nagios2Timeline.numpy = numpy
+
+
+    def test_format(self):
+        alerts = Nagios2Timeline.ParsedAlerts(self.filename)
+        try:
+            self.assertEqual(alerts.count, 59)
+            self.assertEqual(alerts.names[1][0], '')
+            self.assert_('lc2-6.cs.helsinki.fi' in alerts.names[0])
+        finally:
+            alerts.close()
+        self.assertRaises(ValueError, Nagios2Timeline.ParsedAlerts,
+                          'examples/nagios.log')
+        data = open(self.filename, 'rb').read()
+        open(self.filename, 'wb').write(data[:-10])
+        self.assertRaises(ValueError, Nagios2Timeline.ParsedAlerts,
+                          self.filename)
+
+
+    def test_batches(self):
+        # Columns appended to their temporary files in several batches
+        # make the same dump, and the temporary files are removed.
+        filename = 'test-parsed-batches.alerts'
+        (options, args) = Nagios2Timeline.optparser().parse_args([])
+        reader = Nagios2Timeline.NagiosLogReader(ListWriter(), options)
+        reader.dump = Nagios2Timeline.ParsedDump(filename)
+        reader.dump.BATCH = 7
+        reader.process('examples/nagios.log')
+        self.assert_(os.path.exists(reader.dump.temporary('heap')))
+        self.assertEqual(reader.dump.count, 59)
+        reader.dump.close()
+        try:
+            self.assertEqual(open(filename, 'rb').read(),
+                             open(self.filename, 'rb').read())
+            self.assertEqual([name for name in os.listdir('.')
+                              if name.startswith(filename + '.')], [])
+        finally:
+            os.remove(filename)
+
+
+
+class TestWindow(unittest.TestCase):
+    def setUp(self):
+        lines = open('examples/nagios.log').readlines()
+        self.filenames = []
+        for (i, start) in enumerate(range(0, len(lines), 150)):
+            filename = 'test-window-%d.log' % i
+            f = open(filename, 'w')
+            f.writelines(lines[start:start + 150])
+            f.close()
+            self.filenames.append(filename)
+        # Many small blocks, so that each file gets several index points.
+        self.sizes = (Nagios2Timeline.LogIndex.INTERVAL,
+                      Nagios2Timeline.NagiosLogReader.READ_SIZE)
+        Nagios2Timeline.LogIndex.INTERVAL = 2048
+        Nagios2Timeline.NagiosLogReader.READ_SIZE = 512
+
+
+    def tearDown(self):
+        (Nagios2Timeline.LogIndex.INTERVAL,
+         Nagios2Timeline.NagiosLogReader.READ_SIZE) = self.sizes
+        for filename in self.filenames:
+            for name in (filename, filename + '.index'):
+                if os.path.exists(name):
+                    os.remove(name)
+
+
+    def run_reader(self, args):
+        (options, args) = Nagios2Timeline.optparser().parse_args(args)
+        writer = ListWriter()
+        reader = Nagios2Timeline.NagiosLogReader(writer, options)
+        if options.since is None and options.until is None:
+            for filename in self.filenames:
+                reader.process(filename)
+        else:
+            reader.process_window(self.filenames)
+        closed = list(writer.events)
+        reader.flush_events()
+        return (closed, writer.events)
+
+
+    def test_since(self):
+        (closed, events) = self.run_reader([])
+        for since in (1256791332, 1256805672, 1256844600):
+            self.assertEqual(self.run_reader(['--since', str(since)])[1],
+                             [event for event in events
+                              if event['timestamp_end'] >= since])
+        self.assert_(os.path.exists(self.filenames[0] + '.index'))
+
+
+    def test_until(self):
+        (closed, events) = self.run_reader([])
+        until = 1256805672
+        window = self.run_reader(['--until', str(until)])[0]
+        self.assertEqual([event for event in window
+                          if event['timestamp_end'] <= until],
+                         [event for event in closed
+                          if event['timestamp_end'] <= until])
+        for event in window:
+            self.assert_(event['timestamp_start'] <= until)
+
+
+    def test_indexReused(self):
+        (options, args) = Nagios2Timeline.optparser().parse_args([])
+        index = Nagios2Timeline.LogIndex(self.filenames[0], options)
+        index.update()
+        self.assert_(len(index.points) > 2)
+        loaded = Nagios2Timeline.LogIndex(self.filenames[0], options)
+        self.assert_(loaded.load(index.signature()))
+        self.assertEqual(loaded.points, index.points)
+        options.WARNING = True
+        self.failIf(loaded.load(index.signature()))
+
+
+    def test_parseTime(self):
+        (options, args) = Nagios2Timeline.optparser().parse_args(
+            ['--since', '1256805672', '--until', '2009-10-29 12:30'])
+        self.assertEqual(options.since, 1256805672)
+        self.assertEqual(options.until, int(time.mktime(
+            time.strptime('2009-10-29 12:30', '%Y-%m-%d %H:%M'))))
+
+
+
+class TestCheckpoint(unittest.TestCase):
+    def setUp(self):
+        self.lines = open('examples/nagios.log').readlines()
+        self.files = ['test-checkpoint.log', 'test-checkpoint.xml',
+                      'test-checkpoint.xml.checkpoint', 'test-full.xml']
+
+
+    def tearDown(self):
+        for filename in self.files:
+            if os.path.exists(filename):
+                os.remove(filename)
+
+
+    def run_incremental(self, lines):
+        if lines:
+            f = open(self.files[0], 'a')
+            f.writelines(lines)
+            f.close()
+        (options, args) = Nagios2Timeline.optparser().parse_args(['-i'])
+        checkpoint = Nagios2Timeline.Checkpoint(self.files[2])
+        append = checkpoint.load()
+        writer = Nagios2Timeline.TimelineWriterXML(self.files[1], append,
+                                                   checkpoint)
+        reader = Nagios2Timeline.NagiosLogReader(writer, options)
+        reader.set_ongoing_events(writer.get_ongoing_events())
+        reader.last_timestamp = max(reader.last_timestamp,
+                                    writer.last_timestamp)
+        offset = checkpoint.input_offset(self.files[0])
+        end = reader.process(self.files[0], offset)
+        reader.flush_events(checkpoint)
+        checkpoint.consumed(self.files[0], end)
+        checkpoint.save()
+        return (offset, end)
+
+
+    def test_incrementalRuns(self):
+        (options, args) = Nagios2Timeline.optparser().parse_args([])
+        writer = Nagios2Timeline.TimelineWriterXML(self.files[3])
+        reader = Nagios2Timeline.NagiosLogReader(writer, options)
+        reader.process('examples/nagios.log')
+        reader.flush_events()
+        self.run_incremental(self.lines[:400])
+        (offset, end) = self.run_incremental(self.lines[400:])
+        self.assertEqual(offset, len(''.join(self.lines[:400])))
+        self.assertEqual(end, os.path.getsize(self.files[0]))
+        self.assertEqual(open(self.files[1]).read(),
+                         open(self.files[3]).read())
+
+
+    def test_partialLine(self):
+        # A last line still being written is left for the next run.
+        (options, args) = Nagios2Timeline.optparser().parse_args([])
+        writer = Nagios2Timeline.TimelineWriterXML(self.files[3])
+        reader = Nagios2Timeline.NagiosLogReader(writer, options)
+        reader.process('examples/nagios.log')
+        reader.flush_events()
+        alerts = [index for (index, line) in enumerate(self.lines)
+                  if 'SERVICE ALERT' in line]
+        split = alerts[len(alerts) // 2]
+        middle = len(self.lines[split]) // 2
+        (offset, end) = self.run_incremental(self.lines[:split] +
+                                             [self.lines[split][:middle]])
+        self.assertEqual(end, len(''.join(self.lines[:split])))
+        (offset, end) = self.run_incremental([self.lines[split][middle:]] +
+                                             self.lines[split + 1:])
+        self.assertEqual(offset, len(''.join(self.lines[:split])))
+        self.assertEqual(end, os.path.getsize(self.files[0]))
+        self.assertEqual(open(self.files[1]).read(),
+                         open(self.files[3]).read())
+
+
+    def test_compressedRuns(self):
+        # The offset into a compressed log counts uncompressed bytes, which
+        # are more than the size of the file.
+        self.files[0] = 'test-checkpoint.log.gz'
+        f = gzip.GzipFile(self.files[0], 'wb')
+        f.writelines(self.lines)
+        f.close()
+        (options, args) = Nagios2Timeline.optparser().parse_args([])
+        writer = Nagios2Timeline.TimelineWriterXML(self.files[3])
+        reader = Nagios2Timeline.NagiosLogReader(writer, options)
+        reader.process('examples/nagios.log')
+        reader.flush_events()
+        self.run_incremental([])
+        (offset, end) = self.run_incremental([])
+        self.assertEqual(offset, len(''.join(self.lines)))
+        self.assertEqual(open(self.files[1]).read(),
+                         open(self.files[3]).read())
+
+
+    def test_invalidCheckpoint(self):
+        f = open(self.files[2], 'w')
+        f.write('garbage')
+        f.close()
+        checkpoint = Nagios2Timeline.Checkpoint(self.files[2])
+        self.assertRaises(ValueError, checkpoint.load)
+
+
+
+class TestService(unittest.TestCase):
+    def setUp(self):
+        self.filename = 'test-serve.log'
+        self.write('w', '[100] HOST ALERT: lc2-1;DOWN;HARD;1;down\n' + \
+                   '[110] SERVICE ALERT: lc2-2;SSH;CRITICAL;HARD;1;no\n' + \
+                   '[200] HOST ALERT: lc2-1;UP;HARD;1;up\n')
+        (options, args) = Nagios2Timeline.optparser().parse_args([])
+        self.service = Nagios2Timeline.TimelineService([self.filename],
+                                                       options)
+
+
+    def tearDown(self):
+        self.service.close()
+        os.remove(self.filename)
+
+
+    def write(self, mode, data):
+        f = open(self.filename, mode)
+        f.write(data)
+        f.close()
+
+
+    def titles(self, body):
+        dom = xml.dom.minidom.parseString(body)
+        return [event.getAttribute('title')
+                for event in dom.getElementsByTagName('event')]
+
+
+    def test_query(self):
+        (status, headers, body) = self.service.respond('/events.xml', '')
+        self.assertEqual(status, 200)
+        # The ongoing service outage ends after the last timestamp.
+        self.assertEqual(self.titles(body), ['lc2-1', 'lc2-2 SSH'])
+        for (query, titles) in [('host=lc2-2', ['lc2-2 SSH']),
+                                ('state=down', ['lc2-1']),
+                                ('since=150', ['lc2-1', 'lc2-2 SSH']),
+                                ('since=202', []),
+                                ('until=105&exclude_host=lc2-2', ['lc2-1'])]:
+            (status, headers, body) = self.service.respond('/events.xml',
+                                                           query)
+            self.assertEqual(self.titles(body), titles)
+        (status, headers, body) = self.service.respond('/events.json',
+                                                       'host=lc2-2')
+        self.assertEqual([event['title'] for event in
+                          json.loads(body)['events']], ['lc2-2 SSH'])
+        self.assertEqual(self.service.respond('/events.xml', 'host=re:(')[0],
+                         400)
+        self.assertEqual(self.service.respond('/events.xml', 'foo=1')[0], 400)
+        self.assertEqual(self.service.respond('/index.html', '')[0], 404)
+
+
+    def test_cache(self):
+        (status, headers, body) = self.service.respond('/events.xml', '',
+                                                       True)
+        headers = dict(headers)
+        self.assertEqual(headers['Content-Encoding'], 'gzip')
+        plain = self.service.respond('/events.xml', '')[2]
+        self.assertEqual(gzip.GzipFile(fileobj=StringIO(body)).read(), plain)
+        self.assertEqual(self.service.cache.hits, 1)
+        self.assertEqual(headers['Vary'], 'Accept-Encoding')
+        # Each encoding has an ETag of its own.
+        (status, unused, body) = self.service.respond('/events.xml', '', False,
+                                                      headers['ETag'])
+        self.assertEqual((status, body), (200, plain))
+        (status, unused, body) = self.service.respond('/events.xml', '', True,
+                                                      headers['ETag'])
+        self.assertEqual((status, body), (304, ''))
+        # New log data clears the cache, and changes the document.
+        self.write('a', '[300] SERVICE ALERT: lc2-2;SSH;OK;HARD;1;yes\n')
+        (status, headers, body) = self.service.respond('/events.xml', '',
+                                                       False, headers['ETag'])
+        self.assertEqual(status, 200)
+        self.assertEqual(self.service.cache.hits, 3)
+        self.assertEqual(self.service.store.ends, [200, 300])
+
+
+    def test_evict(self):
+        cache = Nagios2Timeline.ResponseCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')
+        cache.put('c', 3)
+        self.assertEqual(sorted(cache.responses), ['a', 'c'])
+        self.assertEqual(cache.get('b'), None)
+
+
+    def test_http(self):
+        server = Nagios2Timeline.http_server(('127.0.0.1', 0),
+                                             self.service)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            url = 'http://127.0.0.1:%d/events.xml?host=lc2-1' % \
+                  server.server_address[1]
+            response = urllib2.urlopen(url)
+            self.assertEqual(self.titles(response.read()), ['lc2-1'])
+            self.assert_(response.info()['ETag'])
+        finally:
+            server.shutdown()
+            thread.join()
+            server.server_close()
+
+
+class TestLogFollower(unittest.TestCase):
+    def setUp(self):
+        self.files = ['test-follow.log', 'test-follow.log.1']
+        (options, args) = Nagios2Timeline.optparser().parse_args([])
+        self.writer = ListWriter()
+        self.reader = Nagios2Timeline.NagiosLogReader(self.writer, options)
+        self.write('w', '[100] HOST ALERT: lc2-1;DOWN;HARD;1;down\n')
+        self.follower = Nagios2Timeline.LogFollower(self.reader,
+                                                    self.files[0], batch=1)
+
+
+    def tearDown(self):
+        self.follower.close()
+        for filename in self.files:
+            if os.path.exists(filename):
+                os.remove(filename)
+
+
+    def write(self, mode, data):
+        f = open(self.files[0], mode)
+        f.write(data)
+        f.close()
+
+
+    def test_partialLine(self):
+        self.follower.poll()
+        self.write('a', '[200] HOST ALERT: lc2-1;UP;HARD;1;')
+        self.follower.poll()
+        self.assertEqual(self.writer.events, [])
+        self.write('a', 'up\n')
+        self.follower.poll()
+        self.assertEqual(len(self.writer.events), 1)
+        self.assertEqual(self.writer.events[0]['plugin_end'], 'up')
+        self.assertEqual(self.follower.offset,
+                         os.path.getsize(self.files[0]))
+
+
+    def test_rotation(self):
+        self.follower.poll()
+        self.write('a', '[150] SERVICE ALERT: lc2-2;SSH;CRITICAL;HARD;1;no\n')
+        os.rename(self.files[0], self.files[1])
+        self.write('w', '[200] HOST ALERT: lc2-1;UP;HARD;1;up\n' + \
+                   '[210] SERVICE ALERT: lc2-2;SSH;OK;HARD;1;yes\n')
+        self.follower.poll()
+        self.assertEqual([event['title'] for event in self.writer.events],
+                         ['lc2-1', 'lc2-2 SSH'])
+        self.assertEqual(self.reader.ongoing_events, {})
+
+
+
+suite = unittest.TestLoader().loadTestsFromModule(sys.modules[__name__])
 unittest.TextTestRunner(verbosity=2).run(suite)